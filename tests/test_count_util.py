@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+import utilities.count_util as ut_count
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'count')
+
+# the expected tables were made with HTSeq 2.1.2:
+#   htseq-count -f bam -r pos -s no -m intersection-nonempty -t exon \
+#       -i gene_id -a 10 {name}.bam genes.gtf > {name}.counts
+#
+# the reads cover spliced and clipped alignments, multi-mappers, reads
+# without an NH tag, low quality, unaligned and unplaced reads, references
+# without genes and, in paired.bam, mates on different references, mates
+# that are unaligned and mates missing from the file
+
+
+@pytest.mark.parametrize('name', ['single', 'paired'])
+@pytest.mark.parametrize('n_proc', [1, 3])
+def test_counts_match_htseq_count(tmp_path, name, n_proc):
+    out_path = str(tmp_path / 'counts.txt')
+
+    genes, counts = ut_count.count_reads(
+            os.path.join(DATA_DIR, '{}.bam'.format(name)),
+            os.path.join(DATA_DIR, 'genes.gtf'), n_proc=n_proc,
+            index_path=str(tmp_path / 'genes.gtf.idx')
+    )
+    ut_count.write_counts(out_path, genes, counts)
+
+    with open(out_path) as fh, \
+            open(os.path.join(DATA_DIR, '{}.counts'.format(name))) as expected:
+        assert fh.read() == expected.read()
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+
+import multiprocessing as mp
+
+import utilities.pipeline_util as ut_pipe
+
+
+def wait_for(budget, *request):
+    budget.acquire(*request)
+    time.sleep(60)
+
+
+def acquire_in_thread(budget, *request):
+    """Start acquiring in a thread, so a test can't hang on it"""
+    thread = threading.Thread(target=budget.acquire, args=request, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_disk_budget_waiter_dies():
+    budget = ut_pipe.DiskBudget(100, interval=0.01)
+    budget.acquire(100)
+
+    # dies while it is queued, holding a ticket that will never be used
+    proc = mp.Process(target=wait_for, args=(budget, 50))
+    proc.start()
+    time.sleep(0.2)
+    proc.kill()
+    proc.join()
+
+    assert budget.reclaim(proc.pid) == ()
+
+    budget.release(100)
+    thread = acquire_in_thread(budget, 50)
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert budget.used == 50
+
+
+def admit(budget, n_bytes, admitted):
+    budget.acquire(n_bytes)
+    admitted.put(n_bytes)
+
+
+def test_disk_budget_in_order():
+    budget = ut_pipe.DiskBudget(100, interval=0.01)
+    budget.acquire(60)
+    admitted = mp.Queue()
+
+    # the large request was first, so the small one waits behind it
+    procs = []
+    for n_bytes in (80, 10):
+        procs.append(mp.Process(target=admit, args=(budget, n_bytes, admitted)))
+        procs[-1].start()
+        time.sleep(0.2)
+
+    assert admitted.empty()
+
+    budget.release(60)
+    for proc in procs:
+        proc.join(5)
+
+    assert [admitted.get(timeout=1) for proc in procs] == [80, 10]
+    assert budget.used == 90
+
+
+def test_resource_budget_reclaim():
+    budget = ut_pipe.ResourceBudget(4, 100, interval=0.01)
+
+    proc = mp.Process(target=wait_for, args=(budget, 3, 60))
+    proc.start()
+    while budget.used == (0, 0):
+        time.sleep(0.01)
+    proc.kill()
+    proc.join()
+
+    assert budget.reclaim(proc.pid) == (3, 60)
+    assert budget.used == (0, 0)
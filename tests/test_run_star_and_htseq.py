@@ -0,0 +1,159 @@
+import logging
+import os
+import queue
+import threading
+
+import multiprocessing as mp
+
+import utilities.alignment.run_star_and_htseq as rsh
+import utilities.checkpoint_util as ut_ckpt
+import utilities.pipeline_util as ut_pipe
+import utilities.queue_util as ut_queue
+
+
+class DyingQueue(object):
+    """An upload queue whose worker dies as soon as it has handed on one item"""
+
+    def __init__(self, queue, sample_name):
+        self.queue = queue
+        self.sample_name = sample_name
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def put(self, item):
+        self.queue.put(item)
+        if item[1] == self.sample_name:
+            # make sure the item gets there before we do
+            self.queue.close()
+            self.queue.join_thread()
+            os._exit(1)
+
+
+def drain(q):
+    items = []
+    while True:
+        try:
+            items.append(q.get(timeout=1))
+        except queue.Empty:
+            return items
+
+
+def test_count_worker_dies_after_upload_handoff(tmp_path):
+    run_dir = str(tmp_path)
+    input_dir, taxon = 'run', 'mus'
+    samples = ['first', 'die-after', 'last']
+
+    # already counted, so the workers go straight to the upload hand-off
+    checkpoints = ut_ckpt.Checkpoints(run_dir)
+    for sample_name in samples:
+        os.makedirs(os.path.join(run_dir, input_dir, sample_name, taxon,
+                                 'results', 'Pass1'))
+        checkpoints.mark(input_dir, sample_name, taxon, 'count')
+
+    manager = mp.Manager()
+    log_queue = mp.Queue()
+    htseq_queue = mp.Queue()
+    upload_queue = mp.Queue()
+
+    budget = ut_pipe.ResourceBudget(4, 8 * 1024 ** 3, interval=0.01)
+    disk_space = ut_pipe.DiskBudget(1024 ** 4)
+    tracker = ut_pipe.PartTracker(manager)
+    genomes = {taxon: {'sjdb_gtf': 'genes.gtf', 'reference': None}}
+
+    failures = []
+    pool = ut_pipe.WorkerPool(
+            'count', rsh.run_htseq,
+            (DyingQueue(upload_queue, 'die-after'), log_queue,
+             's3://bucket/fastqs', None, genomes, budget, 'builtin', 'gzip',
+             False, 'bam', disk_space, tracker, checkpoints, None),
+            htseq_queue, 2, manager, log_queue, retries=1,
+            on_failure=failures.append, budgets=[budget], interval=0.1
+    )
+    pool.start()
+
+    for sample_name in samples:
+        htseq_queue.put((input_dir, sample_name,
+                         os.path.join(run_dir, input_dir, sample_name),
+                         taxon, 'pos', 0))
+
+    pool.stop()
+
+    uploaded = [item[1] for item in drain(upload_queue)]
+    messages = [msg for msg, level in drain(log_queue)]
+    manager.shutdown()
+
+    assert sorted(uploaded) == sorted(samples)
+    assert failures == []
+    assert not any(msg.startswith(('Retrying', 'Giving up'))
+                   for msg in messages)
+    assert sum(pool.restarts) == 1
+
+
+class FinishingQueue(object):
+    """A download queue for a pipeline that finishes samples straight away"""
+
+    def __init__(self, work_queue):
+        self.work_queue = work_queue
+        self.samples = []
+
+    def put(self, sample):
+        self.samples.append(sample[1])
+        self.work_queue.complete('{}/{}'.format(*sample[:2]))
+
+
+def test_claim_samples_after_lease_expires(tmp_path):
+    path = str(tmp_path)
+    samples = [('run', sample_name, [], 0, ['mus'])
+               for sample_name in ('mine', 'theirs')]
+
+    # a job that claimed a sample and died
+    ut_queue.LeaseQueue(path, owner='dead', lease_seconds=1).claim('run/theirs')
+
+    work_queue = ut_queue.LeaseQueue(path, owner='alive', lease_seconds=1)
+    download_queue = FinishingQueue(work_queue)
+
+    stop_renewing, renew_thread = rsh.claim_samples(
+            work_queue, samples, download_queue, 0, 1,
+            logging.getLogger(__name__)
+    )
+    stop_renewing.set()
+    renew_thread.join()
+
+    assert download_queue.samples == ['mine', 'theirs']
+    assert all(work_queue.is_finished('run/{}'.format(sample[1]))
+               for sample in samples)
+
+
+class FlakyQueue(object):
+    lease_seconds = 0.03
+
+    def __init__(self):
+        self.renewed = []
+
+    def renew(self, item):
+        self.renewed.append(item)
+        if item == 'flaky':
+            raise OSError('try again')
+        return item != 'gone'
+
+
+def test_renew_leases_survives_errors():
+    work_queue = FlakyQueue()
+    held = {'gone', 'flaky', 'kept'}
+    stop_event = threading.Event()
+
+    thread = threading.Thread(
+            target=rsh.renew_leases,
+            args=(work_queue, held, threading.Lock(), stop_event,
+                  logging.getLogger(__name__)),
+            daemon=True
+    )
+    thread.start()
+    while work_queue.renewed.count('flaky') < 2:
+        stop_event.wait(0.01)
+    stop_event.set()
+    thread.join()
+
+    assert held == {'flaky', 'kept'}
+    assert work_queue.renewed.count('gone') == 1
@@ -5,7 +5,12 @@ import argparse
 import os
 import sys
 import subprocess
-import tarfile
+
+import concurrent.futures as cf
+
+import utilities.archive_util as ut_archive
+import utilities.reference_util as ut_ref
+import utilities.s3_util as s3u
 
 from utilities.log_util import get_logger, log_command
 
@@ -33,16 +38,53 @@ def get_parser():
     parser.add_argument('--cell_count', type=int, default=3000)
 
     parser.add_argument('--glacier', action='store_true')
+    parser.add_argument('--glacier_tier', default='Standard',
+                        choices=s3u.RESTORE_TIERS,
+                        help='Retrieval tier for restoring from Glacier')
+    parser.add_argument('--archive_format', choices=ut_archive.ARCHIVE_FORMATS,
+                        default='gzip',
+                        help='Compression for the results archive, which is'
+                             ' streamed to S3 while it is compressed')
+    parser.add_argument('--indexed_archive', action='store_true',
+                        help='Compress each file in the results archive'
+                             ' separately and save an index next to it, so'
+                             ' single files can be read with a ranged GET.'
+                             ' Requires gzip')
     parser.add_argument('--root_dir', default='/mnt')
+    parser.add_argument('--reference_cache', default=ut_ref.CACHE_DIR,
+                        help='Host-level cache directory for reference data')
+    parser.add_argument('--reference_cache_size', type=int, default=100,
+                        help='Size limit for the reference cache, in GB')
+    parser.add_argument('--no_reference_cache', action='store_true',
+                        help='Download reference data for this job only')
 
     return parser
 
 
+def upload_with_retry(session, src_files, dest_keys, bucket, logger):
+    """Upload files concurrently, retrying the ones that fail"""
+    file_pairs = list(zip(src_files, dest_keys))
+
+    for i in range(S3_RETRY):
+        failed = {r.key for r in session.upload(file_pairs, bucket)
+                  if not r.success}
+        if not failed:
+            return
+
+        logger.info("retrying upload of {}".format(', '.join(sorted(failed))))
+        file_pairs = [(src, key) for src, key in file_pairs if key in failed]
+
+    raise RuntimeError("couldn't upload {}".format(', '.join(sorted(failed))))
+
+
 def main(logger):
     parser = get_parser()
 
     args = parser.parse_args()
 
+    if args.indexed_archive and args.archive_format != 'gzip':
+        raise ValueError('--indexed_archive needs --archive_format gzip')
+
     if os.environ.get('AWS_BATCH_JOB_ID'):
         args.root_dir = os.path.join(args.root_dir,
                                      os.environ['AWS_BATCH_JOB_ID'])
@@ -54,9 +96,6 @@ def main(logger):
     fastq_path = os.path.join(result_path, 'fastqs')
     os.makedirs(fastq_path)
 
-    genome_base_dir = os.path.join(args.root_dir, "genome", "cellranger")
-    os.makedirs(genome_base_dir)
-
     if args.taxon == 'homo':
         genome_name = 'HG38-PLUS'
     elif args.taxon == 'mus':
@@ -77,28 +116,57 @@ def main(logger):
 
     genome_tar_source = os.path.join('s3://czi-hca/ref-genome/cellranger/',
                                      genome_name + '.tgz')
-    genome_dir = os.path.join(genome_base_dir, genome_name)
 
-    # download the ref genome data
-    command = ['aws', 's3', 'cp', '--quiet',
-               genome_tar_source, genome_base_dir]
-    log_command(logger, command, shell=True)
+    # download and extract the ref genome data in one pass
+    if args.no_reference_cache:
+        genome_base_dir = os.path.join(args.root_dir, "genome", "cellranger")
+        os.makedirs(genome_base_dir)
 
-    genome_tar_file = os.path.basename(genome_tar_source)
-    logger.debug('Extracting {}'.format(genome_tar_file))
-    with tarfile.open(os.path.join(genome_base_dir, genome_tar_file)) as tf:
-        tf.extractall(path=genome_base_dir)
+        ut_ref.stage_reference(*s3u.s3_bucket_and_key(genome_tar_source),
+                               genome_base_dir, logger)
+    else:
+        # shared with other jobs on this host, released when the job exits
+        ref_cache = ut_ref.ReferenceCache(
+                args.reference_cache,
+                max_bytes=args.reference_cache_size * 1024 ** 3
+        )
+        genome_base_dir = ref_cache.acquire(
+                *s3u.s3_bucket_and_key(genome_tar_source), logger=logger
+        )
+
+    genome_dir = os.path.join(genome_base_dir, genome_name)
 
 
     sys.stdout.flush()
 
     # download the fastq files
-    command = ['aws', 's3', 'cp',
-               '--no-progress',
-               '--recursive',
-               '--force-glacier-transfer' if args.glacier else '',
-               args.s3_input_dir, fastq_path]
-    log_command(logger, command, shell=True)
+    if args.glacier:
+        # restore from glacier and start downloading as files come back
+        s3_input_bucket, s3_input_prefix = s3u.s3_bucket_and_key(
+                args.s3_input_dir
+        )
+        s3_input_prefix = s3_input_prefix.rstrip('/') + '/'
+
+        fastq_keys = list(s3u.get_files(s3_input_bucket, s3_input_prefix))
+        fastq_files = [
+            os.path.join(fastq_path, os.path.relpath(k, s3_input_prefix))
+            for k in fastq_keys
+        ]
+
+        logger.info('Restoring and downloading {} files'.format(
+                len(fastq_keys))
+        )
+        failed = s3u.restore_and_download(fastq_keys, fastq_files,
+                                          b=s3_input_bucket,
+                                          tier=args.glacier_tier)
+        if failed:
+            raise RuntimeError("couldn't download {} files".format(len(failed)))
+    else:
+        command = ['aws', 's3', 'cp',
+                   '--no-progress',
+                   '--recursive',
+                   args.s3_input_dir, fastq_path]
+        log_command(logger, command, shell=True)
 
 
     # Run cellranger
@@ -114,36 +182,48 @@ def main(logger):
 
 
     # Move results(websummary, cell-gene table, tarball) data back to S3
-    for file_name in files_to_upload:
-        command = ['aws', 's3', 'cp', '--quiet',
-                   os.path.join(result_path, sample_id, file_name),
-                   '{}/'.format(args.s3_output_dir)]
-        for i in range(S3_RETRY):
-            try:
-                log_command(logger, command, shell=True)
-                break
-            except subprocess.CalledProcessError:
-                logger.info("retrying cp {}".format(file_name))
-        else:
-            raise RuntimeError("couldn't sync {}".format(file_name))
-
-    command = ['tar', 'cvzf',
-               '{}.tgz'.format(os.path.join(result_path, sample_id)),
-               sample_id]
-    log_command(logger, command, shell=True)
-
-
-    command = ['aws', 's3', 'cp', '--quiet',
-               '{}.tgz'.format(os.path.join(result_path, sample_id)),
-               '{}/'.format(args.s3_output_dir)]
-    for i in range(S3_RETRY):
-        try:
-            log_command(logger, command, shell=True)
-            break
-        except subprocess.CalledProcessError:
-            logger.info("retrying cp {}.tgz".format(sample_id))
-    else:
-        raise RuntimeError("couldn't sync {}.tgz".format(sample_id))
+    s3_output_bucket, s3_output_prefix = s3u.s3_bucket_and_key(
+            args.s3_output_dir.rstrip('/')
+    )
+
+    src_files = [os.path.join(result_path, sample_id, file_name)
+                 for file_name in files_to_upload]
+    dest_keys = [os.path.join(s3_output_prefix, os.path.basename(file_name))
+                 for file_name in files_to_upload]
+
+    archive_key = os.path.join(s3_output_prefix, '{}{}'.format(
+            sample_id, ut_archive.EXTENSIONS[args.archive_format]))
+
+    with s3u.TransferSession(n_threads=2 * s3u.UPLOAD_CONCURRENCY) as session:
+        # the summary files go up while the archive is compressed and
+        # streamed to S3, without writing a local tarball
+        with cf.ThreadPoolExecutor(max_workers=1) as executor:
+            uploads = executor.submit(upload_with_retry, session, src_files,
+                                      dest_keys, s3_output_bucket, logger)
+
+            for i in range(S3_RETRY):
+                try:
+                    stats = ut_archive.upload_archive(
+                            os.path.join(result_path, sample_id),
+                            s3_output_bucket, archive_key,
+                            archive_format=args.archive_format,
+                            n_threads=os.cpu_count(),
+                            indexed=args.indexed_archive
+                    )
+                    break
+                except Exception:
+                    logger.info("retrying upload of {}".format(archive_key),
+                                exc_info=True)
+            else:
+                raise RuntimeError("couldn't upload {}".format(archive_key))
+
+            uploads.result()
+
+        logger.info('Archived {:.1f} GB to {:.1f} GB in {:.1f}s'.format(
+                stats['bytes_in'] / 1e9, stats['bytes_out'] / 1e9,
+                stats['seconds']))
+        logger.info('Uploaded {bytes} bytes in {seconds:.1f}s'.format(
+                **session.counters()))
 
 
 if __name__ == "__main__":
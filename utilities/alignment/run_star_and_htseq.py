@@ -1,20 +1,27 @@
 #!/usr/bin/env python
 import argparse
-import datetime
 import logging
 import os
-import re
+import shlex
+import shutil
 import subprocess
-import tarfile
+import threading
+import time
 
 import multiprocessing as mp
 
-from collections import defaultdict
+import concurrent.futures as cf
 
+
+import utilities.archive_util as ut_archive
+import utilities.checkpoint_util as ut_ckpt
+import utilities.count_util as ut_count
 import utilities.log_util as ut_log
+import utilities.pipeline_util as ut_pipe
+import utilities.queue_util as ut_queue
+import utilities.reference_util as ut_ref
 import utilities.s3_util as s3u
-
-import boto3
+import utilities.sample_util as ut_sample
 
 
 S3_LOG_DIR = 's3://jamestwebber-logs/star_logs/'
@@ -40,7 +47,32 @@ COMMON_PARS = [STAR,
                '--outReadsUnmapped', 'Fastx',
                '--readFilesCommand', 'zcat']
 
-CURR_MIN_VER = datetime.datetime(2017, 3, 1, tzinfo=datetime.timezone.utc)
+CURR_MIN_VER = ut_sample.CURR_MIN_VER
+
+# resources for each stage, as (most, least) that the stage can run with.
+# STAR's memory is on top of the genome, which is shared by all the runs
+STAR_MEMORY = 8 * 1024 ** 3
+SORT_THREADS = (4, 1)
+SORT_MEMORY = (12 * 1024 ** 3, 1024 ** 3)
+INDEX_THREADS = (4, 1)
+INDEX_MEMORY = 512 * 1024 ** 2
+HTSEQ_MEMORY = 2 * 1024 ** 3
+COUNT_THREADS = (4, 1)
+COUNT_MEMORY = (8 * 1024 ** 3, 2 * 1024 ** 3)
+CRAM_THREADS = (4, 1)
+CRAM_MEMORY = 1024 ** 3
+
+# a sample's peak disk use as a multiple of its fastq.gz size: the fastqs
+# plus the unsorted and sorted BAMs and the sort's temporary files, or
+# without the unsorted BAM when streaming. DiskMonitor logs the real peak
+FOOTPRINT_RATIO = {'standard': 4.0, 'streaming': 3.0}
+
+# attempts at uploading a sample's results before giving up on it
+UPLOAD_RETRY = 3
+
+# describes where each sample's results went, uploaded as
+# [sample].[taxon].results.json once everything else is there
+RESULT_MANIFEST_SUFFIX = '.results.json'
 
 
 def get_default_requirements():
@@ -53,7 +85,10 @@ def get_parser():
             formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
 
-    parser.add_argument('--taxon', choices=('homo', 'mus'))
+    parser.add_argument('--taxon', choices=('homo', 'mus'), nargs='+',
+                        required=True,
+                        help='One or more taxa. Each sample is downloaded'
+                             ' once and aligned to each genome in turn')
 
     parser.add_argument('--s3_input_path', default='s3://czbiohub-seqbot/fastqs',
                         help='Location of input folders')
@@ -69,142 +104,998 @@ def get_parser():
                         help='Number of processes to give to each STAR run')
     parser.add_argument('--htseq_proc', type=int, default=4,
                         help='Number of htseq processes to run')
-
+    parser.add_argument('--cpus', type=int, default=None,
+                        help='CPUs to share between the stages, default from'
+                             ' the cgroup limits or the job requirements')
+    parser.add_argument('--memory', type=int, default=None,
+                        help='GB of memory to share between the stages, default'
+                             ' from the cgroup limits or the job requirements')
+    parser.add_argument('--upload_proc', type=int, default=2,
+                        help='Number of processes uploading results, each'
+                             ' sending one sample\'s files concurrently')
+    parser.add_argument('--archive_format', choices=ut_archive.ARCHIVE_FORMATS,
+                        default='gzip',
+                        help='Compression for the results archive, which is'
+                             ' streamed to S3 while it is compressed')
+    parser.add_argument('--indexed_archive', action='store_true',
+                        help='Compress each file in the results archive'
+                             ' separately and save an index next to it, so'
+                             ' single files can be read with a ranged GET.'
+                             ' Requires gzip')
+    parser.add_argument('--download_proc', type=int, default=2,
+                        help='Number of processes downloading fastqs ahead of STAR')
+    parser.add_argument('--download_budget', type=int, default=100,
+                        help='GB of fastqs that can be downloaded ahead of STAR')
+    parser.add_argument('--disk_reserve', type=int, default=10,
+                        help='GB to keep free on the run volume. Samples are'
+                             ' only started when their estimated peak disk'
+                             ' use fits in the rest')
+    parser.add_argument('--worker_retries', type=int, default=1,
+                        help='Times to retry a sample whose STAR or count'
+                             ' worker dies (e.g. out of memory) before giving'
+                             ' up on it. The worker is always replaced')
+    parser.add_argument('--checkpoint_path', default=None,
+                        help='S3 path to save each sample\'s finished stages'
+                             ' to, so that a restarted job (on any instance)'
+                             ' carries on from them instead of re-running'
+                             ' STAR. Stages are always recorded locally')
+
+    parser.add_argument('--output_format', choices=('bam', 'cram'),
+                        default='bam',
+                        help='Upload the aligned reads as BAM, or as CRAM'
+                             ' compressed against the reference FASTA')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Pipe STAR straight into samtools sort and count'
+                             ' the coordinate-sorted BAM, skipping the unsorted'
+                             ' and name-sorted BAMs')
+    parser.add_argument('--count_engine',
+                        choices=('htseq-count', 'htseq-regions', 'builtin'),
+                        default='htseq-count',
+                        help='Count genes with htseq-count, with htseq-count'
+                             ' on groups of chromosomes in parallel (needs'
+                             ' samtools 1.12+), or in-process from the'
+                             ' coordinate-sorted BAM with a cached GTF index')
     parser.add_argument('--force_realign', action='store_true',
                         help='Align files even when results already exist')
+    parser.add_argument('--manifest', default=None,
+                        help='Manifest from aws_star listing the fastqs and'
+                             ' existing results, instead of listing S3')
+    parser.add_argument('--partition_plan', default=None,
+                        help='Plan from aws_star listing the samples in each partition')
+    parser.add_argument('--work_queue', default=None,
+                        help='Claim samples from a shared work queue at this'
+                             ' S3 or local path, instead of a fixed partition')
+    parser.add_argument('--lease_minutes', type=int, default=60,
+                        help='How long a work queue claim lasts without renewal')
+    parser.add_argument('--reference_cache', default=ut_ref.CACHE_DIR,
+                        help='Host-level cache directory for reference data')
+    parser.add_argument('--reference_cache_size', type=int, default=100,
+                        help='Size limit for the reference cache, in GB')
+    parser.add_argument('--no_reference_cache', action='store_true',
+                        help='Download reference data for this job only')
+    parser.add_argument('--listing_cache', nargs='?', default=None,
+                        const=s3u.DEFAULT_CACHE_PATH,
+                        help='Keep an on-disk cache of S3 listings, at the'
+                             ' given path or $LISTING_CACHE_PATH. Expired'
+                             ' listings are refreshed incrementally')
 
     return parser
 
 
-def run_sample(star_queue, htseq_queue, log_queue,
-               s3_input_bucket, genome_dir, run_dir, n_proc):
-
-    s3c = boto3.client('s3')
-
-    for input_dir, sample_name, sample_fns in iter(star_queue.get, 'STOP'):
-        log_queue.put(('{} - {}'.format(input_dir, sample_name), logging.INFO))
-        dest_dir = os.path.join(run_dir, input_dir, sample_name)
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
-            os.mkdir(os.path.join(dest_dir, 'rawdata'))
-            os.mkdir(os.path.join(dest_dir, 'results'))
-            os.mkdir(os.path.join(dest_dir, 'results', 'Pass1'))
+def finish_sample(work_queue, input_dir, sample_name, failed=False):
+    """Mark a sample finished in the work queue, if there is one"""
+    if work_queue is not None:
+        work_queue.complete('{}/{}'.format(input_dir, sample_name),
+                            failed=failed)
+
+
+def clean_up(log_queue, dest_dir, disk_space, footprint):
+    """Remove a sample's local files and give back its disk space"""
+    command = ['rm', '-rf', dest_dir]
+    ut_log.log_command_to_queue(log_queue, command, shell=True)
+    disk_space.release(footprint)
+
+
+def finish_taxon(log_queue, input_dir, sample_name, dest_dir, taxon,
+                 disk_space, footprint, tracker, checkpoints, work_queue,
+                 failed=False):
+    """
+    Clean up after one taxon of a sample. Whoever finishes the last taxon
+    removes what's left of the sample and marks it finished.
+    """
+    checkpoints.finish(input_dir, sample_name, taxon, failed=failed)
+    clean_up(log_queue, os.path.join(dest_dir, taxon), disk_space, footprint)
+
+    sample_failed = tracker.finish('{}/{}'.format(input_dir, sample_name),
+                                   failed=failed)
+    if sample_failed is not None:
+        clean_up(log_queue, dest_dir, disk_space, 0)
+        finish_sample(work_queue, input_dir, sample_name, failed=sample_failed)
+
+
+def abandon_alignment(item, log_queue, disk_budget, disk_space, tracker,
+                      checkpoints, work_queue):
+    """Clean up what's left of a sample that STAR couldn't finish"""
+    input_dir, sample_name, dest_dir, reads, n_bytes, footprint, taxa = item
+    disk_budget.release(n_bytes)
+
+    shares = [footprint // len(taxa)] * len(taxa)
+    shares[0] += footprint % len(taxa)
+
+    for taxon, share in zip(taxa, shares):
+        finish_taxon(log_queue, input_dir, sample_name, dest_dir, taxon,
+                     disk_space, share, tracker, checkpoints, work_queue,
+                     failed=True)
+
+
+def abandon_count(item, log_queue, disk_space, tracker, checkpoints,
+                  work_queue):
+    """Clean up a taxon that couldn't be counted"""
+    input_dir, sample_name, dest_dir, taxon, order, footprint = item
+    finish_taxon(log_queue, input_dir, sample_name, dest_dir, taxon,
+                 disk_space, footprint, tracker, checkpoints, work_queue,
+                 failed=True)
+
+
+def checkpoint(checkpoints, log_queue, input_dir, sample_name, taxon, stage,
+               files=None):
+    """Mark a stage finished, and log if its files couldn't be saved to S3"""
+    if not checkpoints.mark(input_dir, sample_name, taxon, stage, files):
+        log_queue.put(('{} - {}: couldn\'t save the {} checkpoint to S3'.format(
+                input_dir, sample_name, stage), logging.INFO))
+
+
+def renew_leases(work_queue, held, held_lock, stop_event, logger):
+    """Keep renewing leases until the samples are finished (or lost)"""
+    while not stop_event.wait(work_queue.lease_seconds / 3):
+        with held_lock:
+            items = list(held)
+
+        for item in items:
+            try:
+                renewed = work_queue.renew(item)
+            except Exception as exc:
+                # there's time for a few more tries before the lease runs out
+                logger.info("Couldn't renew the lease on {}: {}".format(
+                        item, exc))
+                continue
 
-        for sample_fn in sample_fns:
-            s3c.download_file(
-                Bucket=s3_input_bucket, Key=sample_fn,
-                Filename=os.path.join(dest_dir, os.path.basename(sample_fn))
-            )
+            if not renewed:
+                with held_lock:
+                    held.discard(item)
+
+
+def claim_samples(work_queue, samples, download_queue,
+                  partition_id, num_partitions, logger):
+    """
+    Claim samples from the work queue and feed them to the pipeline. Puts
+    block while the pipeline is full, so this only claims work as we have
+    room for it and the rest stays available to other jobs.
+
+    Samples that other jobs hold are tried again, less often the longer
+    nothing turns up, so the leases of jobs that die are picked up. This
+    returns once every sample is done or failed, including the ones we
+    claimed, so it also waits for our pipeline to drain.
+
+    Returns an Event and the thread renewing our leases, which should run
+    until the pipeline has finished.
+    """
+    held = set()
+    held_lock = threading.Lock()
+    stop_renewing = threading.Event()
+
+    renew_thread = threading.Thread(
+            target=renew_leases,
+            args=(work_queue, held, held_lock, stop_renewing, logger),
+            daemon=True
+    )
+    renew_thread.start()
+
+    # each job starts at a different point in the list to avoid contention
+    offset = len(samples) * partition_id // max(num_partitions, 1)
+    samples = samples[offset:] + samples[:offset]
+    items = ['{}/{}'.format(*sample[:2]) for sample in samples]
+
+    def is_finished(item):
+        try:
+            return work_queue.is_finished(item)
+        except Exception as exc:
+            logger.info("Couldn't check on {}: {}".format(item, exc))
+            return False
+
+    # a lease that has just expired is picked up within max_delay seconds
+    min_delay = work_queue.lease_seconds / 30
+    max_delay = work_queue.lease_seconds / 3
+    delay = min_delay
+    next_pass = time.time()
+
+    claimed = set()
+    finished = set()
+
+    while True:
+        # our own samples finish as the pipeline gets through them
+        finished.update(item for item in claimed - finished
+                        if is_finished(item))
+        if len(finished) == len(items):
+            break
+
+        if time.time() >= next_pass:
+            n_claimed = len(claimed)
+
+            for sample, item in zip(samples, items):
+                if item in claimed or item in finished:
+                    continue
+
+                if is_finished(item):
+                    finished.add(item)
+                    continue
+
+                try:
+                    if not work_queue.claim(item):
+                        continue
+                except Exception as exc:
+                    logger.info("Couldn't claim {}: {}".format(item, exc))
+                    continue
+
+                claimed.add(item)
+                with held_lock:
+                    held.add(item)
+
+                logger.info("Claimed sample {}, adding to queue".format(item))
+                download_queue.put(sample)
+
+            if len(claimed) > n_claimed:
+                delay = min_delay
+            else:
+                delay = min(2 * delay, max_delay)
+            next_pass = time.time() + delay
+
+        time.sleep(max(min(min_delay, next_pass - time.time()), 0))
+
+    logger.info("Claimed {} of {} samples".format(len(claimed), len(samples)))
+
+    return stop_renewing, renew_thread
+
+
+def stage_genome(taxon, root_dir, ref_cache, logger):
+    """
+    Get the reference data and STAR index for taxon, from the reference
+    cache if there is one. Returns a dict of the paths the pipeline uses.
+    """
+    if taxon == 'homo':
+        genome_name = 'HG38-PLUS'
+        ref_name = 'hg38-plus'
+    elif taxon == 'mus':
+        genome_name = 'MM10-PLUS'
+        ref_name = 'mm10-plus'
+    else:
+        raise ValueError('Invalid taxon {}'.format(taxon))
 
-        # start running STAR
-        # getting input files first
+    ref_genome_file = '{}.tgz'.format(ref_name)
+    ref_genome_star_file = 'STAR/{}.tgz'.format(genome_name)
 
-        reads = sorted(os.path.join(dest_dir, os.path.basename(sample_fn))
-                       for sample_fn in sample_fns)
+    if ref_cache is None:
+        genome_base_dir = os.path.join(root_dir, 'genome')
+        star_base_dir = os.path.join(root_dir, 'genome', 'STAR')
 
-        command = COMMON_PARS[:]
-        command.extend(('--runThreadN', str(n_proc),
-                        '--genomeDir', genome_dir,
-                        '--readFilesIn', ' '.join(reads)))
-        failed = ut_log.log_command_to_queue(
-            log_queue, command, shell=True, cwd=os.path.join(dest_dir, 'results', 'Pass1')
-        )
+        # download the genome data
+        logger.info('Downloading and extracting genome data {}'.format(ref_genome_file))
+        ut_ref.stage_reference('czbiohub-reference', ref_genome_file,
+                               genome_base_dir, logger)
 
-        # running sam tools
-        command = [SAMTOOLS, 'sort', '-m', '6000000000', '-o',
-                   './Pass1/Aligned.out.sorted.bam', './Pass1/Aligned.out.bam']
-        failed = failed or ut_log.log_command_to_queue(
-            log_queue, command, shell=True, cwd=os.path.join(dest_dir, 'results')
-        )
+        # download STAR stuff
+        logger.info('Downloading and extracting STAR data {}'.format(ref_genome_star_file))
+        ut_ref.stage_reference('czbiohub-reference', ref_genome_star_file,
+                               star_base_dir, logger)
+    else:
+        # shared with other jobs on this host, and only downloaded once
+        genome_base_dir = ref_cache.acquire('czbiohub-reference',
+                                            ref_genome_file, logger)
+        star_base_dir = ref_cache.acquire('czbiohub-reference',
+                                          ref_genome_star_file, logger)
+
+    return {'ref_name': ref_name,
+            'ref_genome_file': ref_genome_file,
+            'ref_genome_star_file': ref_genome_star_file,
+            'genome_base_dir': genome_base_dir,
+            'star_base_dir': star_base_dir,
+            'genome_dir': os.path.join(star_base_dir, genome_name, ''),
+            'sjdb_gtf': os.path.join(genome_base_dir, ref_name,
+                                     '{}.gtf'.format(ref_name))}
+
+
+def get_grant(budget, log_queue, stage, sample_name, *request):
+    """Wait for resources for a stage, and log what it was given"""
+    grant = budget.acquire(*request)
+    log_queue.put(('{} - {}: {} CPUs, {:.1f} GB after waiting {:.1f}s'.format(
+            sample_name, stage, grant.cpus, grant.memory / 1024 ** 3,
+            grant.waited), logging.INFO))
+    return grant
+
+
+def sort_command(cpus, memory, *args):
+    """samtools sort with cpus threads sharing memory bytes"""
+    return [SAMTOOLS, 'sort',
+            '-@', str(cpus),
+            '-m', str(memory // cpus)] + list(args)
+
+
+def download_samples(download_queue, star_queue, log_queue,
+                     s3_input_bucket, run_dir, disk_budget, disk_space,
+                     footprint_ratio, tracker, checkpoints, work_queue):
+    total_stall = 0.0
+
+    with s3u.TransferSession(n_threads=8) as session:
+        for input_dir, sample_name, sample_fns, n_bytes, taxa in iter(download_queue.get, 'STOP'):
+            # wait until there's room on disk for everything this sample
+            # will write, and until STAR has caught up with the downloads.
+            # The fastqs are shared, and each taxon adds its own BAMs
+            footprint = int(n_bytes * (1 + (footprint_ratio - 1) * len(taxa)))
+            stall = disk_space.acquire(footprint)
+            stall += disk_budget.acquire(n_bytes)
+            total_stall += stall
+
+            dest_dir = os.path.join(run_dir, input_dir, sample_name)
+            if not os.path.exists(dest_dir):
+                os.makedirs(dest_dir)
+                os.mkdir(os.path.join(dest_dir, 'rawdata'))
+
+            reads = [os.path.join(dest_dir, os.path.basename(sample_fn))
+                     for sample_fn in sample_fns]
+
+            start_time = time.time()
+
+            # pick up whatever an earlier job saved of this sample. If that
+            # fails, the missing stages are just run again
+            for taxon in taxa:
+                if not checkpoints.restore(input_dir, sample_name, taxon):
+                    log_queue.put(('Failed to restore {} - {} ({}) from its'
+                                   ' checkpoint'.format(input_dir, sample_name,
+                                                        taxon), logging.INFO))
+
+            failed = []
+            if all(checkpoints.done(input_dir, sample_name, taxon, 'align')
+                   for taxon in taxa):
+                # STAR won't need the fastqs
+                log_queue.put(('{} - {}: already aligned, not downloading'.format(
+                        input_dir, sample_name), logging.INFO))
+                reads = []
+            elif (checkpoints.done(input_dir, sample_name, None, 'download')
+                  and all(os.path.exists(fn) for fn in reads)):
+                log_queue.put(('{} - {}: already downloaded'.format(
+                        input_dir, sample_name), logging.INFO))
+            else:
+                failed = [r for r in session.download(zip(sample_fns, reads),
+                                                      s3_input_bucket)
+                          if not r.success]
+                if not failed:
+                    checkpoints.mark(input_dir, sample_name, None, 'download')
+
+            if failed:
+                log_queue.put(('Failed to download {} - {}: {}'.format(
+                        input_dir, sample_name, failed[0].error), logging.INFO))
+                clean_up(log_queue, dest_dir, disk_space, footprint)
+                disk_budget.release(n_bytes)
+                finish_sample(work_queue, input_dir, sample_name, failed=True)
+                continue
 
-        # running samtools index -b
-        command = [SAMTOOLS, 'index', '-b', 'Aligned.out.sorted.bam']
-        failed = failed or ut_log.log_command_to_queue(
-            log_queue, command, shell=True, cwd=os.path.join(dest_dir, 'results', 'Pass1')
+            tracker.start('{}/{}'.format(input_dir, sample_name), len(taxa))
+            star_queue.put((input_dir, sample_name, dest_dir, sorted(reads),
+                            n_bytes, footprint, taxa))
+
+            log_queue.put((
+                'Downloaded {} - {}: {:.1f} MB in {:.1f}s, waited {:.1f}s for'
+                ' disk space, {} samples queued for STAR'.format(
+                        input_dir, sample_name, n_bytes / 1e6,
+                        time.time() - start_time, stall, star_queue.qsize()),
+                logging.INFO
+            ))
+
+    log_queue.put(('Download worker finished, waited {:.1f}s for disk space'.format(
+            total_stall), logging.INFO))
+
+
+def run_sample(star_queue, htseq_queue, log_queue, genomes, n_proc,
+               disk_budget, disk_space, budget, streaming, name_sort, tracker,
+               checkpoints, work_queue):
+
+    total_idle = 0.0
+
+    while True:
+        # time spent here means STAR is waiting on the downloads
+        start_time = time.time()
+        item = star_queue.get()
+        idle = time.time() - start_time
+        total_idle += idle
+
+        if item == 'STOP':
+            break
+
+        input_dir, sample_name, dest_dir, reads, n_bytes, footprint, taxa = item
+        log_queue.put(('{} - {} (waited {:.1f}s for input)'.format(
+                input_dir, sample_name, idle), logging.INFO))
+
+        # the fastqs are aligned to each genome in turn, and each taxon's
+        # results go on (and get their share of the disk space) separately
+        shares = [footprint // len(taxa)] * len(taxa)
+        shares[0] += footprint % len(taxa)
+
+        for i, (taxon, share) in enumerate(zip(taxa, shares)):
+            taxon_dir = os.path.join(dest_dir, taxon)
+            os.makedirs(os.path.join(taxon_dir, 'results', 'Pass1'),
+                        exist_ok=True)
+
+            start_time = time.time()
+            disk_monitor = ut_pipe.DiskMonitor(dest_dir)
+
+            # a restarted job carries on after the last finished stage
+            done = {stage for stage in ut_ckpt.TAXON_STAGES
+                    if checkpoints.done(input_dir, sample_name, taxon, stage)}
+            if done:
+                log_queue.put(('{} - {} ({}): resuming after {}'.format(
+                        input_dir, sample_name, taxon,
+                        ', '.join(sorted(done))), logging.INFO))
+
+            command = COMMON_PARS[:]
+            command.extend(('--genomeDir', genomes[taxon]['genome_dir'],
+                            '--readFilesIn', ' '.join(reads)))
+
+            # stages finish in order, so a later stage implies the earlier ones
+            failed = False
+            if streaming and 'sort' not in done:
+                # STAR and the sort run at the same time, with one grant
+                grant = get_grant(budget, log_queue, 'STAR | sort', sample_name,
+                                  n_proc + SORT_THREADS[0],
+                                  STAR_MEMORY + SORT_MEMORY[0],
+                                  n_proc + SORT_THREADS[1],
+                                  STAR_MEMORY + SORT_MEMORY[1])
+                sort_cpus = max(grant.cpus - n_proc, 1)
+
+                # pipe the unsorted BAM straight into the sort
+                command.extend(('--runThreadN', str(grant.cpus - sort_cpus),
+                                '--outStd', 'BAM_Unsorted', '|'))
+                command.extend(sort_command(sort_cpus, grant.memory - STAR_MEMORY,
+                                            '-o', 'Aligned.out.sorted.bam', '-'))
+                failed = ut_log.log_command_to_queue(
+                    log_queue, ['set -o pipefail;'] + command,
+                    shell=True, executable='/bin/bash',
+                    cwd=os.path.join(taxon_dir, 'results', 'Pass1')
+                )
+                budget.release(grant)
+
+                if not failed:
+                    checkpoints.mark(input_dir, sample_name, taxon, 'align')
+                    checkpoints.mark(input_dir, sample_name, taxon, 'sort')
+            elif 'sort' not in done:
+                # start running STAR
+                if 'align' not in done:
+                    grant = get_grant(budget, log_queue, 'STAR', sample_name,
+                                      n_proc, STAR_MEMORY)
+                    command.extend(('--runThreadN', str(grant.cpus)))
+                    failed = ut_log.log_command_to_queue(
+                        log_queue, command, shell=True, cwd=os.path.join(taxon_dir, 'results', 'Pass1')
+                    )
+                    budget.release(grant)
+
+                    if not failed:
+                        checkpoints.mark(input_dir, sample_name, taxon, 'align')
+
+                # running sam tools
+                if not failed:
+                    grant = get_grant(budget, log_queue, 'sort', sample_name,
+                                      SORT_THREADS[0], SORT_MEMORY[0],
+                                      SORT_THREADS[1], SORT_MEMORY[1])
+                    command = sort_command(grant.cpus, grant.memory,
+                                           '-o', './Pass1/Aligned.out.sorted.bam',
+                                           './Pass1/Aligned.out.bam')
+                    failed = ut_log.log_command_to_queue(
+                        log_queue, command, shell=True, cwd=os.path.join(taxon_dir, 'results')
+                    )
+                    budget.release(grant)
+
+                    if not failed:
+                        checkpoints.mark(input_dir, sample_name, taxon, 'sort')
+
+            # running samtools index -b
+            if not failed and 'index' not in done:
+                grant = get_grant(budget, log_queue, 'index', sample_name,
+                                  INDEX_THREADS[0], INDEX_MEMORY,
+                                  INDEX_THREADS[1], INDEX_MEMORY)
+                command = [SAMTOOLS, 'index', '-@', str(grant.cpus),
+                           '-b', 'Aligned.out.sorted.bam']
+                failed = ut_log.log_command_to_queue(
+                    log_queue, command, shell=True, cwd=os.path.join(taxon_dir, 'results', 'Pass1')
+                )
+                budget.release(grant)
+
+                # remove unsorted bam files
+                unsorted_bam = os.path.join(taxon_dir, 'results', 'Pass1',
+                                            'Aligned.out.bam')
+                if not failed and os.path.exists(unsorted_bam):
+                    os.remove(unsorted_bam)
+
+                # the count stage saves the files to S3 while it counts, so
+                # STAR can get on with the next sample
+                if not failed:
+                    checkpoints.mark(input_dir, sample_name, taxon, 'index')
+
+            # remove fastq files once the last genome is done with them
+            if taxon == taxa[-1]:
+                for fastq_file in reads:
+                    if os.path.exists(fastq_file):
+                        os.remove(fastq_file)
+                disk_budget.release(n_bytes)
+
+            # generating files for htseq-count -r name, if we're using it
+            if not failed and name_sort and 'count' not in done:
+                grant = get_grant(budget, log_queue, 'name sort', sample_name,
+                                  SORT_THREADS[0], SORT_MEMORY[0],
+                                  SORT_THREADS[1], SORT_MEMORY[1])
+                command = sort_command(grant.cpus, grant.memory, '-n',
+                                       '-o', './Pass1/Aligned.out.sorted-byname.bam',
+                                       './Pass1/Aligned.out.sorted.bam')
+                failed = ut_log.log_command_to_queue(
+                    log_queue, command, shell=True, cwd=os.path.join(taxon_dir, 'results')
+                )
+                budget.release(grant)
+
+            peak_disk = disk_monitor.stop()
+            log_queue.put((
+                '{} - {}: aligned to {} in {:.1f}s ({} mode), peak disk {:.2f} GB'
+                ' (estimated {:.2f} GB)'.format(
+                        input_dir, sample_name, taxon, time.time() - start_time,
+                        'streaming' if streaming else 'standard', peak_disk / 1e9,
+                        footprint / 1e9),
+                logging.INFO
+            ))
+
+            # if this worker dies, its replacement only retries the rest.
+            # This goes first, so a taxon can't be passed on twice
+            if taxon != taxa[-1]:
+                star_queue.update((input_dir, sample_name, dest_dir, reads,
+                                   n_bytes, sum(shares[i + 1:]), taxa[i + 1:]))
+            else:
+                star_queue.update(None)
+
+            # ready to be htseq-ed and cleaned up
+            if not failed:
+                htseq_queue.put((input_dir, sample_name, dest_dir, taxon,
+                                 'name' if name_sort else 'pos', share))
+            else:
+                finish_taxon(log_queue, input_dir, sample_name, dest_dir,
+                             taxon, disk_space, share, tracker, checkpoints,
+                             work_queue, failed=True)
+
+    log_queue.put(('STAR worker finished, waited {:.1f}s for input'.format(
+            total_idle), logging.INFO))
+
+
+def convert_to_cram(budget, log_queue, sample_name, bam_dir, fasta):
+    """
+    Replace Aligned.out.sorted.bam and its index in bam_dir with a CRAM
+    compressed against fasta, and its index. Returns the sizes of each and
+    the seconds taken, or None if the conversion failed.
+    """
+    bam_file = os.path.join(bam_dir, 'Aligned.out.sorted.bam')
+    cram_file = os.path.join(bam_dir, 'Aligned.out.sorted.cram')
+
+    start_time = time.time()
+
+    grant = get_grant(budget, log_queue, 'cram', sample_name,
+                      CRAM_THREADS[0], CRAM_MEMORY,
+                      CRAM_THREADS[1], CRAM_MEMORY)
+    command = [SAMTOOLS, 'view', '-C', '-T', fasta, '-@', str(grant.cpus),
+               '-o', cram_file, bam_file]
+    failed = ut_log.log_command_to_queue(log_queue, command, shell=True)
+    if not failed:
+        command = [SAMTOOLS, 'index', '-@', str(grant.cpus), cram_file]
+        failed = ut_log.log_command_to_queue(log_queue, command, shell=True)
+    budget.release(grant)
+
+    if failed:
+        return None
+
+    stats = {
+        'bam_bytes': (os.path.getsize(bam_file)
+                      + os.path.getsize(bam_file + '.bai')),
+        'cram_bytes': (os.path.getsize(cram_file)
+                       + os.path.getsize(cram_file + '.crai')),
+        'seconds': time.time() - start_time
+    }
+
+    os.remove(bam_file)
+    os.remove(bam_file + '.bai')
+
+    return stats
+
+
+def count_regions(budget, log_queue, sample_name, results_dir, sjdb_gtf):
+    """
+    Run htseq-count on the coordinate-sorted BAM in results_dir/Pass1 with a
+    process per group of references, and add the tables up into
+    htseq-count.txt. Pairs with mates on different references are counted
+    in one more process, so the total is the same as counting the whole
+    file at once. Returns True if it failed.
+    """
+    bam_file = os.path.join(results_dir, 'Pass1', 'Aligned.out.sorted.bam')
+
+    # reads on each reference, and the unplaced ones as '*'
+    try:
+        idxstats = subprocess.check_output([SAMTOOLS, 'idxstats', bam_file],
+                                           universal_newlines=True)
+    except subprocess.CalledProcessError:
+        log_queue.put(('Couldn\'t read the index of {}'.format(bam_file),
+                       logging.INFO))
+        return True
+
+    contig_reads = [(fields[0], int(fields[2]) + int(fields[3]))
+                    for fields in (line.split('\t')
+                                   for line in idxstats.splitlines())]
+
+    grant = get_grant(budget, log_queue, 'htseq', sample_name,
+                      COUNT_THREADS[0], COUNT_THREADS[0] * HTSEQ_MEMORY,
+                      COUNT_THREADS[1], HTSEQ_MEMORY)
+    n_jobs = max(min(grant.cpus, grant.memory // HTSEQ_MEMORY), 1)
+    groups = ut_count.group_contigs(contig_reads, max(n_jobs - 1, 1))
+
+    # names with a colon would be read as a range
+    regions = [[shlex.quote('{{{}}}'.format(contig) if ':' in contig
+                            else contig) for contig in group]
+               for group in groups]
+
+    htseq = [HTSEQ, '-r', 'pos', '-s', 'no', '-f', 'sam',
+             '-m', 'intersection-nonempty', '-', sjdb_gtf]
+
+    # a pair stays with its reference when both mates are on it, and the
+    # pairs split between references are all read in one pass
+    jobs = [(['-e', "'flag.paired && refid != mrefid'", bam_file],
+             'htseq-count.pairs.txt')]
+    jobs.extend((['-e', "'!flag.paired || refid == mrefid'", bam_file]
+                 + group_regions, 'htseq-count.{}.txt'.format(i))
+                for i, group_regions in enumerate(regions))
+
+    def count_job(view_args, out_file):
+        command = (['set -o pipefail;', SAMTOOLS, 'view', '-h'] + view_args
+                   + ['|'] + htseq + ['>', out_file])
+        return ut_log.log_command_to_queue(log_queue, command, shell=True,
+                                           executable='/bin/bash',
+                                           cwd=results_dir)
+
+    with cf.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        failed = any(executor.map(lambda job: count_job(*job), jobs))
+    budget.release(grant)
+
+    tables = [os.path.join(results_dir, out_file) for _, out_file in jobs]
+    if not failed:
+        ut_count.merge_counts(tables, os.path.join(results_dir,
+                                                   'htseq-count.txt'))
+
+    for table in tables:
+        if os.path.exists(table):
+            os.remove(table)
+
+    return failed
+
+
+def result_manifest(input_dir, sample_name, taxon, bucket, results_dir,
+                    file_pairs, archive_key, archive_format, indexed,
+                    output_format, reference):
+    """
+    Describes where everything in a sample's results dir ended up: each file
+    that is uploaded on its own, by its path under results/, and the
+    archive holding everything else, with the names of its members. For
+    CRAM output, reference has the name and MD5 of the FASTA needed to
+    decode it.
+    """
+    s3_path = 's3://{}/{}'.format
+
+    archive = {
+        'path': s3_path(bucket, archive_key),
+        'format': archive_format,
+        'index': (s3_path(bucket, archive_key + s3u.ARCHIVE_INDEX_SUFFIX)
+                  if indexed else None),
+        'members': ut_archive.archive_members(
+                results_dir, exclude=[src for src, key in file_pairs]
         )
+    }
+
+    return {'input_dir': input_dir,
+            'sample_name': sample_name,
+            'taxon': taxon,
+            'output_format': output_format,
+            'reference': reference,
+            'files': {os.path.relpath(src, results_dir): s3_path(bucket, key)
+                      for src, key in file_pairs},
+            'archive': archive}
+
+
+def run_htseq(htseq_queue, upload_queue, log_queue, s3_input_path, s3_output_path,
+              genomes, budget, count_engine, archive_format, indexed,
+              output_format, disk_space, tracker, checkpoints, work_queue):
+    cram_totals = {'samples': 0, 'bam_bytes': 0, 'cram_bytes': 0, 'seconds': 0.0}
+    checkpoint_executor = cf.ThreadPoolExecutor(max_workers=1)
+
+    for input_dir, sample_name, dest_dir, taxon, order, footprint in iter(htseq_queue.get, 'STOP'):
+        taxon_dir = os.path.join(dest_dir, taxon)
+        sjdb_gtf = genomes[taxon]['sjdb_gtf']
+
+        if order == 'name':
+            bam_file = 'Aligned.out.sorted-byname.bam'
+        else:
+            bam_file = 'Aligned.out.sorted.bam'
 
-        # remove unsorted bam files
-        if not failed:
-            os.remove(os.path.join(dest_dir, 'results', 'Pass1', 'Aligned.out.bam'))
-
-        # remove fastq files
-        for fastq_file in reads:
-            os.remove(fastq_file)
+        start_time = time.time()
 
-        # generating files for htseq-count
-        command = [SAMTOOLS, 'sort', '-m', '6000000000', '-n', '-o',
-                   './Pass1/Aligned.out.sorted-byname.bam',
-                   './Pass1/Aligned.out.sorted.bam']
-        failed = failed or ut_log.log_command_to_queue(
-            log_queue, command, shell=True, cwd=os.path.join(dest_dir, 'results')
-        )
+        # a restarted job may have counted (and converted) this already
+        resumed = checkpoints.done(input_dir, sample_name, taxon, 'count')
 
-        # ready to be htseq-ed and cleaned up
-        if not failed:
-            htseq_queue.put((input_dir, sample_name, dest_dir))
+        # everything STAR made is saved with the index checkpoint while we
+        # count. It has to be there before anything is removed or converted
+        if resumed or checkpoints.saved(input_dir, sample_name, taxon, 'index'):
+            saving = None
+        else:
+            star_files = [
+                os.path.join(dir_path, fn) for dir_path, _, fns
+                in os.walk(os.path.join(taxon_dir, 'results')) for fn in fns
+                if fn != 'Aligned.out.sorted-byname.bam'
+            ]
+            saving = checkpoint_executor.submit(
+                    checkpoint, checkpoints, log_queue, input_dir,
+                    sample_name, taxon, 'index', star_files
+            )
 
+        if resumed:
+            log_queue.put(('{} - {} ({}): already counted'.format(
+                    input_dir, sample_name, taxon), logging.INFO))
+            failed = False
+        elif count_engine == 'builtin':
+            grant = get_grant(budget, log_queue, 'count', sample_name,
+                              COUNT_THREADS[0], COUNT_MEMORY[0],
+                              COUNT_THREADS[1], COUNT_MEMORY[1])
+            try:
+                genes, counts = ut_count.count_reads(
+                        os.path.join(taxon_dir, 'results', 'Pass1', bam_file),
+                        sjdb_gtf, n_proc=grant.cpus
+                )
+                ut_count.write_counts(
+                        os.path.join(taxon_dir, 'results', 'htseq-count.txt'),
+                        genes, counts
+                )
+                failed = False
+            except Exception as exc:
+                log_queue.put(('Counting failed for {} - {}: {}'.format(
+                        input_dir, sample_name, exc), logging.INFO))
+                failed = True
+            budget.release(grant)
+        elif count_engine == 'htseq-regions':
+            failed = count_regions(budget, log_queue, sample_name,
+                                   os.path.join(taxon_dir, 'results'), sjdb_gtf)
+        else:
+            # running htseq
+            grant = get_grant(budget, log_queue, 'htseq', sample_name,
+                              1, HTSEQ_MEMORY)
+            command = [HTSEQ,
+                       '-r', order, '-s', 'no', '-f', 'bam',
+                       '-m', 'intersection-nonempty',
+                       os.path.join(taxon_dir, 'results', 'Pass1', bam_file),
+                       sjdb_gtf, '>', 'htseq-count.txt']
+            failed = ut_log.log_command_to_queue(
+                log_queue, command, shell=True, cwd=os.path.join(taxon_dir, 'results')
+            )
+            budget.release(grant)
 
-def run_htseq(htseq_queue, log_queue, s3_input_path, s3_output_path, taxon, sjdb_gtf):
-    s3c = boto3.client('s3')
+        if saving is not None:
+            saving.result()
 
-    for input_dir, sample_name, dest_dir in iter(htseq_queue.get, 'STOP'):
-        # running htseq
-        command = [HTSEQ,
-                   '-r', 'name', '-s', 'no', '-f', 'bam',
-                   '-m', 'intersection-nonempty',
-                   os.path.join(dest_dir, 'results', 'Pass1',
-                                'Aligned.out.sorted-byname.bam'),
-                   sjdb_gtf, '>', 'htseq-count.txt']
-        failed = ut_log.log_command_to_queue(
-            log_queue, command, shell=True, cwd=os.path.join(dest_dir, 'results')
-        )
         if failed:
-            command = ['rm', '-rf', dest_dir]
-            ut_log.log_command_to_queue(log_queue, command, shell=True)
+            htseq_queue.update(None)
+            finish_taxon(log_queue, input_dir, sample_name, dest_dir, taxon,
+                         disk_space, footprint, tracker, checkpoints,
+                         work_queue, failed=True)
             continue
 
-        os.remove(os.path.join(dest_dir, 'results', 'Pass1',
-                               'Aligned.out.sorted-byname.bam'))
-
-        # compress the results dir and move it to s3
-        command = ['tar', '-cvzf',
-                   '{}.{}.tgz'.format(sample_name, taxon),
-                   'results']
-        ut_log.log_command_to_queue(log_queue, command, shell=True, cwd=dest_dir)
+        if not resumed:
+            log_queue.put(('{} - {}: counted in {:.1f}s ({}, {} order)'.format(
+                    input_dir, sample_name, time.time() - start_time,
+                    count_engine, order), logging.INFO))
+
+        if order == 'name' and not resumed:
+            os.remove(os.path.join(taxon_dir, 'results', 'Pass1', bam_file))
+
+        if output_format == 'cram' and not resumed:
+            stats = convert_to_cram(budget, log_queue, sample_name,
+                                    os.path.join(taxon_dir, 'results', 'Pass1'),
+                                    genomes[taxon]['fasta'])
+            if stats is None:
+                htseq_queue.update(None)
+                finish_taxon(log_queue, input_dir, sample_name, dest_dir,
+                             taxon, disk_space, footprint, tracker,
+                             checkpoints, work_queue, failed=True)
+                continue
 
-        if s3_output_path is None:
-            s3_output_path = os.path.join(s3_input_path, input_dir, 'results')
+            log_queue.put((
+                '{} - {}: BAM {:.1f} MB to CRAM {:.1f} MB ({:.0%}) in {:.1f}s'.format(
+                        input_dir, sample_name, stats['bam_bytes'] / 1e6,
+                        stats['cram_bytes'] / 1e6,
+                        stats['cram_bytes'] / max(stats['bam_bytes'], 1),
+                        stats['seconds']),
+                logging.INFO
+            ))
+
+            cram_totals['samples'] += 1
+            for k in ('bam_bytes', 'cram_bytes', 'seconds'):
+                cram_totals[k] += stats[k]
+
+        if output_format == 'cram':
+            aligned_files = ['Aligned.out.sorted.cram',
+                             'Aligned.out.sorted.cram.crai']
+
+            # a BAM restored from the index checkpoint is already converted
+            for fn in ('Aligned.out.sorted.bam', 'Aligned.out.sorted.bam.bai'):
+                bam_path = os.path.join(taxon_dir, 'results', 'Pass1', fn)
+                if resumed and os.path.exists(bam_path):
+                    os.remove(bam_path)
+        else:
+            aligned_files = ['Aligned.out.sorted.bam',
+                             'Aligned.out.sorted.bam.bai']
+
+        if not resumed:
+            # the BAM is already saved with the index stage, a CRAM isn't
+            count_files = [os.path.join(taxon_dir, 'results', 'htseq-count.txt')]
+            if output_format == 'cram':
+                count_files.extend(os.path.join(taxon_dir, 'results', 'Pass1', fn)
+                                   for fn in aligned_files)
+            checkpoint(checkpoints, log_queue, input_dir, sample_name, taxon,
+                       'count', count_files)
+
+        s3_output_bucket,s3_output_prefix = s3u.s3_bucket_and_key(
+                ut_sample.get_output_path(s3_input_path, input_dir, s3_output_path)
+        )
 
-        s3_output_bucket,s3_output_prefix = s3u.s3_bucket_and_key(s3_output_path)
+        results_dir = os.path.join(taxon_dir, 'results')
 
         src_files = [
-            os.path.join(dest_dir, '{}.{}.tgz'.format(sample_name, taxon)),
-            os.path.join(dest_dir, 'results', 'htseq-count.txt'),
-            os.path.join(dest_dir, 'results', 'Pass1', 'Log.final.out'),
-            os.path.join(dest_dir, 'results', 'Pass1', 'SJ.out.tab'),
-            os.path.join(dest_dir, 'results', 'Pass1',
-                         'Aligned.out.sorted.bam'),
-            os.path.join(dest_dir, 'results', 'Pass1',
-                         'Aligned.out.sorted.bam.bai')
-        ]
+            os.path.join(results_dir, 'htseq-count.txt'),
+            os.path.join(results_dir, 'Pass1', 'Log.final.out'),
+            os.path.join(results_dir, 'Pass1', 'SJ.out.tab')
+        ] + [os.path.join(results_dir, 'Pass1', fn) for fn in aligned_files]
 
         dest_names = [
-            '{}.{}.tgz'.format(sample_name, taxon),
             '{}.{}.htseq-count.txt'.format(sample_name, taxon),
             '{}.{}.log.final.out'.format(sample_name, taxon),
-            '{}.{}.SJ.out.tab'.format(sample_name, taxon),
-            '{}.{}.Aligned.out.sorted.bam'.format(sample_name, taxon),
-            '{}.{}.Aligned.out.sorted.bam.bai'.format(sample_name, taxon)
-        ]
+            '{}.{}.SJ.out.tab'.format(sample_name, taxon)
+        ] + ['{}.{}.{}'.format(sample_name, taxon, fn) for fn in aligned_files]
+
+        file_pairs = [(src_file, os.path.join(s3_output_prefix, dest_name))
+                      for src_file, dest_name in zip(src_files, dest_names)]
+
+        # the rest of the results dir is compressed as it is uploaded,
+        # leaving out the files that go up on their own
+        archive_key = os.path.join(s3_output_prefix, '{}.{}{}'.format(
+                sample_name, taxon, ut_archive.EXTENSIONS[archive_format]))
+        archives = [(results_dir, archive_key, src_files)]
+
+        # outside of the results dir, so it isn't archived
+        manifest_file = os.path.join(taxon_dir, 'results.json')
+        ut_sample.write_json(manifest_file, result_manifest(
+                input_dir, sample_name, taxon, s3_output_bucket, results_dir,
+                file_pairs, archive_key, archive_format, indexed,
+                output_format, genomes[taxon]['reference']
+        ))
+        manifest_key = os.path.join(
+                s3_output_prefix,
+                '{}.{}{}'.format(sample_name, taxon, RESULT_MANIFEST_SUFFIX)
+        )
 
-        for src_file,dest_name in zip(src_files, dest_names):
-            log_queue.put(('Uploading {}'.format(dest_name), logging.INFO))
-            s3c.upload_file(Filename=src_file, Bucket=s3_output_bucket,
-                            Key=os.path.join(s3_output_prefix, dest_name))
+        # if this worker dies after this, the taxon isn't counted (and
+        # uploaded, and finished) a second time
+        htseq_queue.update(None)
+
+        # the upload stage cleans up, so we can move on to the next sample
+        upload_queue.put((input_dir, sample_name, dest_dir, taxon, s3_output_bucket,
+                          footprint, file_pairs, archives,
+                          (manifest_file, manifest_key)))
+        log_queue.put(('{} - {} ({}): queued for upload, {} samples waiting'.format(
+                input_dir, sample_name, taxon, upload_queue.qsize()), logging.INFO))
+
+    if cram_totals['samples']:
+        log_queue.put((
+            'Converted {samples} samples from BAM ({bam:.2f} GB) to CRAM'
+            ' ({cram:.2f} GB, {ratio:.0%}) in {seconds:.1f}s'.format(
+                    bam=cram_totals['bam_bytes'] / 1e9,
+                    cram=cram_totals['cram_bytes'] / 1e9,
+                    ratio=cram_totals['cram_bytes'] / max(cram_totals['bam_bytes'], 1),
+                    **cram_totals),
+            logging.INFO
+        ))
+
+    checkpoint_executor.shutdown()
+
+
+def stream_archive(log_queue, path, bucket, key, exclude, archive_format,
+                   indexed):
+    """Archive path straight to S3, retrying. Returns True if it got there"""
+    for i in range(UPLOAD_RETRY):
+        try:
+            stats = ut_archive.upload_archive(path, bucket, key,
+                                              archive_format=archive_format,
+                                              indexed=indexed, exclude=exclude)
+        except Exception as exc:
+            log_queue.put(('Failed to upload {}: {}'.format(key, exc),
+                           logging.INFO))
+            continue
 
-        # rm all the files
-        command = ['rm', '-rf', dest_dir]
-        ut_log.log_command_to_queue(log_queue, command, shell=True)
+        log_queue.put((
+            'Uploaded {}: {:.1f} MB compressed to {:.1f} MB in {:.1f}s'.format(
+                    key, stats['bytes_in'] / 1e6, stats['bytes_out'] / 1e6,
+                    stats['seconds']),
+            logging.INFO
+        ))
+        return True
+
+    return False
+
+
+def upload_results(upload_queue, log_queue, archive_format, indexed,
+                   disk_space, tracker, checkpoints, work_queue):
+    """
+    Upload each sample's results with all of its files going at once, and
+    only remove the local copy once S3 has all of them. The result manifest
+    goes last, so it only exists for complete results.
+    """
+    archive_executor = cf.ThreadPoolExecutor(max_workers=1)
+
+    with s3u.TransferSession(n_threads=2 * s3u.UPLOAD_CONCURRENCY) as session:
+        for input_dir, sample_name, dest_dir, taxon, bucket, footprint, file_pairs, archives, manifest in iter(upload_queue.get, 'STOP'):
+            start_time = time.time()
+            n_bytes = sum(os.path.getsize(src) for src, key in file_pairs)
+
+            archive_futures = [
+                archive_executor.submit(stream_archive, log_queue, path,
+                                        bucket, key, exclude, archive_format,
+                                        indexed)
+                for path, key, exclude in archives
+            ]
+
+            for i in range(UPLOAD_RETRY):
+                failed = [r for r in session.upload(file_pairs, bucket)
+                          if not r.success]
+                if not failed:
+                    break
+
+                for r in failed:
+                    log_queue.put(('Failed to upload {}: {}'.format(
+                            r.key, r.error), logging.INFO))
+
+                failed_keys = {r.key for r in failed}
+                file_pairs = [(src, key) for src, key in file_pairs
+                              if key in failed_keys]
+
+            if not all(f.result() for f in archive_futures):
+                failed.extend(archives)
+
+            if not failed:
+                failed = [r for r in session.upload([manifest], bucket)
+                          if not r.success]
+
+            if failed:
+                log_queue.put(('Giving up on uploading {} - {} ({})'.format(
+                        input_dir, sample_name, taxon), logging.INFO))
+            else:
+                elapsed = time.time() - start_time
+                log_queue.put((
+                    'Uploaded {} - {} ({}): {:.1f} MB in {:.1f}s ({:.1f} MB/s)'.format(
+                            input_dir, sample_name, taxon, n_bytes / 1e6, elapsed,
+                            n_bytes / 1e6 / max(elapsed, 1e-6)),
+                    logging.INFO
+                ))
+
+            # rm all the files
+            finish_taxon(log_queue, input_dir, sample_name, dest_dir, taxon,
+                         disk_space, footprint, tracker, checkpoints,
+                         work_queue, failed=bool(failed))
+
+    archive_executor.shutdown()
 
 
 def main(logger):
@@ -212,36 +1103,71 @@ def main(logger):
 
     args = parser.parse_args()
 
+    if args.indexed_archive and args.archive_format != 'gzip':
+        raise ValueError('--indexed_archive needs --archive_format gzip')
+
     if os.environ.get('AWS_BATCH_JOB_ID'):
         root_dir = os.path.join('/mnt', os.environ['AWS_BATCH_JOB_ID'])
     else:
         root_dir = '/mnt'
 
     run_dir = os.path.join(root_dir, 'data', 'hca')
-    os.makedirs(run_dir)
-
-    if args.taxon == 'homo':
-        genome_dir = os.path.join(root_dir, "genome/STAR/HG38-PLUS/")
-        ref_genome_file = 'hg38-plus.tgz'
-        ref_genome_star_file = 'STAR/HG38-PLUS.tgz'
-        sjdb_gtf = os.path.join(root_dir, 'genome', 'hg38-plus', 'hg38-plus.gtf')
-    elif args.taxon == 'mus':
-        genome_dir = os.path.join(root_dir, "genome/STAR/MM10-PLUS/")
-        ref_genome_file = 'mm10-plus.tgz'
-        ref_genome_star_file = 'STAR/MM10-PLUS.tgz'
-        sjdb_gtf = os.path.join(root_dir, 'genome', 'mm10-plus', 'mm10-plus.gtf')
+    # it may be there from an earlier run of this job, which we carry on
+    os.makedirs(run_dir, exist_ok=True)
 
-    else:
-        raise ValueError('Invalid taxon {}'.format(args.taxon))
+    checkpoints = ut_ckpt.Checkpoints(run_dir, args.checkpoint_path)
+
+    taxa = list(dict.fromkeys(args.taxon))
+
+    cpus, memory = ut_pipe.get_resources(get_default_requirements())
+    if args.cpus:
+        cpus = args.cpus
+    if args.memory:
+        memory = args.memory * 1024 ** 3
 
-    if args.star_proc > mp.cpu_count():
+    if args.star_proc > cpus:
         raise ValueError('Not enough CPUs to give {} processes to STAR'.format(
                 args.star_proc))
 
     s3_input_bucket,s3_input_prefix = s3u.s3_bucket_and_key(args.s3_input_path)
 
+    if args.no_reference_cache:
+        ref_cache = None
+    else:
+        ref_cache = ut_ref.ReferenceCache(
+                args.reference_cache,
+                max_bytes=args.reference_cache_size * 1024 ** 3
+        )
+
+    genomes = {taxon: stage_genome(taxon, root_dir, ref_cache, logger)
+               for taxon in taxa}
+
+    # the genomes are loaded once into shared memory, the rest is for the stages
+    genome_memory = sum(os.path.getsize(os.path.join(genome['genome_dir'], fn))
+                        for genome in genomes.values()
+                        for fn in os.listdir(genome['genome_dir'])
+                        if os.path.isfile(os.path.join(genome['genome_dir'], fn)))
+
+    # the upload processes aren't in the budget, so their buffers are set
+    # aside first: each sends one sample's files while it streams an archive
+    upload_memory = args.upload_proc * (s3u.UPLOAD_MEMORY
+                                        + ut_archive.UPLOAD_MEMORY)
+
+    budget = ut_pipe.ResourceBudget(
+            cpus, max(memory - genome_memory - upload_memory, 0)
+    )
+    if genome_memory + upload_memory >= memory:
+        logger.warning('Genome ({:.1f} GB) and uploads ({:.1f} GB) are larger'
+                       ' than the memory budget ({:.1f} GB)'.format(
+                               genome_memory / 1024 ** 3,
+                               upload_memory / 1024 ** 3, memory / 1024 ** 3))
+
     logger.info(
             '''Run Info: partition {} out of {}
+                        cpus:\t{}
+                  memory(GB):\t{:.1f}
+           genome_memory(GB):\t{:.1f}
+           upload_memory(GB):\t{:.1f}
                    star_proc:\t{}
                   htseq_proc:\t{}
                   genome_dir:\t{}
@@ -252,85 +1178,209 @@ def main(logger):
                s3_input_path:\t{}
                   input_dirs:\t{}'''.format(
                     args.partition_id, args.num_partitions,
+                    cpus, memory / 1024 ** 3, genome_memory / 1024 ** 3,
+                    upload_memory / 1024 ** 3,
                     args.star_proc, args.htseq_proc,
-                    genome_dir, ref_genome_file,
-                    ref_genome_star_file, sjdb_gtf,
-                    args.taxon, args.s3_input_path,
+                    ', '.join(genomes[t]['genome_dir'] for t in taxa),
+                    ', '.join(genomes[t]['ref_genome_file'] for t in taxa),
+                    ', '.join(genomes[t]['ref_genome_star_file'] for t in taxa),
+                    ', '.join(genomes[t]['sjdb_gtf'] for t in taxa),
+                    ', '.join(taxa), args.s3_input_path,
                     ', '.join(args.input_dirs)
             )
     )
 
 
-    s3 = boto3.resource('s3')
-
-    # download the genome data
-    os.mkdir(os.path.join(root_dir, 'genome'))
-    logger.info('Downloading and extracting genome data {}'.format(ref_genome_file))
-
-    object = s3.Object('czbiohub-reference', ref_genome_file)
+    for taxon in taxa:
+        genome = genomes[taxon]
 
-    with tarfile.open(fileobj=object.get()['Body'], mode='r:gz') as tf:
-        tf.extractall(path=os.path.join(root_dir, 'genome'))
-
-
-    # download STAR stuff
-    os.mkdir(os.path.join(root_dir, 'genome', 'STAR'))
-    logger.info('Downloading and extracting STAR data {}'.format(ref_genome_star_file))
-
-    object = s3.Object('czbiohub-reference', ref_genome_star_file)
+        if args.output_format == 'cram':
+            # CRAM is compressed against the reference, so note which one
+            genome['fasta'] = ut_ref.find_fasta(
+                    os.path.join(genome['genome_base_dir'], genome['ref_name'])
+            )
+            ut_ref.index_fasta(genome['fasta'], logger)
+            genome['reference'] = {
+                'fasta': os.path.basename(genome['fasta']),
+                'md5': ut_ref.fasta_md5(genome['fasta'], logger)
+            }
+            logger.info('Writing CRAM against {} (MD5 {})'.format(
+                    genome['fasta'], genome['reference']['md5']))
+        else:
+            genome['fasta'] = genome['reference'] = None
 
-    with tarfile.open(fileobj=object.get()['Body'], mode='r:gz') as tf:
-        tf.extractall(path=os.path.join(root_dir, 'genome', 'STAR'))
+        if args.count_engine == 'builtin':
+            if ut_count.pysam is None:
+                raise ValueError('pysam is needed for --count_engine builtin')
 
+            # built once per reference, and shared by the workers
+            start_time = time.time()
+            ut_count.GeneIndex.load(genome['sjdb_gtf'], logger=logger)
+            logger.info('Gene index ready in {:.1f}s'.format(time.time() - start_time))
 
-    # Load Genome Into Memory
-    command = [STAR, '--genomeDir', genome_dir, '--genomeLoad', 'LoadAndExit']
-    ut_log.log_command(logger, command, shell=True)
+        # Load Genome Into Memory
+        command = [STAR, '--genomeDir', genome['genome_dir'],
+                   '--genomeLoad', 'LoadAndExit']
+        ut_log.log_command(logger, command, shell=True)
 
     log_queue, log_thread = ut_log.get_thread_logger(logger)
 
+    if args.work_queue:
+        work_queue = ut_queue.LeaseQueue(args.work_queue,
+                                         lease_seconds=args.lease_minutes * 60)
+        # only claim samples as the pipeline has room for them
+        download_queue = mp.Queue(maxsize=args.download_proc)
+    else:
+        work_queue = None
+        download_queue = mp.Queue()
+
     star_queue = mp.Queue()
     htseq_queue = mp.Queue()
+    upload_queue = mp.Queue()
+
+    # counts down each sample's taxa, so the last one can clean up after it
+    manager = mp.Manager()
+    tracker = ut_pipe.PartTracker(manager)
+
+    # fastqs for upcoming samples are downloaded while STAR runs, up to
+    # download_budget GB ahead
+    disk_budget = ut_pipe.DiskBudget(args.download_budget * 1024 ** 3)
+
+    # each sample holds its estimated peak disk use from the start of its
+    # download until its files are removed, so the volume doesn't fill up
+    disk_reserve = args.disk_reserve * 1024 ** 3
+    disk_space = ut_pipe.DiskBudget(
+            shutil.disk_usage(run_dir).free - disk_reserve,
+            path=run_dir, reserve=disk_reserve
+    )
+    footprint_ratio = FOOTPRINT_RATIO['streaming' if args.streaming
+                                      else 'standard']
+    logger.info('{:.1f} GB of disk space for samples'.format(
+            disk_space.n_bytes / 1024 ** 3))
+
+    download_args = (download_queue, star_queue, log_queue, s3_input_bucket,
+                     run_dir, disk_budget, disk_space, footprint_ratio,
+                     tracker, checkpoints, work_queue)
+    download_procs = [mp.Process(target=download_samples, args=download_args)
+                      for i in range(args.download_proc)]
+
+    for p in download_procs:
+        p.start()
+
+    # the budget decides how many of these are actually running at once
+    n_star_procs = cpus // args.star_proc
+
+    # only htseq-count -r name needs a name-sorted copy of the BAM
+    name_sort = args.count_engine == 'htseq-count' and not args.streaming
+
+    # STAR and counting are where workers die (usually out of memory), so
+    # those are supervised: dead workers are replaced and their samples
+    # retried, which picks up from the sample's checkpoints
+    describe = lambda item: '{} - {}'.format(*item[:2])
+
+    star_args = (htseq_queue, log_queue,
+                 genomes, args.star_proc, disk_budget, disk_space, budget,
+                 args.streaming, name_sort, tracker, checkpoints, work_queue)
+    star_pool = ut_pipe.WorkerPool(
+            'STAR', run_sample, star_args, star_queue, n_star_procs, manager,
+            log_queue, retries=args.worker_retries, describe=describe,
+            budgets=[budget, disk_budget, disk_space],
+            on_failure=lambda item: abandon_alignment(
+                    item, log_queue, disk_budget, disk_space, tracker,
+                    checkpoints, work_queue)
+    )
+    star_pool.start()
 
-    n_star_procs = mp.cpu_count() // args.star_proc
+    htseq_args = (upload_queue, log_queue,
+                  args.s3_input_path, args.s3_output_path,
+                  genomes, budget, args.count_engine,
+                  args.archive_format, args.indexed_archive,
+                  args.output_format, disk_space, tracker, checkpoints,
+                  work_queue)
+    htseq_pool = ut_pipe.WorkerPool(
+            'count', run_htseq, htseq_args, htseq_queue, args.htseq_proc,
+            manager, log_queue, retries=args.worker_retries,
+            describe=describe, budgets=[budget, disk_space],
+            on_failure=lambda item: abandon_count(
+                    item, log_queue, disk_space, tracker, checkpoints,
+                    work_queue)
+    )
+    htseq_pool.start()
 
-    star_args = (star_queue, htseq_queue, log_queue, s3_input_bucket,
-                 genome_dir, run_dir, args.star_proc)
-    star_procs = [mp.Process(target=run_sample, args=star_args)
-                  for i in range(n_star_procs)]
+    upload_procs = [mp.Process(target=upload_results,
+                               args=(upload_queue, log_queue,
+                                     args.archive_format,
+                                     args.indexed_archive, disk_space,
+                                     tracker, checkpoints, work_queue))
+                    for i in range(args.upload_proc)]
 
-    for p in star_procs:
+    for p in upload_procs:
         p.start()
 
-    htseq_args = (htseq_queue, log_queue,
-                  args.s3_input_path, args.s3_output_path,
-                  args.taxon, sjdb_gtf)
-    htseq_procs = [mp.Process(target=run_htseq, args=htseq_args)
-                   for i in range(args.htseq_proc)]
 
-    for p in htseq_procs:
-        p.start()
+    if args.partition_plan:
+        logger.info('Reading partition plan {}'.format(args.partition_plan))
+        plan = ut_sample.read_json(args.partition_plan)
+        if plan['num_partitions'] != args.num_partitions:
+            raise ValueError('Plan has {} partitions, expected {}'.format(
+                    plan['num_partitions'], args.num_partitions))
 
+        plan_samples = {
+            tuple(sample) for sample
+            in plan['partitions'][args.partition_id]['samples']
+        }
+    else:
+        plan_samples = None
 
-    sample_re = re.compile("([^/]+)_R\d_\d+.fastq.gz$")
+    if args.listing_cache:
+        logger.info('Using listing cache {}'.format(args.listing_cache))
+        cache = s3u.ListingCache(args.listing_cache)
+    else:
+        cache = None
 
-    for input_dir in args.input_dirs:
-        if args.s3_output_path is None:
-            s3_output_path = os.path.join(args.s3_input_path, input_dir, 'results')
-        else:
-            s3_output_path = args.s3_output_path
+    queued_samples = []
 
-        s3_output_bucket,s3_output_prefix = s3u.s3_bucket_and_key(s3_output_path)
+    if args.manifest:
+        logger.info('Reading manifest {}'.format(args.manifest))
+        manifest = ut_sample.read_json(args.manifest)
+        if manifest['s3_input_path'] != args.s3_input_path:
+            raise ValueError('Manifest is for {}, not {}'.format(
+                    manifest['s3_input_path'], args.s3_input_path))
+    else:
+        manifest = None
 
-        # Check the input_dir folder for existing runs
-        if not args.force_realign:
-            output = s3u.prefix_gen(s3_output_bucket, s3_output_prefix,
-                                    lambda r: (r['LastModified'], r['Key']))
+    for input_dir in args.input_dirs:
+        if manifest is not None:
+            if input_dir not in manifest['input_dirs']:
+                raise ValueError('{} is not in the manifest'.format(input_dir))
+
+            manifest_samples = manifest['input_dirs'][input_dir]['samples']
+
+            samples = {sample_name: [tuple(fastq) for fastq in info['fastqs']]
+                       for sample_name, info in manifest_samples.items()}
+            if not args.force_realign:
+                output_files = {
+                    (sample_name, taxon)
+                    for sample_name, info in manifest_samples.items()
+                    for taxon in info['finished']
+                }
+            else:
+                output_files = set()
         else:
-            output = []
+            s3_output_path = ut_sample.get_output_path(
+                    args.s3_input_path, input_dir, args.s3_output_path
+            )
 
-        output_files = {tuple(os.path.basename(fn).split('.')[:2]) for dt,fn in output
-                        if fn.endswith('htseq-count.txt') and dt > CURR_MIN_VER}
+            # Check the input_dir folder for existing runs
+            if not args.force_realign:
+                output_files = ut_sample.get_finished(s3_output_path, cache=cache)
+            else:
+                output_files = set()
+
+            samples = ut_sample.get_samples(
+                    s3_input_bucket, os.path.join(s3_input_prefix, input_dir),
+                    cache=cache
+            )
 
         logger.info("Skipping {} existing results".format(len(output_files)))
 
@@ -338,47 +1388,81 @@ def main(logger):
                 args.partition_id, args.num_partitions, input_dir)
         )
 
-        output = [
-            fn for fn in s3u.get_files(s3_input_bucket,
-                                       os.path.join(s3_input_prefix, input_dir))
-            if fn.endswith('fastq.gz')
-        ]
-
-        logger.info("number of fastq.gz files: {}".format(len(output)))
-
-        sample_lists = defaultdict(list)
+        logger.info("number of fastq.gz files: {}".format(
+                sum(len(fastqs) for fastqs in samples.values()))
+        )
 
-        for fn in output:
-            matched = sample_re.search(os.path.basename(fn))
-            if matched:
-                sample_lists[matched.group(1)].append(fn)
+        sample_lists = {sample_name: sorted(key for key, size in fastqs)
+                        for sample_name, fastqs in samples.items()}
+        sample_sizes = {sample_name: sum(size for key, size in fastqs)
+                        for sample_name, fastqs in samples.items()}
 
-        for sample_name in sorted(sample_lists)[args.partition_id::args.num_partitions]:
-            if (sample_name, args.taxon) in output_files:
+        if plan_samples is not None:
+            partition_samples = [sample_name for sample_name in sorted(sample_lists)
+                                 if (input_dir, sample_name) in plan_samples]
+        elif work_queue is None:
+            partition_samples = sorted(sample_lists)[args.partition_id::args.num_partitions]
+        else:
+            partition_samples = sorted(sample_lists)
+
+        for sample_name in partition_samples:
+            sample_taxa = [taxon for taxon in taxa
+                           if (sample_name, taxon) not in output_files
+                           and (args.force_realign or not checkpoints.uploaded(
+                                   input_dir, sample_name, taxon))]
+            if not sample_taxa:
                 logger.info("{} already exists, skipping".format(sample_name))
                 continue
 
-            logger.info("Adding sample {} to queue".format(sample_name))
-            star_queue.put((input_dir, sample_name, sorted(sample_lists[sample_name])))
+            sample = (input_dir, sample_name,
+                      sorted(sample_lists[sample_name]),
+                      sample_sizes[sample_name], sample_taxa)
+
+            if work_queue is None:
+                logger.info("Adding sample {} to queue".format(sample_name))
+                download_queue.put(sample)
+            else:
+                queued_samples.append(sample)
+
+    if work_queue is not None:
+        stop_renewing, renew_thread = claim_samples(
+                work_queue, queued_samples, download_queue,
+                args.partition_id, args.num_partitions, logger
+        )
 
-    for i in range(n_star_procs):
-        star_queue.put('STOP')
+    for i in range(args.download_proc):
+        download_queue.put('STOP')
 
-    for p in star_procs:
+    for p in download_procs:
         p.join()
 
-    for i in range(args.htseq_proc):
-        htseq_queue.put('STOP')
+    star_pool.stop()
+    htseq_pool.stop()
+
+    for i in range(args.upload_proc):
+        upload_queue.put('STOP')
 
-    for p in htseq_procs:
+    for p in upload_procs:
         p.join()
 
+    if work_queue is not None:
+        stop_renewing.set()
+        renew_thread.join()
+
     log_queue.put('STOP')
     log_thread.join()
 
-    # Remove Genome from Memory
-    command = [STAR, '--genomeDir', genome_dir, '--genomeLoad', 'Remove']
-    ut_log.log_command(logger, command, shell=True)
+    manager.shutdown()
+
+    for genome in genomes.values():
+        # Remove Genome from Memory
+        command = [STAR, '--genomeDir', genome['genome_dir'],
+                   '--genomeLoad', 'Remove']
+        ut_log.log_command(logger, command, shell=True)
+
+        if ref_cache is not None:
+            ref_cache.release(genome['genome_base_dir'])
+            ref_cache.release(genome['star_base_dir'])
 
     logger.info('Job completed')
 
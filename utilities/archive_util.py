@@ -0,0 +1,314 @@
+import json
+import os
+import tarfile
+import time
+import zlib
+
+import boto3
+import botocore.config
+
+import concurrent.futures as cf
+
+from collections import deque
+
+import utilities.s3_util as s3u
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+ARCHIVE_FORMATS = ('gzip', 'zstd')
+EXTENSIONS = {'gzip': '.tgz', 'zstd': '.tar.zst'}
+
+BLOCK_SIZE = 4 * 1024 ** 2
+N_THREADS = 8
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# roughly the most memory upload_archive holds: the parts going up to S3,
+# and the blocks being compressed (in and out) with the one filling up
+UPLOAD_MEMORY = (s3u.MULTIPART_WRITER_MEMORY
+                 + 2 * (2 * N_THREADS + 1) * BLOCK_SIZE)
+
+
+class ParallelGzipWriter(object):
+    """
+    A write-only file object that gzips into fileobj on n_threads threads.
+    Input is cut into blocks of block_size and each block is compressed as
+    its own gzip member, like BGZF. Concatenated members are a valid gzip
+    file, so the output reads back with gzip, tar or pigz as usual.
+
+    new_block() ends the current block early, so that what follows starts a
+    new member which can be decompressed on its own. The compressed offset
+    of every block is in block_offsets once the writer is closed.
+    """
+
+    def __init__(self, fileobj, n_threads=N_THREADS, block_size=BLOCK_SIZE,
+                 level=GZIP_LEVEL):
+        self.fileobj = fileobj
+        self.n_threads = n_threads
+        self.block_size = block_size
+        self.level = level
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        self.block_offsets = []
+
+        self._executor = cf.ThreadPoolExecutor(max_workers=n_threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._n_blocks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writable(self):
+        return True
+
+    def _compress(self, data):
+        # wbits=31 writes a gzip header and trailer around the block
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def _write_next(self):
+        block = self._pending.popleft().result()
+        self.block_offsets.append(self.bytes_out)
+        self.fileobj.write(block)
+        self.bytes_out += len(block)
+
+    def _submit(self, data):
+        # blocks are written in order, keeping a few in flight
+        while len(self._pending) >= 2 * self.n_threads:
+            self._write_next()
+
+        self._pending.append(self._executor.submit(self._compress, data))
+        self._n_blocks += 1
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_in += len(data)
+
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+
+        return len(data)
+
+    def tell(self):
+        """The uncompressed position, which is what tarfile expects"""
+        return self.bytes_in
+
+    def new_block(self):
+        """Start a new block here. Returns the index of that block"""
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        return self._n_blocks
+
+    def close(self):
+        """Write out everything that's left. fileobj is left open"""
+        if self._buffer or not self._n_blocks:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        while self._pending:
+            self._write_next()
+
+        self._executor.shutdown(wait=True)
+
+
+class _CountingWriter(object):
+    """Passes writes through to fileobj, counting the bytes"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.n_bytes = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.n_bytes += len(data)
+        return len(data)
+
+
+class ZstdWriter(object):
+    """The same interface as ParallelGzipWriter, using zstd's own threads"""
+
+    def __init__(self, fileobj, n_threads=N_THREADS, level=ZSTD_LEVEL):
+        if zstandard is None:
+            raise ImportError('zstandard is needed to write zstd archives')
+
+        self.fileobj = fileobj
+        self.bytes_in = 0
+
+        self._output = _CountingWriter(fileobj)
+        compressor = zstandard.ZstdCompressor(level=level, threads=n_threads)
+        self._writer = compressor.stream_writer(self._output, closefd=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def bytes_out(self):
+        return self._output.n_bytes
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        return self._writer.write(data)
+
+    def close(self):
+        """Finish the zstd frame. fileobj is left open"""
+        self._writer.close()
+
+
+def compressor(fileobj, archive_format='gzip', n_threads=N_THREADS):
+    """A writer that compresses into fileobj in the given format"""
+    if archive_format == 'gzip':
+        return ParallelGzipWriter(fileobj, n_threads=n_threads)
+    elif archive_format == 'zstd':
+        return ZstdWriter(fileobj, n_threads=n_threads)
+    else:
+        raise ValueError('Unknown archive format {}'.format(archive_format))
+
+
+def _walk(path, arcname, exclude=()):
+    """(path, name) for everything under path, in the order tarfile adds them"""
+    if path in exclude:
+        return
+
+    yield path, arcname
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        for fn in sorted(os.listdir(path)):
+            yield from _walk(os.path.join(path, fn), os.path.join(arcname, fn),
+                             exclude)
+
+
+def archive_members(path, arcname=None, exclude=()):
+    """The names an archive of path would have, leaving out exclude"""
+    if arcname is None:
+        arcname = os.path.basename(path.rstrip('/'))
+
+    return [name for _, name in _walk(path, arcname, set(exclude))]
+
+
+def write_archive(fileobj, path, arcname=None, archive_format='gzip',
+                  n_threads=N_THREADS, exclude=()):
+    """
+    Write path (a file or directory) as a compressed tar stream to fileobj,
+    which only needs a write method. Paths in exclude are left out. Returns
+    the compressing writer, with bytes_in and bytes_out totals.
+    """
+    if arcname is None:
+        arcname = os.path.basename(path.rstrip('/'))
+
+    exclude = set(exclude)
+
+    with compressor(fileobj, archive_format, n_threads) as writer:
+        with tarfile.open(fileobj=writer, mode='w|') as tf:
+            for member_path, name in _walk(path, arcname, exclude):
+                tf.add(member_path, arcname=name, recursive=False)
+
+    return writer
+
+
+def write_indexed_archive(fileobj, path, arcname=None, n_threads=N_THREADS,
+                          exclude=()):
+    """
+    Like write_archive with gzip, but every file starts a new gzip member,
+    so it can be read from the archive without the rest. The result is
+    still an ordinary .tgz. Returns the writer and an index of
+    {name: {'offset', 'length', 'data_offset', 'size'}}: offset and length
+    are the compressed byte range holding the file, and data_offset is where
+    its data starts once that range is decompressed.
+    """
+    if arcname is None:
+        arcname = os.path.basename(path.rstrip('/'))
+
+    entries = []
+
+    with ParallelGzipWriter(fileobj, n_threads=n_threads) as writer:
+        # mode 'w' rather than 'w|', so that writes aren't buffered and
+        # the block boundaries line up with the members
+        with tarfile.open(fileobj=writer, mode='w') as tf:
+            for member_path, name in _walk(path, arcname, set(exclude)):
+                tarinfo = tf.gettarinfo(member_path, name)
+                block = writer.new_block()
+                start = writer.tell()
+
+                if tarinfo.isreg():
+                    with open(member_path, 'rb') as fh:
+                        tf.addfile(tarinfo, fh)
+                else:
+                    tf.addfile(tarinfo)
+
+                # the data is padded out to a whole number of tar blocks
+                padded = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                entries.append((tarinfo.name, block, tarinfo.size,
+                                writer.tell() - start - padded))
+
+            end_block = writer.new_block()
+
+    offsets = writer.block_offsets + [writer.bytes_out]
+    next_blocks = [entry[1] for entry in entries[1:]] + [end_block]
+
+    index = dict()
+    for (name, block, size, data_offset), next_block in zip(entries, next_blocks):
+        index[name] = {'offset': offsets[block],
+                       'length': offsets[next_block] - offsets[block],
+                       'data_offset': data_offset,
+                       'size': size}
+
+    return writer, index
+
+
+def upload_archive(path, bucket, key, arcname=None, archive_format='gzip',
+                   n_threads=N_THREADS, client=None, indexed=False, exclude=()):
+    """
+    Archive path straight into s3://bucket/key, compressing in parallel and
+    uploading the parts as they're produced, without writing a local file.
+    If indexed, files can be read back one at a time using the index saved
+    next to the archive (see s3_util.read_archive_member). Paths in exclude
+    are left out. Returns a dict with the bytes in and out and the seconds
+    taken.
+    """
+    if indexed and archive_format != 'gzip':
+        raise ValueError('Indexed archives must use gzip')
+
+    if client is None:
+        client = boto3.client(
+                's3', config=botocore.config.Config(
+                        max_pool_connections=s3u.UPLOAD_CONCURRENCY
+                )
+        )
+
+    start_time = time.time()
+
+    with s3u.MultipartWriter(client, bucket, key) as fh:
+        if indexed:
+            writer, index = write_indexed_archive(fh, path, arcname,
+                                                  n_threads, exclude)
+        else:
+            writer = write_archive(fh, path, arcname, archive_format,
+                                   n_threads, exclude)
+
+    if indexed:
+        client.put_object(Bucket=bucket, Key=key + s3u.ARCHIVE_INDEX_SUFFIX,
+                          Body=json.dumps({'format': archive_format,
+                                           'members': index}).encode())
+
+    return {'bytes_in': writer.bytes_in,
+            'bytes_out': writer.bytes_out,
+            'seconds': time.time() - start_time}
@@ -0,0 +1,186 @@
+import json
+import os
+import socket
+import time
+
+import utilities.queue_util as ut_queue
+import utilities.s3_util as s3u
+
+
+# stages are finished in this order. download is per sample, the rest are
+# per taxon, since a sample can be aligned to more than one genome
+SAMPLE_STAGES = ('download',)
+TAXON_STAGES = ('align', 'sort', 'index', 'count', 'upload')
+
+# local markers go in this directory in each sample's (or taxon's) directory
+CHECKPOINT_DIR = '.checkpoints'
+
+
+class Checkpoints(object):
+    """
+    Stage completion markers for each sample, so a restarted job can pick a
+    sample up after its last finished stage instead of from the download.
+
+    Markers are written in the sample's own directory under run_dir, so they
+    are removed along with it. If s3_path is given, markers for stages that
+    are marked with their files are also written there, with a copy of the
+    files, so a job on another instance can restore the sample and carry on.
+    Those copies are removed once the sample's results are uploaded.
+
+        run_dir/input_dir/sample_name/[taxon/].checkpoints/stage
+        s3_path/input_dir/sample_name/taxon/stage
+        s3_path/input_dir/sample_name/taxon/files/...
+    """
+
+    def __init__(self, run_dir, s3_path=None):
+        self.run_dir = run_dir
+        self.local = ut_queue.LocalLeaseStore(run_dir)
+
+        if s3_path:
+            self.remote = ut_queue.S3LeaseStore(s3_path)
+        else:
+            self.remote = None
+
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        # one session per process, like the lease stores' clients
+        if self._pid != os.getpid():
+            self._session = s3u.TransferSession(n_threads=8)
+            self._pid = os.getpid()
+        return self._session
+
+    def base_dir(self, input_dir, sample_name, taxon=None):
+        """The local directory that a stage's files are relative to"""
+        return os.path.join(self.run_dir, input_dir, sample_name, taxon or '')
+
+    def _local_name(self, input_dir, sample_name, taxon, stage):
+        return os.path.join(input_dir, sample_name, taxon or '',
+                            CHECKPOINT_DIR, stage)
+
+    def _remote_name(self, input_dir, sample_name, taxon, stage):
+        return os.path.join(input_dir, sample_name, taxon or '', stage)
+
+    def _file_key(self, input_dir, sample_name, taxon, path):
+        return os.path.join(self.remote.prefix, input_dir, sample_name,
+                            taxon or '', 'files', path)
+
+    def done(self, input_dir, sample_name, taxon, stage):
+        """Whether stage is finished for this sample (and taxon) here"""
+        return self.local.exists(
+                self._local_name(input_dir, sample_name, taxon, stage)
+        )
+
+    def uploaded(self, input_dir, sample_name, taxon):
+        """Whether S3 has a record of this taxon's results being uploaded"""
+        return self.remote is not None and self.remote.exists(
+                self._remote_name(input_dir, sample_name, taxon, 'upload')
+        )
+
+    def saved(self, input_dir, sample_name, taxon, stage):
+        """
+        Whether stage's files are on S3 already, or there's no S3 path to
+        save them to
+        """
+        return self.remote is None or self.remote.exists(
+                self._remote_name(input_dir, sample_name, taxon, stage)
+        )
+
+    def mark(self, input_dir, sample_name, taxon, stage, files=None):
+        """
+        Record that stage is finished. If files (local paths) is given and
+        there's an S3 path, they are copied there and the stage is recorded
+        there too. Returns False if the copy failed, in which case the stage
+        is only marked locally.
+        """
+        base_dir = self.base_dir(input_dir, sample_name, taxon)
+        rel_files = [os.path.relpath(fn, base_dir) for fn in files or ()]
+
+        body = json.dumps({'host': socket.gethostname(),
+                           'time': time.time(),
+                           'files': rel_files})
+
+        self.local.put(self._local_name(input_dir, sample_name, taxon, stage),
+                       body)
+
+        if self.remote is None or files is None:
+            return True
+
+        file_pairs = [(os.path.join(base_dir, fn),
+                       self._file_key(input_dir, sample_name, taxon, fn))
+                      for fn in rel_files]
+        if not all(r.success for r in self.session.upload(file_pairs,
+                                                          self.remote.bucket)):
+            return False
+
+        self.remote.put(self._remote_name(input_dir, sample_name, taxon, stage),
+                        body)
+        return True
+
+    def restore(self, input_dir, sample_name, taxon):
+        """
+        Bring back the stages of a taxon that S3 has and we don't, by
+        downloading their files and marking them here. Stages that were only
+        marked locally are implied by the later ones. Returns False if a
+        download failed.
+        """
+        if self.remote is None:
+            return True
+
+        base_dir = self.base_dir(input_dir, sample_name, taxon)
+
+        # upload is only recorded once the taxon is finished and cleaned up
+        stages = TAXON_STAGES[:-1]
+
+        for i, stage in enumerate(stages):
+            if self.done(input_dir, sample_name, taxon, stage):
+                continue
+
+            current = self.remote.read(
+                    self._remote_name(input_dir, sample_name, taxon, stage)
+            )
+            if current is None:
+                continue
+
+            key_pairs = [(self._file_key(input_dir, sample_name, taxon, fn),
+                          os.path.join(base_dir, fn))
+                         for fn in json.loads(current[0])['files']]
+            for key, path in key_pairs:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            if not all(r.success for r in self.session.download(
+                    key_pairs, self.remote.bucket)):
+                return False
+
+            for earlier in stages[:i + 1]:
+                if not self.done(input_dir, sample_name, taxon, earlier):
+                    self.local.put(self._local_name(input_dir, sample_name,
+                                                    taxon, earlier),
+                                   current[0])
+
+        return True
+
+    def finish(self, input_dir, sample_name, taxon, failed=False):
+        """
+        Once a taxon's results are uploaded, remove the S3 copies of its
+        stages and record the upload so that later jobs can skip it. If it
+        failed, the copies are kept for a later job to resume from.
+        """
+        if self.remote is None or failed:
+            return
+
+        for stage in TAXON_STAGES:
+            name = self._remote_name(input_dir, sample_name, taxon, stage)
+            current = self.remote.read(name)
+            if current is None:
+                continue
+
+            keys = [self._file_key(input_dir, sample_name, taxon, fn)
+                    for fn in json.loads(current[0])['files']]
+            list(self.session.remove(keys, self.remote.bucket))
+
+            self.remote.delete(name)
+
+        self.mark(input_dir, sample_name, taxon, 'upload', files=[])
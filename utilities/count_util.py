@@ -0,0 +1,560 @@
+import bisect
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+
+import multiprocessing as mp
+
+from array import array
+from collections import Counter
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+
+# counts the same way as
+#   htseq-count -s no -m intersection-nonempty -t exon -i gene_id -a 10
+FEATURE_TYPE = 'exon'
+ID_ATTRIBUTE = 'gene_id'
+MIN_AQUAL = 10
+
+INDEX_MAGIC = b'GTFIDX1\n'
+INDEX_SUFFIX = '.idx'
+
+# special counters, in the order htseq-count prints them
+NO_FEATURE = -1
+AMBIGUOUS = -2
+TOO_LOW_AQUAL = -3
+NOT_ALIGNED = -4
+NOT_UNIQUE = -5
+
+SPECIAL_COUNTERS = ((NO_FEATURE, '__no_feature'),
+                    (AMBIGUOUS, '__ambiguous'),
+                    (TOO_LOW_AQUAL, '__too_low_aQual'),
+                    (NOT_ALIGNED, '__not_aligned'),
+                    (NOT_UNIQUE, '__alignment_not_unique'))
+
+# CIGAR operations: M, = and X are counted, and these plus D and N move
+# along the reference
+MATCH_OPS = (0, 7, 8)
+REF_OPS = (0, 2, 3, 7, 8)
+
+# split on semicolons that aren't in quotes, as HTSeq does
+_ATTR_SPLIT_RE = re.compile(r'(?:[^;"]|"[^"]*")+')
+_ATTR_RE = re.compile(r'\s*([^\s=]+)[\s=]+(.*)')
+
+
+def _parse_attributes(attr_str):
+    attrs = dict()
+    for attr in _ATTR_SPLIT_RE.findall(attr_str.rstrip('\n')):
+        if not attr.strip():
+            continue
+
+        matched = _ATTR_RE.match(attr)
+        if not matched:
+            raise ValueError('Failure parsing GTF attributes: {}'.format(attr_str))
+
+        value = matched.group(2)
+        if value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        attrs[matched.group(1)] = value
+
+    return attrs
+
+
+def read_gtf(gtf_path, feature_type=FEATURE_TYPE, id_attribute=ID_ATTRIBUTE):
+    """Yields (chrom, start, end, feature_id) with 0-based, half-open coordinates"""
+    with open(gtf_path) as fh:
+        for line in fh:
+            if line == '\n' or line.startswith('#'):
+                continue
+
+            fields = line.split('\t', 8)
+            if fields[2] != feature_type:
+                continue
+
+            attrs = _parse_attributes(fields[8])
+            if id_attribute not in attrs:
+                raise ValueError('Feature {} does not contain a {} attribute'.format(
+                        line.rstrip(), id_attribute))
+
+            yield fields[0], int(fields[3]) - 1, int(fields[4]), attrs[id_attribute]
+
+
+class GeneIndex(object):
+    """
+    The genes overlapping each position of the genome, as a step function:
+    for each chromosome a sorted array of boundaries and the id of the gene
+    set between each boundary and the next. Sets are stored once as runs of
+    gene indexes. Everything lives in one file that is memory-mapped, so
+    the index is built once per reference and shared by every process that
+    reads it.
+
+    Build it with GeneIndex.load(gtf_path), which reuses a cached index if
+    the GTF hasn't changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError('{} is not a gene index'.format(path))
+
+        header_start = len(INDEX_MAGIC) + 8
+        header_len, = struct.unpack('<q', self._mm[len(INDEX_MAGIC):header_start])
+        self.header = json.loads(
+                self._mm[header_start:header_start + header_len].decode()
+        )
+
+        self.genes = self.header['genes']
+        self.chroms = {chrom: (start, n) for chrom, start, n
+                       in self.header['chroms']}
+
+        view = memoryview(self._mm)
+        arrays = dict()
+        for name, typecode, offset, length in self.header['arrays']:
+            size = array(typecode).itemsize
+            arrays[name] = view[offset:offset + length * size].cast(typecode)
+
+        self._bounds = arrays['bounds']
+        self._step_sets = arrays['step_sets']
+        self._set_offsets = arrays['set_offsets']
+        self._set_genes = arrays['set_genes']
+
+        self._sets = dict()
+
+    def _gene_set(self, set_id):
+        if set_id not in self._sets:
+            self._sets[set_id] = frozenset(
+                    self._set_genes[self._set_offsets[set_id]:
+                                    self._set_offsets[set_id + 1]]
+            )
+        return self._sets[set_id]
+
+    def gene_sets(self, chrom, start, end):
+        """The non-empty sets of gene indexes overlapping [start, end) on chrom"""
+        first, n = self.chroms[chrom]
+        bounds = self._bounds[first:first + n]
+
+        # step i covers [bounds[i], bounds[i + 1]), and the last one is empty
+        i = max(bisect.bisect_right(bounds, start) - 1, 0)
+        while i < n - 1 and bounds[i] < end:
+            set_id = self._step_sets[first + i]
+            if set_id:
+                yield self._gene_set(set_id)
+            i += 1
+
+    @staticmethod
+    def build(gtf_path, index_path, feature_type=FEATURE_TYPE,
+              id_attribute=ID_ATTRIBUTE):
+        """Parse gtf_path and write its index to index_path"""
+        features = dict()
+        for chrom, start, end, gene in read_gtf(gtf_path, feature_type,
+                                                id_attribute):
+            features.setdefault(chrom, []).append((start, end, gene))
+
+        genes = sorted({f[2] for chrom_features in features.values()
+                        for f in chrom_features})
+        gene_ids = {gene: i for i, gene in enumerate(genes)}
+
+        bounds = array('q')
+        step_sets = array('q')
+        set_offsets = array('q', [0, 0])
+        set_genes = array('i')
+        set_ids = {frozenset(): 0}
+        chroms = []
+
+        for chrom in sorted(features):
+            events = Counter()
+            for start, end, gene in features[chrom]:
+                if end > start:
+                    events[start, gene_ids[gene]] += 1
+                    events[end, gene_ids[gene]] -= 1
+
+            positions = sorted({pos for pos, gene_id in events})
+            changes = dict()
+            for (pos, gene_id), delta in events.items():
+                if delta:
+                    changes.setdefault(pos, []).append((gene_id, delta))
+
+            first = len(bounds)
+
+            active = Counter()
+            last_set = None
+            for pos in positions:
+                for gene_id, delta in changes.get(pos, ()):
+                    active[gene_id] += delta
+                    if not active[gene_id]:
+                        del active[gene_id]
+
+                gene_set = frozenset(active)
+                if gene_set == last_set:
+                    continue
+
+                if gene_set not in set_ids:
+                    set_ids[gene_set] = len(set_ids)
+                    set_genes.extend(sorted(gene_set))
+                    set_offsets.append(len(set_genes))
+
+                bounds.append(pos)
+                step_sets.append(set_ids[gene_set])
+                last_set = gene_set
+
+            chroms.append([chrom, first, len(bounds) - first])
+
+        st = os.stat(gtf_path)
+        header = {'gtf': os.path.abspath(gtf_path),
+                  'gtf_size': st.st_size,
+                  'gtf_mtime': st.st_mtime,
+                  'feature_type': feature_type,
+                  'id_attribute': id_attribute,
+                  'genes': genes,
+                  'chroms': chroms}
+
+        named_arrays = (('bounds', bounds), ('step_sets', step_sets),
+                        ('set_offsets', set_offsets), ('set_genes', set_genes))
+
+        # the header records where each array is, which depends on the
+        # header's length, so lay it out with room to spare
+        header['arrays'] = [[name, a.typecode, 0, len(a)]
+                            for name, a in named_arrays]
+        offset = len(INDEX_MAGIC) + 8 + len(json.dumps(header)) + 1024
+        for entry, (name, a) in zip(header['arrays'], named_arrays):
+            offset += -offset % 8
+            entry[2] = offset
+            offset += len(a) * a.itemsize
+
+        header_bytes = json.dumps(header).encode()
+
+        # written to a temporary file and renamed, so readers never see a
+        # partial index
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+        fd, tmp_path = tempfile.mkstemp(dir=index_dir, prefix='.gtfidx')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(INDEX_MAGIC)
+                fh.write(struct.pack('<q', len(header_bytes)))
+                fh.write(header_bytes)
+                for (name, typecode, offset, length), (_, a) in zip(
+                        header['arrays'], named_arrays):
+                    fh.write(b'\0' * (offset - fh.tell()))
+                    a.tofile(fh)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, index_path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, gtf_path, index_path=None, logger=None):
+        """
+        The index for gtf_path, stored next to it by default. It's rebuilt
+        if it is missing or the GTF has changed since it was built.
+        """
+        if index_path is None:
+            index_path = gtf_path + INDEX_SUFFIX
+
+        st = os.stat(gtf_path)
+
+        if os.path.exists(index_path):
+            index = cls(index_path)
+            if (index.header['gtf_size'] == st.st_size
+                    and index.header['gtf_mtime'] == st.st_mtime):
+                return index
+
+        if logger:
+            logger.info('Building gene index {}'.format(index_path))
+
+        cls.build(gtf_path, index_path)
+        return cls(index_path)
+
+
+def _record(read):
+    """The parts of a pysam alignment that counting needs, as a tuple"""
+    ivs = []
+    if not read.is_unmapped:
+        pos = read.reference_start
+        for op, n in read.cigartuples:
+            if op in MATCH_OPS and n > 0:
+                ivs.append((pos, pos + n))
+            if op in REF_OPS:
+                pos += n
+
+    nh = read.get_tag('NH') if read.has_tag('NH') else None
+
+    return (read.query_name, read.flag, read.reference_name,
+            read.reference_start, tuple(ivs), read.mapping_quality, nh,
+            read.next_reference_name, read.next_reference_start,
+            read.template_length)
+
+
+class _Pairer(object):
+    """
+    Pairs mates in a coordinate-sorted stream the way HTSeq does for
+    htseq-count -r pos: each read waits in a buffer, keyed by where it is
+    and where its mate should be, until the mate arrives.
+    """
+
+    def __init__(self):
+        self.buffer = dict()
+        self._n = 0
+
+    def add(self, rec):
+        """Returns (first, second) when rec completes a pair, otherwise None"""
+        name, flag, chrom, start, _, _, _, mate_chrom, mate_pos, tlen = rec
+
+        if not flag & 0x1:
+            raise ValueError('Found a single-end read ({}) in a paired-end'
+                             ' file'.format(name))
+        if flag & 0x40:
+            which, other = 'first', 'second'
+        elif flag & 0x80:
+            which, other = 'second', 'first'
+        else:
+            raise ValueError('Paired-end read {} is neither first nor'
+                             ' second'.format(name))
+
+        aligned = not flag & 0x4
+        mate_aligned = not flag & 0x8
+
+        pos = (chrom, start) if aligned else (None, None)
+        mate = (mate_chrom, mate_pos) if mate_aligned else (None, None)
+        size = tlen if aligned and mate_aligned else None
+
+        mate_key = (name, other) + mate + pos + (-size if size is not None else None,)
+        if mate_key in self.buffer:
+            _, mate_rec = self.buffer[mate_key].pop(0)
+            if not self.buffer[mate_key]:
+                del self.buffer[mate_key]
+
+            return (rec, mate_rec) if which == 'first' else (mate_rec, rec)
+
+        # numbered so the leftovers can be put back in file order
+        self.buffer.setdefault((name, which) + pos + mate + (size,), []).append(
+                (self._n, rec)
+        )
+        self._n += 1
+        return None
+
+    def leftovers(self):
+        """The reads still waiting for their mates, in the order they came"""
+        return [rec for _, rec in sorted((item for items in self.buffer.values()
+                                          for item in items),
+                                         key=lambda item: item[0])]
+
+    def unpaired(self):
+        """The reads whose mates never showed up, as (first, second) pairs"""
+        for rec in self.leftovers():
+            yield (rec, None) if rec[1] & 0x40 else (None, rec)
+        self.buffer = dict()
+
+
+def _assign(index, ivs, minaqual=MIN_AQUAL):
+    """The gene index for a list of (chrom, start, end), or a special counter"""
+    gene_set = None
+    for chrom, start, end in ivs:
+        if chrom not in index.chroms:
+            return NO_FEATURE
+        for genes in index.gene_sets(chrom, start, end):
+            gene_set = genes if gene_set is None else gene_set & genes
+
+    if not gene_set:
+        return NO_FEATURE
+    elif len(gene_set) > 1:
+        return AMBIGUOUS
+    else:
+        return next(iter(gene_set))
+
+
+def _count_single(index, rec, minaqual=MIN_AQUAL):
+    _, flag, chrom, _, ivs, mapq, nh = rec[:7]
+
+    if flag & 0x4:
+        return NOT_ALIGNED
+    if nh is not None and nh > 1:
+        return NOT_UNIQUE
+    if mapq < minaqual:
+        return TOO_LOW_AQUAL
+
+    return _assign(index, [(chrom, start, end) for start, end in ivs])
+
+
+def _count_pair(index, pair, minaqual=MIN_AQUAL):
+    first, second = pair
+    aligned = [rec is not None and not rec[1] & 0x4 for rec in pair]
+
+    if not any(aligned):
+        return NOT_ALIGNED
+
+    # like HTSeq, a missing NH tag on the first mate skips the check
+    for rec in pair:
+        if rec is not None:
+            if rec[6] is None:
+                break
+            if rec[6] > 1:
+                return NOT_UNIQUE
+
+    if any(rec is not None and rec[5] < minaqual for rec in pair):
+        return TOO_LOW_AQUAL
+
+    return _assign(index, [(rec[2], start, end)
+                           for rec, rec_aligned in zip(pair, aligned)
+                           if rec_aligned for start, end in rec[4]])
+
+
+_worker = dict()
+
+
+def _init_worker(bam_path, index_path):
+    _worker['bam'] = pysam.AlignmentFile(bam_path, 'rb')
+    _worker['index'] = GeneIndex(index_path)
+
+
+def _unplaced_reads(bam):
+    """
+    The reads without a position. They are at the end of the file, and the
+    index knows where they start, so the rest of the file isn't read.
+    """
+    return bam.fetch('*')
+
+
+def _count_contig(args):
+    """
+    Count the reads on one reference (None for the unplaced reads). Returns
+    the counts and, for paired-end data, the reads whose mates weren't
+    found on this reference, in file order.
+    """
+    contig, paired, minaqual = args
+    bam, index = _worker['bam'], _worker['index']
+
+    if contig is None:
+        reads = _unplaced_reads(bam)
+    else:
+        reads = bam.fetch(contig)
+
+    counts = Counter()
+
+    if not paired:
+        for read in reads:
+            counts[_count_single(index, _record(read), minaqual)] += 1
+        return counts, []
+
+    pairer = _Pairer()
+    for read in reads:
+        pair = pairer.add(_record(read))
+        if pair is not None:
+            counts[_count_pair(index, pair, minaqual)] += 1
+
+    return counts, pairer.leftovers()
+
+
+def count_reads(bam_path, gtf_path, n_proc=1, index_path=None,
+                minaqual=MIN_AQUAL, logger=None):
+    """
+    Count the reads in a coordinate-sorted, indexed BAM file per gene, like
+    htseq-count -r pos -s no -m intersection-nonempty, with a process per
+    reference sequence. Mates that are on different references are paired
+    up afterwards. Returns (genes, counts) where counts is a Counter keyed
+    by gene index or special counter.
+    """
+    if pysam is None:
+        raise ImportError('pysam is needed to count reads')
+
+    index = GeneIndex.load(gtf_path, index_path, logger=logger)
+
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        paired = False
+        for read in bam.fetch(until_eof=True):
+            paired = read.is_paired
+            break
+
+        contigs = [contig for contig, n in zip(bam.references,
+                                                 bam.lengths)
+                   if n > 0]
+        if bam.nocoordinate:
+            contigs.append(None)
+
+    counts = Counter()
+    pairer = _Pairer()
+
+    with mp.Pool(n_proc, initializer=_init_worker,
+                 initargs=(bam_path, index.path)) as pool:
+        # results come back in file order, so pairs across references
+        # are matched the same way as in a single pass
+        for contig_counts, leftovers in pool.imap(
+                _count_contig,
+                [(contig, paired, minaqual) for contig in contigs]):
+            counts.update(contig_counts)
+            for rec in leftovers:
+                pair = pairer.add(rec)
+                if pair is not None:
+                    counts[_count_pair(index, pair, minaqual)] += 1
+
+    for pair in pairer.unpaired():
+        counts[_count_pair(index, pair, minaqual)] += 1
+
+    return index.genes, counts
+
+
+def write_counts(path, genes, counts):
+    """Write counts in the same format as htseq-count"""
+    with open(path, 'w') as fh:
+        for i, gene in enumerate(genes):
+            fh.write('{}\t{}\n'.format(gene, counts[i]))
+        for counter, name in SPECIAL_COUNTERS:
+            fh.write('{}\t{}\n'.format(name, counts[counter]))
+
+
+def group_contigs(contig_reads, n_groups):
+    """
+    Split references into up to n_groups with about the same number of reads
+    each, for counting in parallel. contig_reads is [(contig, n_reads), ...]
+    in file order, and each group keeps that order. Returns a list of lists
+    of contigs, leaving out contigs without reads.
+    """
+    order = {contig: i for i, (contig, n) in enumerate(contig_reads)}
+
+    groups = [[] for i in range(n_groups)]
+    heap = [(0, i) for i in range(n_groups)]
+
+    for contig, n in sorted(contig_reads, key=lambda c: (-c[1], order[c[0]])):
+        if n == 0:
+            continue
+        load, i = heapq.heappop(heap)
+        groups[i].append(contig)
+        heapq.heappush(heap, (load + n, i))
+
+    return [sorted(group, key=order.get) for group in groups if group]
+
+
+def read_counts(path):
+    """The (name, count) rows of a table written by htseq-count"""
+    with open(path) as fh:
+        return [(name, int(count)) for name, count
+                in (line.rstrip('\n').split('\t') for line in fh)]
+
+
+def merge_counts(paths, out_path):
+    """
+    Add up htseq-count tables made with the same GTF from different reads,
+    special counters included, and write the total in the same format.
+    """
+    tables = [read_counts(path) for path in paths]
+
+    for path, table in zip(paths[1:], tables[1:]):
+        if [name for name, _ in table] != [name for name, _ in tables[0]]:
+            raise ValueError('{} has different genes from {}'.format(
+                    path, paths[0]))
+
+    with open(out_path, 'w') as fh:
+        for rows in zip(*tables):
+            fh.write('{}\t{}\n'.format(rows[0][0], sum(n for _, n in rows)))
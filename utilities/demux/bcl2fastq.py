@@ -9,6 +9,8 @@ import sys
 
 import pandas as pd
 
+import utilities.s3_util as s3u
+
 from utilities.log_util import get_logger, log_command
 
 
@@ -64,6 +66,9 @@ def get_parser():
                         help='Defaults to [exp_id].csv')
     parser.add_argument('--force-glacier', action='store_true',
                         help='Force a transfer from Glacier storage')
+    parser.add_argument('--glacier-tier', default='Standard',
+                        choices=s3u.RESTORE_TIERS,
+                        help='Retrieval tier for restoring from Glacier')
     # TODO(dstone): add an option to delete the original un-demultiplexed from S3 afterward
 
     parser.add_argument('--bcl2fastq_options',
@@ -135,19 +140,41 @@ def main(logger):
                              '{}'.format(samples_not_matching_run_ids))
 
         # download the bcl files
-        command = ['aws', 's3', 'sync', '--quiet',
-                   '--force-glacier-transfer' if args.force_glacier else '',
-                   os.path.join(args.s3_input_dir, args.exp_id), bcl_path]
-        for i in range(S3_RETRY):
-            try:
-                log_command(logger, command, shell=True)
-                break
-            except subprocess.CalledProcessError:
-                logger.info("retrying s3 sync bcl")
-        else:
-            raise RuntimeError("couldn't sync {}".format(
-                    os.path.join(args.s3_input_dir, args.exp_id))
+        if args.force_glacier:
+            # restore from glacier and start downloading as files come back
+            s3_input_bucket, s3_input_prefix = s3u.s3_bucket_and_key(
+                    os.path.join(args.s3_input_dir, args.exp_id, '')
+            )
+
+            bcl_keys = list(s3u.get_files(s3_input_bucket, s3_input_prefix))
+            bcl_files = [
+                os.path.join(bcl_path, os.path.relpath(k, s3_input_prefix))
+                for k in bcl_keys
+            ]
+
+            logger.info("restoring and downloading {} files".format(
+                    len(bcl_keys))
             )
+            failed = s3u.restore_and_download(bcl_keys, bcl_files,
+                                              b=s3_input_bucket,
+                                              tier=args.glacier_tier)
+            if failed:
+                raise RuntimeError("couldn't download {} files from {}".format(
+                        len(failed), os.path.join(args.s3_input_dir, args.exp_id))
+                )
+        else:
+            command = ['aws', 's3', 'sync', '--quiet',
+                       os.path.join(args.s3_input_dir, args.exp_id), bcl_path]
+            for i in range(S3_RETRY):
+                try:
+                    log_command(logger, command, shell=True)
+                    break
+                except subprocess.CalledProcessError:
+                    logger.info("retrying s3 sync bcl")
+            else:
+                raise RuntimeError("couldn't sync {}".format(
+                        os.path.join(args.s3_input_dir, args.exp_id))
+                )
 
 
     # this is actually awful because the process forks and you have to go kill it yourself
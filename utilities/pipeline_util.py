@@ -0,0 +1,596 @@
+import contextlib
+import logging
+import os
+import shutil
+import stat
+import threading
+import time
+
+import multiprocessing as mp
+
+from collections import namedtuple
+
+
+CGROUP_DIR = os.path.join('/sys', 'fs', 'cgroup')
+
+# cgroup v1 reports "no limit" as a huge number rather than 'max'
+CGROUP_NO_LIMIT = 2 ** 60
+
+Grant = namedtuple('Grant', ('cpus', 'memory', 'waited'))
+
+# how many processes can hold or wait for a budget at once
+MAX_HOLDERS = 256
+
+
+class _Budget(object):
+    """
+    The queueing shared by the budgets. Requests take a ticket and are
+    admitted in the order they're made, once they fit. Each process has an
+    entry in a shared table, by pid, with the ticket it is waiting on (or
+    -1) and the amounts it holds, so if a process dies, reclaim(pid) gives
+    those back and lets the requests queued behind it go ahead. That means
+    a process can only have one request waiting at a time.
+
+    Waiting requests check every interval seconds, rather than waiting on a
+    multiprocessing Condition, whose notify hangs for good once a process
+    dies while waiting on it.
+    """
+
+    # how many amounts each process's entry holds, after its pid and ticket
+    n_amounts = 0
+
+    def __init__(self, interval):
+        self.interval = interval
+
+        self._width = 2 + self.n_amounts
+        self._next_ticket = mp.Value('q', 0, lock=False)
+        self._serving = mp.Value('q', 0, lock=False)
+        self._lock = mp.Lock()
+        self._holders = mp.Array('q', self._empty() * MAX_HOLDERS, lock=False)
+
+    def _empty(self):
+        return [0, -1] + [0] * self.n_amounts
+
+    def _holder(self, pid):
+        """The offset of pid's entry in _holders, adding it if needed"""
+        free = None
+        for i in range(0, len(self._holders), self._width):
+            if self._holders[i] == pid:
+                return i
+            if free is None and self._holders[i] == 0:
+                free = i
+
+        if free is None:
+            raise RuntimeError('More than {} processes are using the'
+                               ' budget'.format(MAX_HOLDERS))
+
+        self._holders[free:free + self._width] = self._empty()
+        self._holders[free] = pid
+        return free
+
+    def _drop_if_idle(self, i):
+        if self._holders[i + 1:i + self._width] == self._empty()[1:]:
+            self._holders[i] = 0
+
+    def _skip_abandoned(self):
+        # tickets whose process died while waiting are never going to be used
+        waiting = set(self._holders[1::self._width])
+        while (self._serving.value < self._next_ticket.value
+               and self._serving.value not in waiting):
+            self._serving.value += 1
+
+    def _admit(self, fits, take):
+        """
+        Wait for our turn and until fits() is true, then call take(holder)
+        with our entry's offset, all under the lock. Returns what take
+        returned and the seconds spent waiting.
+        """
+        start_time = time.time()
+
+        with self._lock:
+            ticket = self._next_ticket.value
+            self._next_ticket.value += 1
+
+            holder = self._holder(os.getpid())
+            self._holders[holder + 1] = ticket
+
+        while True:
+            with self._lock:
+                self._skip_abandoned()
+
+                if ticket == self._serving.value and fits():
+                    taken = take(holder)
+                    self._serving.value += 1
+                    self._holders[holder + 1] = -1
+                    self._drop_if_idle(holder)
+                    break
+
+            time.sleep(self.interval)
+
+        return taken, time.time() - start_time
+
+    def _give_back(self, amounts):
+        pass
+
+    def reclaim(self, pid):
+        """
+        Give back everything a dead process held and drop its place in the
+        queue. Returns the amounts it held
+        """
+        with self._lock:
+            for i in range(0, len(self._holders), self._width):
+                if self._holders[i] != pid:
+                    continue
+
+                amounts = tuple(self._holders[i + 2:i + self._width])
+                self._give_back(amounts)
+                self._holders[i:i + self._width] = self._empty()
+
+                return amounts
+
+        return (0,) * self.n_amounts
+
+
+class DiskBudget(_Budget):
+    """
+    A budget of bytes shared between processes, used to bound how much data
+    one stage of a pipeline can stage ahead of the next. acquire blocks until
+    the request fits; a request is always admitted when nothing else is held,
+    so a single item larger than the budget can't stall the pipeline.
+
+    If path is given, a request also has to fit in the free space left on
+    that volume (less reserve bytes), in case the estimates are low or
+    something else is filling it. That is checked every interval seconds
+    while waiting.
+
+    The bytes travel with the items they were taken for, and are released by
+    whichever process finishes the item, so reclaim(pid) only drops a dead
+    process's place in the queue. What it was holding is released when its
+    item is retried or given up on.
+    """
+
+    def __init__(self, n_bytes, path=None, reserve=0, interval=1.0):
+        super(DiskBudget, self).__init__(interval)
+        self.n_bytes = n_bytes
+        self.path = path
+        self.reserve = reserve
+        self._used = mp.Value('q', 0, lock=False)
+
+    @property
+    def used(self):
+        return self._used.value
+
+    def _fits(self, n_bytes):
+        if self._used.value == 0:
+            return True
+
+        if self._used.value + n_bytes > self.n_bytes:
+            return False
+
+        return (self.path is None
+                or shutil.disk_usage(self.path).free - self.reserve >= n_bytes)
+
+    def acquire(self, n_bytes):
+        """Take n_bytes from the budget. Returns the seconds spent waiting"""
+
+        def take(holder):
+            self._used.value += n_bytes
+
+        return self._admit(lambda: self._fits(n_bytes), take)[1]
+
+    def release(self, n_bytes):
+        with self._lock:
+            self._used.value -= n_bytes
+
+
+def dir_size(path):
+    """Total size of the files under path, not following links"""
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for fn in file_names:
+            try:
+                st = os.lstat(os.path.join(dir_path, fn))
+            except FileNotFoundError:
+                # removed while we were looking
+                continue
+            if not stat.S_ISLNK(st.st_mode):
+                total += st.st_size
+
+    return total
+
+
+class DiskMonitor(object):
+    """
+    Tracks the largest size a directory reaches by checking it every
+    interval seconds in a background thread, until stop() is called.
+    """
+
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.peak = dir_size(path)
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, dir_size(self.path))
+
+    def stop(self):
+        """Stop checking and return the peak size in bytes"""
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, dir_size(self.path))
+        return self.peak
+
+
+def _read_cgroup(*path):
+    try:
+        with open(os.path.join(CGROUP_DIR, *path)) as fh:
+            return fh.read().split()
+    except (OSError, IOError):
+        return None
+
+
+def get_cgroup_limits():
+    """
+    The CPU and memory (bytes) limits of this container from cgroups v2 or
+    v1. Either is None if there is no limit.
+    """
+    cpus = memory = None
+
+    cpu_max = _read_cgroup('cpu.max')
+    if cpu_max is not None:
+        if cpu_max[0] != 'max':
+            cpus = int(cpu_max[0]) / int(cpu_max[1])
+    else:
+        quota = _read_cgroup('cpu', 'cpu.cfs_quota_us')
+        period = _read_cgroup('cpu', 'cpu.cfs_period_us')
+        if quota and period and int(quota[0]) > 0:
+            cpus = int(quota[0]) / int(period[0])
+
+    memory_max = (_read_cgroup('memory.max')
+                  or _read_cgroup('memory', 'memory.limit_in_bytes'))
+    if memory_max and memory_max[0] != 'max':
+        if int(memory_max[0]) < CGROUP_NO_LIMIT:
+            memory = int(memory_max[0])
+
+    if cpus is not None:
+        cpus = max(int(cpus), 1)
+
+    return cpus, memory
+
+
+def get_resources(requirements=None):
+    """
+    The CPUs and memory (bytes) this job can use: the cgroup limits if there
+    are any, otherwise the job's requirements (vcpus, memory in MB), capped
+    by what the host actually has.
+    """
+    host_cpus = len(os.sched_getaffinity(0))
+    host_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    cpus, memory = get_cgroup_limits()
+
+    if cpus is None:
+        cpus = requirements.vcpus if requirements else host_cpus
+    if memory is None:
+        memory = requirements.memory * 1024 ** 2 if requirements else host_memory
+
+    return min(cpus, host_cpus), min(memory, host_memory)
+
+
+class ResourceBudget(_Budget):
+    """
+    CPUs and memory shared between the stages of a pipeline. Each stage asks
+    for up to some number of threads and bytes and gets whatever is free
+    (but at least its minimum), so a stage that starts while the machine is
+    quiet runs wider, and capacity returns to the pool as stages finish.
+
+    Requests are admitted in the order they're made, so a large request
+    (e.g. STAR) isn't starved by a stream of small ones. As with DiskBudget,
+    a request is always admitted when nothing else is held. A grant is
+    released by the process that acquired it, so if that process dies,
+    reclaim(pid) gives back its (cpus, memory).
+
+    with budget.grant(4, 8 * 1024 ** 3, min_cpus=1) as grant:
+        ... run with grant.cpus threads and grant.memory bytes ...
+    """
+
+    n_amounts = 2
+
+    def __init__(self, cpus, memory, interval=0.5):
+        super(ResourceBudget, self).__init__(interval)
+        self.cpus = cpus
+        self.memory = memory
+
+        self._used_cpus = mp.Value('i', 0, lock=False)
+        self._used_memory = mp.Value('q', 0, lock=False)
+
+    @property
+    def used(self):
+        return self._used_cpus.value, self._used_memory.value
+
+    def _fits(self, min_cpus, min_memory):
+        if self._used_cpus.value == 0 and self._used_memory.value == 0:
+            return True
+
+        return (self._used_cpus.value + min_cpus <= self.cpus
+                and self._used_memory.value + min_memory <= self.memory)
+
+    def acquire(self, cpus, memory, min_cpus=None, min_memory=None):
+        """
+        Ask for up to cpus and memory bytes, waiting until at least min_cpus
+        and min_memory (by default, the whole request) are free. Returns a
+        Grant of what was given and the seconds spent waiting.
+        """
+        if min_cpus is None:
+            min_cpus = cpus
+        if min_memory is None:
+            min_memory = memory
+
+        def take(holder):
+            granted_cpus = max(min(cpus, self.cpus - self._used_cpus.value),
+                               min_cpus)
+            granted_memory = max(
+                    min(memory, self.memory - self._used_memory.value),
+                    min_memory
+            )
+
+            self._used_cpus.value += granted_cpus
+            self._used_memory.value += granted_memory
+
+            self._holders[holder + 2] += granted_cpus
+            self._holders[holder + 3] += granted_memory
+
+            return granted_cpus, granted_memory
+
+        (granted_cpus, granted_memory), waited = self._admit(
+                lambda: self._fits(min_cpus, min_memory), take
+        )
+
+        return Grant(granted_cpus, granted_memory, waited)
+
+    def release(self, grant):
+        with self._lock:
+            self._used_cpus.value -= grant.cpus
+            self._used_memory.value -= grant.memory
+
+            holder = self._holder(os.getpid())
+            self._holders[holder + 2] -= grant.cpus
+            self._holders[holder + 3] -= grant.memory
+            self._drop_if_idle(holder)
+
+    def _give_back(self, amounts):
+        cpus, memory = amounts
+        self._used_cpus.value -= cpus
+        self._used_memory.value -= memory
+
+    @contextlib.contextmanager
+    def grant(self, cpus, memory, min_cpus=None, min_memory=None):
+        grant = self.acquire(cpus, memory, min_cpus, min_memory)
+        try:
+            yield grant
+        finally:
+            self.release(grant)
+
+
+class PartTracker(object):
+    """
+    Tracks items that are split into parts handled by different processes
+    (e.g. a sample aligned to several genomes), so that whichever process
+    finishes the last part can clean up after the whole item. Needs an
+    mp.Manager to share the counts.
+    """
+
+    def __init__(self, manager):
+        self._remaining = manager.dict()
+        self._failed = manager.dict()
+        self._lock = mp.Lock()
+
+    def start(self, item, n_parts):
+        with self._lock:
+            self._remaining[item] = n_parts
+            self._failed[item] = False
+
+    def finish(self, item, failed=False):
+        """
+        Mark one part of item finished. Returns None while other parts are
+        still going, otherwise whether any part of the item failed.
+        """
+        with self._lock:
+            self._remaining[item] -= 1
+            self._failed[item] = self._failed[item] or failed
+
+            if self._remaining[item] > 0:
+                return None
+
+            del self._remaining[item]
+            return self._failed.pop(item)
+
+
+class _WorkerQueue(object):
+    """
+    The pool's queue as one worker sees it. get records the item the worker
+    is holding and counts the one before as done. A replacement worker gets
+    the item its predecessor died with first.
+    """
+
+    def __init__(self, queue, in_flight, stats, slot, retry=None):
+        self.queue = queue
+        self.in_flight = in_flight
+        self.stats = stats
+        self.slot = slot
+
+        self._retry = retry
+        self._attempt = 0
+        self._started = None
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def get(self):
+        stats = dict(self.stats[self.slot])
+        start_time = time.time()
+
+        if self._started is not None:
+            stats['items'] += 1
+            stats['busy'] += start_time - self._started
+
+            # the last item is done, so dying while we wait doesn't repeat it
+            self.in_flight[self.slot] = None
+
+        if self._retry is not None:
+            self._attempt, item = self._retry
+            self._retry = None
+        else:
+            self._attempt, item = 0, self.queue.get()
+
+        self._started = time.time()
+        stats['idle'] += self._started - start_time
+        self.stats[self.slot] = stats
+        self.in_flight[self.slot] = (self._attempt, item)
+
+        return item
+
+    def update(self, item):
+        """
+        Replace the item this worker is holding with what's left of it (or
+        None if nothing is), so that a retry after a crash doesn't repeat
+        work that was passed on.
+        """
+        self.in_flight[self.slot] = (self._attempt, item)
+
+
+class WorkerPool(object):
+    """
+    n_workers processes running target(queue, *args), where target reads
+    items from queue until it gets 'STOP', like the pipeline stages do.
+
+    A thread watches the workers. If one dies (killed for memory, a
+    segfault or an exception), a replacement is started in its place, and
+    the item it was holding is given to the replacement to try again, up to
+    retries times. After that, on_failure(item) is called in this process
+    so the item can be cleaned up. stop() sends the sentinels, waits for the
+    workers to finish and logs how much each of them did. Items are named
+    in the log by describe(item).
+
+    Whatever a dead worker held (or was waiting for) from the budgets, a
+    list of ResourceBudgets and DiskBudgets, is given back before it is
+    replaced.
+    """
+
+    def __init__(self, name, target, args, queue, n_workers, manager,
+                 log_queue, retries=1, on_failure=None, describe=str,
+                 budgets=(), interval=5.0):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.queue = queue
+        self.n_workers = n_workers
+        self.log_queue = log_queue
+        self.retries = retries
+        self.on_failure = on_failure
+        self.describe = describe
+        self.budgets = budgets
+        self.interval = interval
+
+        self.restarts = [0] * n_workers
+
+        self._in_flight = manager.dict()
+        self._stats = manager.dict()
+        self._procs = [None] * n_workers
+        self._finished = [False] * n_workers
+        self._thread = None
+
+    def _spawn(self, slot, retry=None):
+        self._in_flight[slot] = None
+        worker_queue = _WorkerQueue(self.queue, self._in_flight, self._stats,
+                                    slot, retry)
+        self._procs[slot] = mp.Process(target=self.target,
+                                       args=(worker_queue,) + tuple(self.args))
+        self._procs[slot].start()
+
+    def start(self):
+        for slot in range(self.n_workers):
+            self._stats[slot] = {'items': 0, 'busy': 0.0, 'idle': 0.0}
+            self._spawn(slot)
+
+        self._thread = threading.Thread(target=self._supervise, daemon=True)
+        self._thread.start()
+
+    def _recover(self, slot):
+        proc = self._procs[slot]
+        held = self._in_flight[slot]
+        stopping = held is not None and held[1] == 'STOP'
+
+        if not stopping:
+            self.log_queue.put(('{} worker {} died (exit code {})'.format(
+                    self.name, slot, proc.exitcode), logging.INFO))
+
+        for budget in self.budgets:
+            # only ResourceBudgets have anything held by the process itself
+            returned = budget.reclaim(proc.pid)
+            if any(returned):
+                cpus, memory = returned
+                self.log_queue.put((
+                    'Returned {} CPUs and {:.1f} GB held by {} worker {}'.format(
+                            cpus, memory / 1024 ** 3, self.name, slot),
+                    logging.INFO
+                ))
+
+        if stopping:
+            # it was on its way out anyway
+            self._finished[slot] = True
+            return
+
+        retry = None
+        if held is not None and held[1] is not None:
+            attempt, item = held
+            if attempt < self.retries:
+                self.log_queue.put(('Retrying {} (retry {} of {})'.format(
+                        self.describe(item), attempt + 1, self.retries),
+                        logging.INFO))
+                retry = (attempt + 1, item)
+            else:
+                self.log_queue.put(('Giving up on {} after {} retries'.format(
+                        self.describe(item), self.retries), logging.INFO))
+                if self.on_failure is not None:
+                    self.on_failure(item)
+
+        self.restarts[slot] += 1
+        self._spawn(slot, retry)
+
+    def _supervise(self):
+        while not all(self._finished):
+            for slot, proc in enumerate(self._procs):
+                if self._finished[slot] or proc.is_alive():
+                    continue
+
+                proc.join()
+                if proc.exitcode == 0:
+                    self._finished[slot] = True
+                else:
+                    self._recover(slot)
+
+            time.sleep(self.interval)
+
+    def stop(self):
+        """Send every worker a sentinel and wait for them to finish"""
+        for i in range(self.n_workers):
+            self.queue.put('STOP')
+
+        self._thread.join()
+
+        for slot in range(self.n_workers):
+            stats = self._stats[slot]
+            self.log_queue.put((
+                '{} worker {}: {} items, {:.1f}s busy ({:.2f} items/hour),'
+                ' {:.1f}s idle, {} restarts'.format(
+                        self.name, slot, stats['items'], stats['busy'],
+                        3600 * stats['items'] / max(stats['busy'], 1e-9),
+                        stats['idle'], self.restarts[slot]),
+                logging.INFO
+            ))
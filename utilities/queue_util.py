@@ -0,0 +1,234 @@
+import fcntl
+import json
+import os
+import socket
+import tempfile
+import time
+
+import boto3
+import botocore.exceptions
+
+import utilities.s3_util as s3u
+
+
+class S3LeaseStore(object):
+    """
+    Lease objects stored under an S3 prefix. Uses conditional writes
+    (If-None-Match / If-Match) so that creating or taking over a lease is
+    atomic across jobs.
+    """
+
+    def __init__(self, s3_path):
+        self.bucket, self.prefix = s3u.s3_bucket_and_key(s3_path.rstrip('/'))
+        self._client = None
+        self._pid = None
+
+    @property
+    def client(self):
+        # one client per process, since the store is shared with workers
+        if self._pid != os.getpid():
+            self._client = boto3.client('s3')
+            self._pid = os.getpid()
+        return self._client
+
+    def _key(self, name):
+        return '{}/{}'.format(self.prefix, name)
+
+    def _conditional_put(self, name, body, **kwargs):
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(name),
+                                   Body=body.encode(), **kwargs)
+            return True
+        except botocore.exceptions.ClientError as exc:
+            # an If-Match on a key that has been deleted gets a 404
+            code = exc.response.get('Error', {}).get('Code')
+            if code in ('PreconditionFailed', 'ConditionalRequestConflict',
+                        'NoSuchKey'):
+                return False
+            raise
+
+    def create(self, name, body):
+        """Write name only if it doesn't exist. Returns True on success"""
+        return self._conditional_put(name, body, IfNoneMatch='*')
+
+    def read(self, name):
+        """Returns (body, version) or None if name doesn't exist"""
+        try:
+            response = self.client.get_object(Bucket=self.bucket,
+                                              Key=self._key(name))
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+        return response['Body'].read().decode(), response['ETag']
+
+    def replace(self, name, body, version):
+        """Overwrite name only if it is still at version"""
+        return self._conditional_put(name, body, IfMatch=version)
+
+    def put(self, name, body):
+        """Write name whether or not it exists"""
+        self.client.put_object(Bucket=self.bucket, Key=self._key(name),
+                               Body=body.encode())
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(name))
+            return True
+        except botocore.exceptions.ClientError:
+            return False
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(name))
+
+
+class LocalLeaseStore(object):
+    """
+    Lease files in a local (or shared) directory, with the same interface as
+    S3LeaseStore. Files are created with a hard link, which fails if the name
+    exists, and replaced under a lock.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _write_tmp(self, path, body):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(body)
+        return tmp_path
+
+    def create(self, name, body):
+        path = self._path(name)
+        tmp_path = self._write_tmp(path, body)
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def read(self, name):
+        try:
+            with open(self._path(name)) as fh:
+                body = fh.read()
+        except FileNotFoundError:
+            return None
+
+        return body, body
+
+    def replace(self, name, body, version):
+        path = self._path(name)
+        with open(os.path.join(self.root, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            current = self.read(name)
+            if current is None or current[1] != version:
+                return False
+
+            os.replace(self._write_tmp(path, body), path)
+            return True
+
+    def put(self, name, body):
+        path = self._path(name)
+        os.replace(self._write_tmp(path, body), path)
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+
+class LeaseQueue(object):
+    """
+    A list of work items shared between jobs. A job claims an item by
+    creating a lease that expires after lease_seconds unless it is renewed,
+    and marks it done (or failed) when finished. Expired leases can be taken
+    over by any other job, so work held by a dead job is picked up again.
+
+    Items are names like 'input_dir/sample_name'. Under the root there are
+        leases/<item>  - the current owner and expiry time
+        done/<item>    - finished items
+        failed/<item>  - items that failed and shouldn't be retried
+
+    Expiry uses each job's clock, so leases should be much longer than any
+    expected clock skew.
+    """
+
+    def __init__(self, path, owner=None, lease_seconds=3600):
+        if path.startswith('s3://'):
+            self.store = S3LeaseStore(path)
+        else:
+            self.store = LocalLeaseStore(path)
+
+        self.owner = owner or '{}:{}'.format(
+                os.environ.get('AWS_BATCH_JOB_ID', socket.gethostname()),
+                os.getpid()
+        )
+        self.lease_seconds = lease_seconds
+
+    def _lease(self):
+        return json.dumps({'owner': self.owner,
+                           'expires': time.time() + self.lease_seconds})
+
+    def is_finished(self, item):
+        return (self.store.exists('done/{}'.format(item))
+                or self.store.exists('failed/{}'.format(item)))
+
+    def claim(self, item):
+        """Try to take a lease on item. Returns True if we now hold it"""
+        lease_name = 'leases/{}'.format(item)
+
+        # the lease may disappear between create and read if another job
+        # finishes the item, in which case check again
+        for i in range(2):
+            if self.is_finished(item):
+                return False
+
+            if self.store.create(lease_name, self._lease()):
+                return True
+
+            current = self.store.read(lease_name)
+            if current is not None:
+                body, version = current
+                if json.loads(body)['expires'] > time.time():
+                    return False
+
+                # expired, try to take it over
+                return self.store.replace(lease_name, self._lease(), version)
+
+        return False
+
+    def renew(self, item):
+        """Extend our lease on item. Returns False if we no longer hold it"""
+        lease_name = 'leases/{}'.format(item)
+
+        current = self.store.read(lease_name)
+        if current is None:
+            return False
+
+        body, version = current
+        if json.loads(body)['owner'] != self.owner:
+            return False
+
+        return self.store.replace(lease_name, self._lease(), version)
+
+    def release(self, item):
+        """Give up a lease without finishing the item"""
+        self.store.delete('leases/{}'.format(item))
+
+    def complete(self, item, failed=False):
+        """Mark item done (or failed) and drop its lease"""
+        marker = 'failed/{}' if failed else 'done/{}'
+        self.store.create(marker.format(item),
+                          json.dumps({'owner': self.owner, 'time': time.time()}))
+        self.release(item)
@@ -0,0 +1,447 @@
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+import boto3
+import botocore.config
+import botocore.exceptions
+
+import concurrent.futures as cf
+
+from collections import deque
+
+import utilities.pipeline_util as ut_pipe
+
+
+PIGZ = 'pigz'
+SAMTOOLS = 'samtools'
+
+PART_SIZE = 64 * 1024 ** 2
+N_THREADS = 8
+FETCH_RETRY = 5
+
+CACHE_DIR = os.path.join('/mnt', 'reference_cache')
+CACHE_SIZE = 100 * 1024 ** 3
+
+FASTA_EXTENSIONS = ('.fa', '.fasta', '.fna')
+
+
+class RangedReader(object):
+    """
+    A read-only file object for an S3 object, fetched as concurrent ranged
+    GETs of part_size bytes and handed back in order. At most readahead parts
+    are in flight (or buffered) at a time.
+    """
+
+    def __init__(self, client, bucket, key, size, part_size=PART_SIZE,
+                 n_threads=N_THREADS, readahead=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.part_size = part_size
+        self.readahead = readahead or 2 * n_threads
+
+        self._executor = cf.ThreadPoolExecutor(max_workers=n_threads)
+        self._parts = deque()
+        self._next_start = 0
+
+        self._buffer = b''
+        self._offset = 0
+
+        self.start_time = time.time()
+        self.first_byte_time = None
+        self.fetch_end_time = None
+
+        self._fill()
+
+    def _fetch(self, start, end):
+        for i in range(FETCH_RETRY):
+            try:
+                response = self.client.get_object(
+                        Bucket=self.bucket, Key=self.key,
+                        Range='bytes={}-{}'.format(start, end)
+                )
+                data = response['Body'].read()
+                break
+            except (botocore.exceptions.BotoCoreError,
+                    botocore.exceptions.ClientError):
+                if i == FETCH_RETRY - 1:
+                    raise
+                time.sleep(2 ** i)
+
+        if self.first_byte_time is None:
+            self.first_byte_time = time.time()
+        self.fetch_end_time = time.time()
+
+        return data
+
+    def _fill(self):
+        while (len(self._parts) < self.readahead
+               and self._next_start < self.size):
+            end = min(self._next_start + self.part_size, self.size) - 1
+            self._parts.append(
+                    self._executor.submit(self._fetch, self._next_start, end)
+            )
+            self._next_start = end + 1
+
+    def readable(self):
+        return True
+
+    def read(self, n=-1):
+        chunks = []
+
+        while n != 0:
+            if self._offset == len(self._buffer):
+                if not self._parts:
+                    break
+
+                self._buffer = self._parts.popleft().result()
+                self._offset = 0
+                self._fill()
+
+            if n < 0:
+                end = len(self._buffer)
+            else:
+                end = min(self._offset + n, len(self._buffer))
+                n -= end - self._offset
+
+            chunks.append(self._buffer[self._offset:end])
+            self._offset = end
+
+        return b''.join(chunks)
+
+    def close(self):
+        for f in self._parts:
+            f.cancel()
+        self._executor.shutdown(wait=True)
+
+
+def _pump(reader, pipe, chunk_size=PART_SIZE):
+    """Copy everything from reader into pipe, then close it"""
+    try:
+        for chunk in iter(lambda: reader.read(chunk_size), b''):
+            pipe.write(chunk)
+    except BrokenPipeError:
+        pass
+    finally:
+        pipe.close()
+
+
+def stage_reference(bucket, key, dest_dir, logger=None,
+                    n_threads=N_THREADS, part_size=PART_SIZE):
+    """
+    Download and extract a reference tarball from S3 into dest_dir as a
+    single stream: ranged GETs are fetched concurrently, decompressed (with
+    pigz when it's available) and extracted while the download continues.
+    Returns a dict of timings in seconds for each phase.
+    """
+    client = boto3.client(
+            's3', config=botocore.config.Config(max_pool_connections=n_threads)
+    )
+    size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+    if logger:
+        logger.info('Staging s3://{}/{} ({:.1f} GB) into {}'.format(
+                bucket, key, size / 1e9, dest_dir)
+        )
+
+    os.makedirs(dest_dir, exist_ok=True)
+
+    compressed = key.endswith(('.tgz', '.gz'))
+    reader = RangedReader(client, bucket, key, size,
+                          part_size=part_size, n_threads=n_threads)
+
+    try:
+        if compressed and shutil.which(PIGZ):
+            proc = subprocess.Popen([PIGZ, '-dc'], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            pump = threading.Thread(target=_pump, args=(reader, proc.stdin))
+            pump.start()
+
+            try:
+                with tarfile.open(fileobj=proc.stdout, mode='r|') as tf:
+                    tf.extractall(path=dest_dir)
+            except:
+                proc.kill()
+                raise
+            finally:
+                pump.join()
+            proc.stdout.close()
+            if proc.wait():
+                raise subprocess.CalledProcessError(proc.returncode, PIGZ)
+        else:
+            mode = 'r|gz' if compressed else 'r|'
+            with tarfile.open(fileobj=reader, mode=mode) as tf:
+                tf.extractall(path=dest_dir)
+    finally:
+        reader.close()
+
+    end_time = time.time()
+    fetch_end_time = min(reader.fetch_end_time or end_time, end_time)
+
+    timings = {
+        'bytes': size,
+        'first_byte': (reader.first_byte_time or end_time) - reader.start_time,
+        'download': fetch_end_time - reader.start_time,
+        'extract_after_download': end_time - fetch_end_time,
+        'total': end_time - reader.start_time
+    }
+
+    if logger:
+        logger.info(
+                'Staged {}: first byte {first_byte:.1f}s,'
+                ' download {download:.1f}s ({rate:.1f} MB/s),'
+                ' extraction finished {extract_after_download:.1f}s later,'
+                ' total {total:.1f}s'.format(
+                        key, rate=size / 1e6 / max(timings['download'], 1e-6),
+                        **timings
+                )
+        )
+
+    return timings
+
+
+class ReferenceCache(object):
+    """
+    A host-level cache of extracted references, shared by all the jobs on an
+    instance. Entries are keyed by S3 key and ETag, so a new upload of a
+    reference gets a new entry.
+
+    Each entry has two lock files. Jobs using an entry hold its lock shared,
+    so the kernel keeps the reference count and releases it if a job dies,
+    and eviction only removes entries it can lock exclusively. A job that
+    finds the entry missing also takes its fill lock, so concurrent jobs
+    wait for a single download, while jobs that find it there go straight
+    on. Entries are extracted to a temporary directory and renamed into
+    place, and the least recently used entries that aren't in use are
+    evicted when the cache grows past max_bytes.
+
+    cache = ReferenceCache('/mnt/reference_cache')
+    with cache.reference('czbiohub-reference', 'hg38-plus.tgz') as path:
+        ...
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_SIZE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.client = boto3.client('s3')
+
+        self._fds = {}
+
+        os.makedirs(self.root, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _cache_lock(self):
+        """Serializes eviction"""
+        with open(os.path.join(self.root, '.cache.lock'), 'w') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            yield
+
+    def _entry_name(self, bucket, key, etag):
+        digest = hashlib.sha1(
+                '{}/{}:{}'.format(bucket, key, etag).encode()
+        ).hexdigest()
+        return '{}-{}'.format(os.path.basename(key).split('.')[0], digest[:16])
+
+    def acquire(self, bucket, key, logger=None):
+        """
+        Return the path of the extracted reference, downloading it first if
+        it isn't cached. The entry stays in use until release(path).
+        """
+        etag = self.client.head_object(Bucket=bucket, Key=key)['ETag']
+        entry_dir = os.path.join(self.root, self._entry_name(bucket, key, etag))
+
+        fd = os.open(entry_dir + '.lock', os.O_RDWR | os.O_CREAT)
+        try:
+            # in use from here on. This only waits if the entry is being
+            # evicted, in which case it's gone once we have the lock
+            fcntl.flock(fd, fcntl.LOCK_SH)
+
+            if not os.path.isdir(entry_dir):
+                self._populate(bucket, key, etag, entry_dir, logger)
+            elif logger:
+                logger.info('Using cached s3://{}/{} from {}'.format(
+                        bucket, key, entry_dir)
+                )
+        except:
+            os.close(fd)
+            raise
+
+        self._fds[entry_dir] = fd
+        os.utime(os.path.join(entry_dir, '.cache.json'))
+
+        self.evict()
+
+        return entry_dir
+
+    def _populate(self, bucket, key, etag, entry_dir, logger=None):
+        """Download an entry, unless someone else does while we wait"""
+        with open(entry_dir + '.fill.lock', 'w') as fill_lock:
+            fcntl.flock(fill_lock, fcntl.LOCK_EX)
+
+            if os.path.isdir(entry_dir):
+                if logger:
+                    logger.info('Using s3://{}/{} cached by another job in'
+                                ' {}'.format(bucket, key, entry_dir))
+                return
+
+            if logger:
+                logger.info('Caching s3://{}/{} in {}'.format(
+                        bucket, key, entry_dir)
+                )
+
+            tmp_dir = tempfile.mkdtemp(
+                    dir=self.root,
+                    prefix='{}.tmp'.format(os.path.basename(entry_dir))
+            )
+            try:
+                stage_reference(bucket, key, tmp_dir, logger)
+                with open(os.path.join(tmp_dir, '.cache.json'), 'w') as fh:
+                    json.dump({'bucket': bucket, 'key': key, 'etag': etag,
+                               'bytes': ut_pipe.dir_size(tmp_dir)}, fh)
+                os.rename(tmp_dir, entry_dir)
+            except:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+
+    def release(self, entry_dir):
+        """Stop using an entry, so it can be evicted"""
+        os.utime(os.path.join(entry_dir, '.cache.json'))
+        os.close(self._fds.pop(entry_dir))
+
+    @contextlib.contextmanager
+    def reference(self, bucket, key, logger=None):
+        entry_dir = self.acquire(bucket, key, logger)
+        try:
+            yield entry_dir
+        finally:
+            self.release(entry_dir)
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used entries that aren't in use until the
+        cache fits in max_bytes, along with abandoned partial downloads.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        with self._cache_lock():
+            entries = []
+            for meta_file in glob.glob(os.path.join(self.root, '*',
+                                                    '.cache.json')):
+                # a download that is about to be renamed into place. Its
+                # entry's lock is what protects it, so it's left for below
+                if '.tmp' in os.path.basename(os.path.dirname(meta_file)):
+                    continue
+
+                with open(meta_file) as fh:
+                    meta = json.load(fh)
+                entries.append((os.path.getmtime(meta_file),
+                                os.path.dirname(meta_file), meta['bytes']))
+
+            total = sum(entry[2] for entry in entries)
+
+            for tmp_dir in glob.glob(os.path.join(self.root, '*.tmp*', '')):
+                tmp_dir = tmp_dir.rstrip(os.sep)
+                self._remove_unused(tmp_dir, tmp_dir.split('.tmp')[0])
+
+            for _, entry_dir, n_bytes in sorted(entries):
+                if total <= max_bytes:
+                    break
+                if self._remove_unused(entry_dir, entry_dir):
+                    total -= n_bytes
+
+    def _remove_unused(self, path, entry_dir):
+        """Remove path if nobody holds the lock for entry_dir"""
+        fd = os.open(entry_dir + '.lock', os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # in use, or being populated
+            return False
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+            return True
+        finally:
+            os.close(fd)
+
+
+def find_fasta(ref_dir):
+    """The reference FASTA in ref_dir"""
+    fastas = sorted(fn for fn in os.listdir(ref_dir)
+                    if fn.endswith(FASTA_EXTENSIONS))
+    if not fastas:
+        raise ValueError('No FASTA file in {}'.format(ref_dir))
+
+    return os.path.join(ref_dir, fastas[0])
+
+
+def _replace_atomic(path, write):
+    """Call write on a temporary file next to path, then move it into place"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def fasta_md5(fasta, logger=None):
+    """
+    The MD5 of a FASTA file, saved next to it (e.g. in the reference cache)
+    so it is only computed once per reference.
+    """
+    md5_path = fasta + '.md5'
+
+    if (os.path.exists(md5_path)
+            and os.path.getmtime(md5_path) >= os.path.getmtime(fasta)):
+        with open(md5_path) as fh:
+            return fh.read().strip()
+
+    if logger:
+        logger.info('Computing MD5 of {}'.format(fasta))
+
+    md5 = hashlib.md5()
+    with open(fasta, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(PART_SIZE), b''):
+            md5.update(chunk)
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as fh:
+            fh.write(md5.hexdigest() + '\n')
+
+    _replace_atomic(md5_path, write)
+    return md5.hexdigest()
+
+
+def index_fasta(fasta, logger=None):
+    """
+    Make the samtools .fai index for fasta if it doesn't have one, which
+    writing CRAM needs. Jobs sharing the reference can race to build it,
+    so it is written elsewhere and moved into place.
+    """
+    fai_path = fasta + '.fai'
+
+    if (os.path.exists(fai_path)
+            and os.path.getmtime(fai_path) >= os.path.getmtime(fasta)):
+        return fai_path
+
+    if logger:
+        logger.info('Indexing {}'.format(fasta))
+
+    _replace_atomic(fai_path, lambda tmp_path: subprocess.check_call(
+            [SAMTOOLS, 'faidx', '--fai-idx', tmp_path, fasta]
+    ))
+    return fai_path
@@ -1,12 +1,22 @@
 import csv
+import datetime
+import gzip
+import json
 import os
+import sqlite3
+import threading
+import time
+
 import boto3
+import boto3.exceptions
+import boto3.s3.transfer
+import botocore.config
 import botocore.exceptions
 
+import concurrent.futures as cf
 import itertools
-import multiprocessing
 
-from collections import defaultdict, Counter
+from collections import defaultdict, namedtuple, Counter
 
 
 # cribbed from https://github.com/chanzuckerberg/s3mi/blob/master/scripts/s3mi
@@ -18,8 +28,11 @@ def s3_bucket_and_key(s3_uri):
 
 def prefix_gen(bucket, prefix, fn=None):
     """Generic generator of fn(result) from an S3 paginator"""
+    if fn is None:
+        fn = lambda r: r
+
     client = boto3.client('s3')
-    paginator = client.get_paginator('list_objects')
+    paginator = client.get_paginator('list_objects_v2')
 
     response_iterator = paginator.paginate(
             Bucket=bucket, Prefix=prefix
@@ -30,128 +43,1110 @@ def prefix_gen(bucket, prefix, fn=None):
             yield from (fn(r) for r in result['Contents'])
 
 
-def get_files(bucket='czbiohub-seqbot', prefix=None):
+# S3 lists keys in UTF-8 byte order, which is code point order. Ranges
+# without an upper bound are split as if keys were ASCII, which only makes
+# the split less even if they aren't
+_KEY_CEILING = chr(0x80)
+
+
+def _midpoint(low, high):
+    """A key between low and high to split a listing at, or None"""
+    i = 0
+    while i < min(len(low), len(high)) and low[i] == high[i]:
+        i += 1
+
+    low_c = ord(low[i]) if i < len(low) else 0
+    high_c = ord(high[i])
+
+    if high_c - low_c >= 2:
+        return low[:i] + chr((low_c + high_c) // 2)
+
+    if i < len(low):
+        # the boundary is too narrow, so split what's left after low instead
+        next_c = ord(low[i + 1]) if i + 1 < len(low) else 0
+        if ord(_KEY_CEILING) - next_c >= 2:
+            return low[:i + 1] + chr((next_c + ord(_KEY_CEILING)) // 2)
+
+    return None
+
+
+def _list_range(executor, client, bucket, prefix, fn, low=None, high=None):
+    """
+    List one page of the keys under prefix after low, up to and including
+    high. If there are more, the rest of the range is split in two and
+    listed concurrently. Returns fn(result) for the page, and the futures
+    for the rest, in key order.
+    """
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if low is not None:
+        kwargs['StartAfter'] = low
+
+    result = client.list_objects_v2(**kwargs)
+    contents = [r for r in result.get('Contents', [])
+                if high is None or r['Key'] <= high]
+
+    rest = []
+    if result.get('IsTruncated') and len(contents) == len(result['Contents']):
+        last = contents[-1]['Key']
+        if high is None or last < high:
+            # every key starts with prefix, so that's where to split
+            mid = _midpoint(last, prefix + _KEY_CEILING if high is None
+                            else high)
+            bounds = [last, high] if mid is None else [last, mid, high]
+            rest = [executor.submit(_list_range, executor, client, bucket,
+                                    prefix, fn, start, end)
+                    for start, end in zip(bounds[:-1], bounds[1:])]
+
+    return [fn(r) for r in contents], rest
+
+
+def _range_results(future):
+    """Everything listed by a _list_range future and the ones it started"""
+    output, rest = future.result()
+    yield from output
+    for f in rest:
+        yield from _range_results(f)
+
+
+def _list_level(client, bucket, prefix, delimiter, min_shards):
+    """
+    List the objects and CommonPrefixes directly below prefix. Returns None
+    if the first page is full but has fewer than min_shards CommonPrefixes,
+    in which case the prefix is better listed by key ranges.
+    """
+    paginator = client.get_paginator('list_objects_v2')
+
+    objects = []
+    prefixes = []
+    for result in paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                     Delimiter=delimiter):
+        objects.extend(result.get('Contents', []))
+        prefixes.extend(cp['Prefix'] for cp in result.get('CommonPrefixes', []))
+
+        if result.get('IsTruncated') and len(prefixes) < min_shards:
+            return None
+
+    return objects, prefixes
+
+
+def _shard_prefix(executor, client, bucket, prefix, delimiter,
+                  min_shards, max_depth):
+    """
+    Expand prefix one delimiter level at a time until there are at least
+    min_shards sub-prefixes (or max_depth levels). Returns the objects found
+    along the way and the sub-prefixes that still need to be listed. Levels
+    that are mostly objects are left as sub-prefixes, without listing them
+    all here.
+    """
+    objects = []
+    prefixes = [prefix]
+
+    for depth in range(max_depth):
+        levels = executor.map(
+                lambda p: _list_level(client, bucket, p, delimiter, min_shards),
+                prefixes
+        )
+
+        flat = []
+        sub_prefixes = []
+        for level_prefix, level in zip(prefixes, levels):
+            if level is None:
+                flat.append(level_prefix)
+            else:
+                objects.extend(level[0])
+                sub_prefixes.extend(level[1])
+
+        prefixes = flat + sub_prefixes
+        if flat or len(prefixes) >= min_shards or not prefixes:
+            break
+
+    return objects, prefixes
+
+
+def parallel_prefix_gen(bucket, prefix, fn=None, n_threads=16,
+                        delimiter='/', max_depth=3, cache=None):
+    """
+    Generator of fn(result) like prefix_gen, but fans the listing out over
+    the CommonPrefixes under prefix, and over ranges of keys where there are
+    lots of keys at one level, and lists them concurrently. Results are
+    yielded in the same (key) order as prefix_gen.
+
+    If cache is a ListingCache, the listing is answered from it instead.
+    """
+    if fn is None:
+        fn = lambda r: r
+
+    if cache is not None:
+        yield from cache.listing(bucket, prefix, fn)
+        return
+
+    client = boto3.client(
+            's3', config=botocore.config.Config(max_pool_connections=n_threads)
+    )
+
+    with cf.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        objects, prefixes = _shard_prefix(executor, client, bucket, prefix,
+                                          delimiter, n_threads, max_depth)
+
+        # a key sorts before everything under a CommonPrefix exactly when it
+        # sorts before the prefix itself, so the units can be ordered as-is
+        units = [(r['Key'], r, None) for r in objects]
+        units.extend(
+                (p, None, executor.submit(_list_range, executor, client,
+                                          bucket, p, fn))
+                for p in prefixes
+        )
+        units.sort(key=lambda u: u[0])
+
+        for _, r, f in units:
+            if f is None:
+                yield fn(r)
+            else:
+                yield from _range_results(f)
+
+
+def get_files(bucket='czbiohub-seqbot', prefix=None, cache=None):
     """Generator of keys for a given S3 prefix"""
-    yield from prefix_gen(bucket, prefix, lambda r: r['Key'])
+    yield from parallel_prefix_gen(bucket, prefix, lambda r: r['Key'],
+                                   cache=cache)
 
 
-def get_size(bucket='czbiohub-seqbot', prefix=None):
+def get_size(bucket='czbiohub-seqbot', prefix=None, cache=None):
     """Generator of (key,size) for a given S3 prefix"""
-    yield from prefix_gen(bucket, prefix, lambda r: (r['Key'], r['Size']))
+    yield from parallel_prefix_gen(bucket, prefix,
+                                   lambda r: (r['Key'], r['Size']),
+                                   cache=cache)
 
 
-def get_status(file_list, bucket_name='czbiohub-seqbot'):
-    """Print the storage/restore status for a list of keys"""
-    s3r = boto3.resource('s3')
+# set LISTING_CACHE_PATH to keep the cache somewhere that outlives the
+# container, e.g. a volume shared by the jobs on a host
+DEFAULT_CACHE_PATH = os.environ.get(
+        'LISTING_CACHE_PATH',
+        os.path.join('~', '.cache', 'utilities', 's3_listing.sqlite')
+)
+
+
+class ListingCache(object):
+    """
+    An on-disk SQLite index of S3 listings (key, size, ETag, LastModified and
+    storage class). Listings under a prefix that was fetched less than ttl
+    seconds ago are answered locally, otherwise the prefix is refreshed.
+
+    with ListingCache() as cache:
+        fastqs = list(get_files(bucket, prefix, cache=cache))
+
+    By default an expired prefix gets an incremental refresh, which only
+    lists keys that sort after the last key seen for it. That is enough to
+    pick up new samples in a folder, but not deleted or overwritten objects,
+    so the whole prefix is re-listed once it was last listed in full more
+    than full_ttl seconds ago. Use a full refresh (or invalidate) to see
+    those sooner.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=24 * 3600,
+                 full_ttl=7 * 24 * 3600):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.full_ttl = full_ttl
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self._conn = sqlite3.connect(self.path)
+        with self._conn:
+            self._conn.execute(
+                    'CREATE TABLE IF NOT EXISTS objects ('
+                    ' bucket TEXT, key TEXT, size INTEGER, etag TEXT,'
+                    ' last_modified TEXT, storage_class TEXT,'
+                    ' PRIMARY KEY (bucket, key)) WITHOUT ROWID'
+            )
+            self._conn.execute(
+                    'CREATE TABLE IF NOT EXISTS prefixes ('
+                    ' bucket TEXT, prefix TEXT, refreshed REAL, last_key TEXT,'
+                    ' listed REAL, PRIMARY KEY (bucket, prefix)) WITHOUT ROWID'
+            )
+
+            # caches from before full listings were tracked get one next time
+            columns = [row[1] for row in self._conn.execute(
+                    'PRAGMA table_info(prefixes)')]
+            if 'listed' not in columns:
+                self._conn.execute('ALTER TABLE prefixes ADD COLUMN listed REAL')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-    for fn in file_list:
-        obj = s3r.Object(bucket_name, fn)
-        print(obj.key, obj.storage_class, obj.restore)
+    def close(self):
+        self._conn.close()
 
+    def _covering(self, bucket, prefix):
+        """
+        The most recently refreshed cached prefix that contains prefix, and
+        when it was refreshed and last listed in full
+        """
+        return self._conn.execute(
+                'SELECT prefix, refreshed, listed FROM prefixes'
+                ' WHERE bucket = ? AND substr(?, 1, length(prefix)) = prefix'
+                ' ORDER BY refreshed DESC LIMIT 1',
+                (bucket, prefix)
+        ).fetchone()
 
-def restore_file(k):
-    obj = s3r.Object('czbiohub-seqbot', k)
-    if not obj.restore:
-        bucket.meta.client.restore_object(
-            Bucket='czbiohub-seqbot',
-            Key=k,
-            RestoreRequest={'Days': 3}
+    def _insert(self, bucket, records):
+        self._conn.executemany(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)',
+                ((bucket, r['Key'], r['Size'], r.get('ETag'),
+                  r['LastModified'].isoformat(), r.get('StorageClass'))
+                 for r in records)
         )
 
+    def refresh(self, bucket, prefix, incremental=False):
+        """
+        Re-list a prefix from S3. With incremental=True, only keys after the
+        last one seen for this prefix are fetched.
+        """
+        row = self._conn.execute(
+                'SELECT last_key, listed FROM prefixes'
+                ' WHERE bucket = ? AND prefix = ?',
+                (bucket, prefix)
+        ).fetchone()
+
+        refreshed = time.time()
+
+        with self._conn:
+            if incremental and row is not None and row[0] is not None:
+                client = boto3.client('s3')
+                paginator = client.get_paginator('list_objects_v2')
+
+                records = []
+                for result in paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                                 StartAfter=row[0]):
+                    records.extend(result.get('Contents', []))
+                last_key = records[-1]['Key'] if records else row[0]
+                listed = row[1]
+            else:
+                records = list(parallel_prefix_gen(bucket, prefix))
+                self._delete_objects(bucket, prefix)
+                last_key = records[-1]['Key'] if records else None
+                listed = refreshed
+
+            self._insert(bucket, records)
+            self._conn.execute(
+                    'INSERT OR REPLACE INTO prefixes VALUES (?, ?, ?, ?, ?)',
+                    (bucket, prefix, refreshed, last_key, listed)
+            )
+
+    def listing(self, bucket, prefix, fn=None, incremental=True):
+        """
+        Generator of fn(result) for the objects under prefix, with results
+        shaped like list_objects_v2 Contents. Refreshes the prefix first if it
+        isn't cached or is older than the TTL: incrementally, unless
+        incremental is False or it is due a full listing.
+        """
+        if fn is None:
+            fn = lambda r: r
+
+        now = time.time()
+
+        row = self._covering(bucket, prefix)
+        if (row is None or row[2] is None or now - row[2] > self.full_ttl
+                or (not incremental and now - row[1] > self.ttl)):
+            self.refresh(bucket, prefix)
+        elif now - row[1] > self.ttl:
+            self.refresh(bucket, row[0], incremental=True)
+
+        for key, size, etag, last_modified, storage_class in self._conn.execute(
+                'SELECT key, size, etag, last_modified, storage_class'
+                ' FROM objects WHERE bucket = ? AND key >= ?'
+                ' AND substr(key, 1, ?) = ? ORDER BY key',
+                (bucket, prefix, len(prefix), prefix)):
+            yield fn({'Key': key,
+                      'Size': size,
+                      'ETag': etag,
+                      'LastModified': datetime.datetime.fromisoformat(
+                              last_modified),
+                      'StorageClass': storage_class})
+
+    def _delete_objects(self, bucket, prefix):
+        self._conn.execute(
+                'DELETE FROM objects WHERE bucket = ? AND key >= ?'
+                ' AND substr(key, 1, ?) = ?',
+                (bucket, prefix, len(prefix), prefix)
+        )
+
+    def invalidate(self, bucket, prefix=''):
+        """Drop everything cached under prefix (the whole bucket by default)"""
+        with self._conn:
+            self._delete_objects(bucket, prefix)
+            # forget any listing that covers part of prefix
+            self._conn.execute(
+                    'DELETE FROM prefixes WHERE bucket = ?'
+                    ' AND (substr(prefix, 1, ?) = ?'
+                    ' OR substr(?, 1, length(prefix)) = prefix)',
+                    (bucket, len(prefix), prefix, prefix)
+            )
+
+
+TransferResult = namedtuple('TransferResult', ('key', 'success', 'error'))
+CopySummary = namedtuple('CopySummary', ('copied', 'skipped', 'failed'))
+
+# copy_object is limited to 5 GB, anything bigger is copied in parts
+MULTIPART_COPY_LIMIT = 5 * 1024 ** 3
+MULTIPART_COPY_PART_SIZE = 512 * 1024 ** 2
+
+# uploads are sent in parts of this size, several parts at a time per file
+UPLOAD_PART_SIZE = 64 * 1024 ** 2
+UPLOAD_CONCURRENCY = 8
+
+# the most memory one file upload holds (boto3 buffers up to 10 parts), and
+# one MultipartWriter (the parts in flight and the one filling up)
+UPLOAD_MEMORY = 10 * UPLOAD_PART_SIZE
+MULTIPART_WRITER_MEMORY = (2 * UPLOAD_CONCURRENCY + 1) * UPLOAD_PART_SIZE
+
+# archive_util saves the member index of an archive next to it, with this
+# added to the key
+ARCHIVE_INDEX_SUFFIX = '.index.json'
+
+# the most keys that delete_objects accepts in one request
+DELETE_BATCH_SIZE = 1000
+
+# storage classes that need a restore before they can be read
+GLACIER_CLASSES = ('GLACIER', 'DEEP_ARCHIVE')
+RESTORE_TIERS = ('Expedited', 'Standard', 'Bulk')
+
+# client errors that mean "try again later" rather than "this will never work"
+RETRYABLE_CODES = ('SlowDown', 'Throttling', 'ThrottlingException',
+                   'RequestTimeout', 'RequestTimeTooSkewed')
+
+
+def _is_readable(head_response):
+    """True if a head_object response describes an object we can GET"""
+    if head_response.get('StorageClass') not in GLACIER_CLASSES:
+        return True
+
+    return 'ongoing-request="false"' in head_response.get('Restore', '')
+
+
+def _retryable(exc):
+    """True if a failed request is worth repeating (throttling or 5xx)"""
+    if not isinstance(exc, botocore.exceptions.ClientError):
+        return True
+
+    status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+    code = exc.response.get('Error', {}).get('Code', '')
+    return status >= 500 or status == 429 or code in RETRYABLE_CODES
+
+
+class TransferSession(object):
+    """
+    A reusable session for bulk S3 operations. Holds a single boto3 client
+    (with a connection pool sized to match) and runs requests on a bounded
+    thread pool, yielding a TransferResult for each key as it finishes.
+
+    with TransferSession(n_threads=32) as session:
+        for r in session.copy(zip(src_list, dest_list), bucket, new_bucket):
+            if not r.success:
+                print(r.key, r.error)
+
+        print(session.counters())
+    """
+
+    def __init__(self, n_threads=16, max_inflight=None):
+        self.n_threads = n_threads
+        self.max_inflight = max_inflight or 4 * n_threads
+
+        self.client = boto3.client(
+                's3',
+                config=botocore.config.Config(
+                        max_pool_connections=n_threads,
+                        retries={'max_attempts': 10}
+                )
+        )
+        # managed transfers use their own threads, keep them from
+        # exhausting the shared connection pool
+        self.transfer_config = boto3.s3.transfer.TransferConfig(
+                max_concurrency=4
+        )
+        self.upload_config = boto3.s3.transfer.TransferConfig(
+                multipart_threshold=UPLOAD_PART_SIZE,
+                multipart_chunksize=UPLOAD_PART_SIZE,
+                max_concurrency=UPLOAD_CONCURRENCY
+        )
+
+        self._executor = None
+        self._lock = threading.Lock()
+
+        self.n_succeeded = 0
+        self.n_failed = 0
+        self.n_bytes = 0
+        self.start_time = None
+
+    def __enter__(self):
+        self._get_executor()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = cf.ThreadPoolExecutor(max_workers=self.n_threads)
+            self.start_time = time.time()
+        return self._executor
+
+    def _record(self, success, n_bytes=0):
+        with self._lock:
+            if success:
+                self.n_succeeded += 1
+                self.n_bytes += n_bytes
+            else:
+                self.n_failed += 1
+
+    def _map(self, fn, items, ordered=False):
+        """
+        Apply fn to each item on the thread pool, keeping at most
+        max_inflight requests queued. Yields (item, future) pairs in
+        completion order, or in the order of items if ordered is True.
+        """
+        executor = self._get_executor()
+        items = iter(items)
+        pending = {}
+
+        def submit(n):
+            for item in itertools.islice(items, n):
+                pending[executor.submit(fn, item)] = item
+
+        submit(self.max_inflight)
+
+        while pending:
+            if ordered:
+                # dicts keep the order the requests were submitted in
+                done = [next(iter(pending))]
+                cf.wait(done)
+            else:
+                done, _ = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+
+            for f in done:
+                yield pending.pop(f), f
+
+            submit(len(done))
+
+    def _run(self, fn, items, key=lambda item: item):
+        """
+        Run fn over items with _map. fn returns the number of bytes
+        transferred. Yields TransferResults in completion order.
+        """
+        for item, f in self._map(fn, items):
+            try:
+                n_bytes = f.result()
+            except (botocore.exceptions.BotoCoreError,
+                    botocore.exceptions.ClientError,
+                    boto3.exceptions.S3UploadFailedError, OSError) as exc:
+                self._record(False)
+                yield TransferResult(key(item), False, exc)
+            else:
+                self._record(True, n_bytes or 0)
+                yield TransferResult(key(item), True, None)
+
+    def counters(self):
+        """Totals and rates for everything run through this session"""
+        elapsed = time.time() - self.start_time if self.start_time else 0.0
+        n_ops = self.n_succeeded + self.n_failed
+
+        return {
+            'succeeded': self.n_succeeded,
+            'failed': self.n_failed,
+            'bytes': self.n_bytes,
+            'seconds': elapsed,
+            'ops_per_second': n_ops / elapsed if elapsed else 0.0,
+            'bytes_per_second': self.n_bytes / elapsed if elapsed else 0.0
+        }
+
+    def copy(self, key_pairs, bucket, new_bucket, skip_existing=True):
+        """Copy (key, new_key) pairs from bucket to new_bucket"""
+
+        def copy_one(k):
+            key, new_key = k
+            if skip_existing:
+                try:
+                    self.client.head_object(Bucket=new_bucket, Key=new_key)
+                    return 0
+                except botocore.exceptions.ClientError:
+                    pass
+
+            self.client.copy(CopySource={'Bucket': bucket, 'Key': key},
+                             Bucket=new_bucket, Key=new_key,
+                             Config=self.transfer_config)
+            return 0
+
+        yield from self._run(copy_one, key_pairs, key=lambda k: k[0])
+
+    def _multipart_copy(self, bucket, key, new_bucket, new_key, size):
+        upload_id = self.client.create_multipart_upload(
+                Bucket=new_bucket, Key=new_key
+        )['UploadId']
+
+        try:
+            parts = []
+            for i, start in enumerate(range(0, size, MULTIPART_COPY_PART_SIZE)):
+                end = min(start + MULTIPART_COPY_PART_SIZE, size) - 1
+                response = self.client.upload_part_copy(
+                        Bucket=new_bucket, Key=new_key,
+                        UploadId=upload_id, PartNumber=i + 1,
+                        CopySource={'Bucket': bucket, 'Key': key},
+                        CopySourceRange='bytes={}-{}'.format(start, end)
+                )
+                parts.append({'PartNumber': i + 1,
+                              'ETag': response['CopyPartResult']['ETag']})
+
+            self.client.complete_multipart_upload(
+                    Bucket=new_bucket, Key=new_key, UploadId=upload_id,
+                    MultipartUpload={'Parts': parts}
+            )
+        except:
+            self.client.abort_multipart_upload(
+                    Bucket=new_bucket, Key=new_key, UploadId=upload_id
+            )
+            raise
 
-def restore_files(file_list, n_proc=16):
+    def copy_listed(self, record_pairs, bucket, new_bucket):
+        """
+        Copy (record, new_key) pairs from bucket to new_bucket without any
+        extra requests, where record is a listing result for the source key.
+        Objects over MULTIPART_COPY_LIMIT use a multipart server-side copy.
+        """
+
+        def copy_one(k):
+            record, new_key = k
+            if record['Size'] > MULTIPART_COPY_LIMIT:
+                self._multipart_copy(bucket, record['Key'],
+                                     new_bucket, new_key, record['Size'])
+            else:
+                self.client.copy_object(
+                        CopySource={'Bucket': bucket, 'Key': record['Key']},
+                        Bucket=new_bucket, Key=new_key
+                )
+            return record['Size']
+
+        yield from self._run(copy_one, record_pairs, key=lambda k: k[0]['Key'])
+
+    def remove(self, keys, bucket, max_retries=3):
+        """
+        Delete a list of keys from bucket, using multi-object deletes of up
+        to DELETE_BATCH_SIZE keys at a time. Only the keys that come back
+        with errors are retried.
+        """
+
+        def remove_batch(batch):
+            for i in range(max_retries + 1):
+                if i:
+                    time.sleep(2 ** (i - 1))
+
+                response = self.client.delete_objects(
+                        Bucket=bucket,
+                        Delete={'Objects': [{'Key': k} for k in batch],
+                                'Quiet': True}
+                )
+                errors = {e['Key']: e for e in response.get('Errors', [])}
+                if not errors:
+                    break
+
+                batch = list(errors)
+
+            return errors
+
+        keys = iter(keys)
+        batches = iter(lambda: list(itertools.islice(keys, DELETE_BATCH_SIZE)),
+                       [])
+
+        for batch, f in self._map(remove_batch, batches):
+            try:
+                errors = f.result()
+            except (botocore.exceptions.BotoCoreError,
+                    botocore.exceptions.ClientError) as exc:
+                errors = {k: exc for k in batch}
+
+            for k in batch:
+                if k in errors:
+                    self._record(False)
+                    yield TransferResult(k, False, errors[k])
+                else:
+                    self._record(True)
+                    yield TransferResult(k, True, None)
+
+    def head(self, keys, bucket, ordered=False):
+        """
+        Yield (key, head_object response or exception) for each key, as they
+        finish or in the order of keys if ordered is True
+        """
+        head_one = lambda k: self.client.head_object(Bucket=bucket, Key=k)
+
+        for k, f in self._map(head_one, keys, ordered=ordered):
+            try:
+                yield k, f.result()
+            except (botocore.exceptions.BotoCoreError,
+                    botocore.exceptions.ClientError) as exc:
+                yield k, exc
+
+    def restore(self, keys, bucket, days=3, tier='Standard'):
+        """Request a restore for archived keys that aren't restored already"""
+
+        def restore_one(k):
+            response = self.client.head_object(Bucket=bucket, Key=k)
+            if (response.get('StorageClass') not in GLACIER_CLASSES
+                    or response.get('Restore')):
+                return 0
+
+            try:
+                self.client.restore_object(
+                        Bucket=bucket, Key=k,
+                        RestoreRequest={'Days': days,
+                                        'GlacierJobParameters': {'Tier': tier}}
+                )
+            except botocore.exceptions.ClientError as exc:
+                code = exc.response.get('Error', {}).get('Code')
+                if code != 'RestoreAlreadyInProgress':
+                    raise
+            return 0
+
+        yield from self._run(restore_one, keys)
+
+    def download(self, key_pairs, bucket):
+        """Download (key, local_path) pairs from bucket"""
+
+        def download_one(k):
+            key, dest = k
+            self.client.download_file(Bucket=bucket, Key=key, Filename=dest,
+                                      Config=self.transfer_config)
+            return os.path.getsize(dest)
+
+        yield from self._run(download_one, key_pairs, key=lambda k: k[0])
+
+    def upload(self, file_pairs, bucket):
+        """
+        Upload (local_path, key) pairs to bucket, as multipart uploads for
+        anything over UPLOAD_PART_SIZE. An upload only succeeds once the
+        object is in S3 with the right size.
+        """
+
+        def upload_one(k):
+            src, key = k
+            size = os.path.getsize(src)
+            self.client.upload_file(Filename=src, Bucket=bucket, Key=key,
+                                    Config=self.upload_config)
+
+            uploaded = self.client.head_object(Bucket=bucket,
+                                               Key=key)['ContentLength']
+            if uploaded != size:
+                raise IOError('uploaded {} bytes of {}'.format(uploaded, size))
+
+            return size
+
+        yield from self._run(upload_one, file_pairs, key=lambda k: k[1])
+
+
+class MultipartWriter(object):
+    """
+    A write-only file object that streams into an S3 multipart upload, so
+    output can go to S3 without a local copy. Parts of part_size bytes are
+    uploaded on n_threads threads as they fill up. close() completes the
+    upload; leaving the context with an exception aborts it.
+
+    with MultipartWriter(client, bucket, key) as fh:
+        fh.write(data)
+    """
+
+    def __init__(self, client, bucket, key, part_size=UPLOAD_PART_SIZE,
+                 n_threads=UPLOAD_CONCURRENCY):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.n_threads = n_threads
+
+        self.upload_id = client.create_multipart_upload(
+                Bucket=bucket, Key=key
+        )['UploadId']
+
+        self.bytes_written = 0
+
+        self._executor = cf.ThreadPoolExecutor(max_workers=n_threads)
+        self._pending = []
+        self._parts = []
+        self._buffer = bytearray()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def _upload_part(self, part_number, data):
+        response = self.client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                PartNumber=part_number, Body=data
+        )
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def _submit(self, data):
+        # only keep a few parts in memory while they upload
+        while len(self._pending) >= 2 * self.n_threads:
+            self._parts.append(self._pending.pop(0).result())
+
+        part_number = len(self._parts) + len(self._pending) + 1
+        self._pending.append(
+                self._executor.submit(self._upload_part, part_number, data)
+        )
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+
+        while len(self._buffer) >= self.part_size:
+            self._submit(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+
+        return len(data)
+
+    def close(self):
+        if self._closed:
+            return
+
+        try:
+            # the last part can be short, and there has to be at least one
+            if self._buffer or not (self._parts or self._pending):
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+
+            self._parts.extend(f.result() for f in self._pending)
+            self._pending = []
+
+            self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={'Parts': self._parts}
+            )
+        except:
+            self.abort()
+            raise
+        finally:
+            self._executor.shutdown(wait=True)
+
+        self._closed = True
+
+    def abort(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        for f in self._pending:
+            f.cancel()
+        self._executor.shutdown(wait=True)
+
+        self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+
+def _report(results, action):
+    """Consume results, print any failures and return them"""
+    failed = [r for r in results if not r.success]
+    for r in failed:
+        print('failed to {} {}: {}'.format(action, r.key, r.error))
+
+    return failed
+
+
+def get_status(file_list, bucket_name='czbiohub-seqbot', n_proc=16):
+    """Print the storage/restore status for a list of keys"""
+
+    # printed in the order given, as they always were, so runs can be diffed
+    with TransferSession(n_threads=n_proc) as session:
+        for k, response in session.head(file_list, bucket_name, ordered=True):
+            if isinstance(response, Exception):
+                print(k, response)
+            else:
+                print(k, response.get('StorageClass'), response.get('Restore'))
+
+
+def restore_files(file_list, n_proc=16, tier='Standard'):
     """Restore a list of files from czbiohub-seqbot in parallel"""
 
-    global s3r
-    s3r = boto3.resource('s3')
-    global bucket
-    bucket = s3r.Bucket('czbiohub-seqbot')
+    print('restoring files...')
+
+    with TransferSession(n_threads=n_proc) as session:
+        return _report(session.restore(file_list, 'czbiohub-seqbot',
+                                       tier=tier),
+                       'restore')
+
+
+def _restore_and_wait(file_list, bucket, tier, days, n_proc, poll_interval,
+                      timeout, failed):
+    """
+    restore_and_wait, but adding a TransferResult to failed for each key that
+    can't be restored instead of raising at the end
+    """
+    if tier not in RESTORE_TIERS:
+        raise ValueError('Invalid restore tier {}'.format(tier))
+
+    with TransferSession(n_threads=n_proc) as session:
+        pending = set()
+
+        for r in session.restore(file_list, bucket, days=days, tier=tier):
+            if r.success:
+                pending.add(r.key)
+            else:
+                print('failed to restore {}: {}'.format(r.key, r.error))
+                failed.append(r)
+
+        start_time = time.time()
+
+        while pending:
+            for k, response in session.head(sorted(pending), bucket):
+                if isinstance(response, Exception):
+                    if not _retryable(response):
+                        print('failed to restore {}: {}'.format(k, response))
+                        pending.discard(k)
+                        failed.append(TransferResult(k, False, response))
+                elif _is_readable(response):
+                    pending.discard(k)
+                    yield k
+
+            if pending:
+                if timeout and time.time() - start_time > timeout:
+                    raise RuntimeError(
+                            '{} files still not restored after {}s'.format(
+                                    len(pending), timeout)
+                    )
+                time.sleep(poll_interval)
+
+
+def restore_and_wait(file_list, bucket='czbiohub-seqbot', *, tier='Standard',
+                     days=3, n_proc=16, poll_interval=300, timeout=None):
+    """
+    Request restores for a list of keys, then poll their status concurrently
+    and yield each key as soon as it can be read. Raises a RuntimeError at the
+    end if any restore requests failed (including keys that can't be HEADed,
+    e.g. missing or forbidden), or if timeout (in seconds) passes.
+    """
+    failed = []
+    yield from _restore_and_wait(file_list, bucket, tier, days, n_proc,
+                                 poll_interval, timeout, failed)
+
+    if failed:
+        raise RuntimeError('{} restore requests failed'.format(len(failed)))
+
+
+def restore_and_download(src_list, dest_list, *, b, tier='Standard',
+                         n_proc=16, poll_interval=300):
+    """
+    Restore a list of files and download each one as soon as it is readable,
+    rather than waiting for the whole set. Returns TransferResults for the
+    files that couldn't be restored or downloaded.
+    """
+
+    dest = dict(zip(src_list, dest_list))
+    restore_failed = []
+
+    with TransferSession(n_threads=n_proc) as session:
+        executor = session._get_executor()
+        futures = {}
 
-    print('creating pool')
+        for k in _restore_and_wait(list(dest), b, tier, 3, n_proc,
+                                   poll_interval, None, restore_failed):
+            if os.path.dirname(dest[k]):
+                os.makedirs(os.path.dirname(dest[k]), exist_ok=True)
 
-    p = multiprocessing.Pool(processes=n_proc)
+            f = executor.submit(session.client.download_file,
+                                Bucket=b, Key=k, Filename=dest[k],
+                                Config=session.transfer_config)
+            futures[f] = k
 
-    try:
-        print('restoring files...')
-        p.map(restore_file, file_list, chunksize=100)
-    finally:
-        p.close()
-        p.join()
+        failed = []
+        for f in cf.as_completed(futures):
+            try:
+                f.result()
+                session._record(True, os.path.getsize(dest[futures[f]]))
+            except (botocore.exceptions.BotoCoreError,
+                    botocore.exceptions.ClientError, OSError) as exc:
+                session._record(False)
+                failed.append(TransferResult(futures[f], False, exc))
 
+    return restore_failed + _report(failed, 'download')
 
-def copy_file(k):
-    key, new_key = k
-    try:
-        s3c.head_object(Bucket=new_bucket, Key=new_key)
-    except botocore.exceptions.ClientError:
-        s3c.copy(CopySource={'Bucket': bucket, 'Key': key},
-                 Bucket=new_bucket,
-                 Key=new_key)
 
+def _same_object(record, dest_record):
+    """Compare two listing results on size and (single-part) ETag"""
+    if record['Size'] != dest_record['Size']:
+        return False
 
-def copy_files(src_list, dest_list, b, nb, n_proc=16):
+    # multipart ETags depend on the part size, so they can't be compared
+    if '-' in record['ETag'] or '-' in dest_record['ETag']:
+        return True
+
+    return record['ETag'] == dest_record['ETag']
+
+
+def _key_records(session, bucket, keys, prefix=None):
+    """
+    Listing results for keys, from one listing of prefix (by default, what
+    the keys have in common). If that's the whole bucket, each key gets a
+    HEAD request instead. Keys that aren't there are left out.
+    """
+    if prefix is None:
+        prefix = os.path.commonprefix(keys)
+
+    if prefix:
+        return {r['Key']: r for r in parallel_prefix_gen(
+                bucket, prefix, n_threads=session.n_threads)}
+
+    records = dict()
+    for key, response in session.head(keys, bucket):
+        if not isinstance(response, Exception):
+            records[key] = {'Key': key, 'Size': response['ContentLength'],
+                            'ETag': response['ETag']}
+
+    return records
+
+
+def _diff_copy(session, src_list, dest_list, b, nb, src_prefix=None,
+               dest_prefix=None):
+    """List both sides once and copy only missing or changed keys"""
+    src_list = list(src_list)
+    dest_list = list(dest_list)
+
+    if not src_list:
+        return CopySummary([], [], [])
+
+    src_records = _key_records(session, b, src_list, src_prefix)
+    dest_records = _key_records(session, nb, dest_list, dest_prefix)
+
+    to_copy = []
+    skipped = []
+    failed = []
+
+    for key, new_key in zip(src_list, dest_list):
+        if key not in src_records:
+            failed.append(key)
+            print('failed to copy {}: not found in source listing'.format(key))
+        elif (new_key in dest_records
+              and _same_object(src_records[key], dest_records[new_key])):
+            skipped.append(key)
+        else:
+            to_copy.append((src_records[key], new_key))
+
+    copied = []
+    for r in session.copy_listed(to_copy, b, nb):
+        if r.success:
+            copied.append(r.key)
+        else:
+            failed.append(r.key)
+            print('failed to copy {}: {}'.format(r.key, r.error))
+
+    return CopySummary(copied, skipped, failed)
+
+
+def copy_files(src_list, dest_list, b, nb, n_proc=16, diff=False,
+               src_prefix=None, dest_prefix=None):
     """
     Copy a list of files from src_list to dest_list.
     b - original bucket
     nb - destination bucket
-    """
 
-    global s3c
-    s3c = boto3.client('s3')
+    With diff=True, the source and destination prefixes are listed once and
+    only keys that are missing or differ (by size and ETag) are copied,
+    instead of checking each key with a HEAD request. Returns a CopySummary.
+    The prefixes to list are what the keys have in common, unless src_prefix
+    and dest_prefix are given. If that's nothing, the keys are checked with
+    HEAD requests after all, rather than listing the whole bucket.
+    """
 
-    global bucket
-    bucket = b
-    global new_bucket
-    new_bucket = nb
+    with TransferSession(n_threads=n_proc) as session:
+        if diff:
+            summary = _diff_copy(session, src_list, dest_list, b, nb,
+                                 src_prefix, dest_prefix)
+            print('{} copied, {} skipped, {} failed'.format(
+                    len(summary.copied), len(summary.skipped),
+                    len(summary.failed))
+            )
+            return summary
 
-    try:
-        p = multiprocessing.Pool(processes=n_proc)
-        p.map(copy_file, zip(src_list, dest_list), chunksize=100)
-    finally:
-        p.close()
-        p.join()
+        return _report(session.copy(zip(src_list, dest_list), b, nb), 'copy')
 
 
-def remove_file(k):
-    s3c.delete_object(Bucket=bucket, Key=k)
+def remove_files(file_list, *, b, really=False, n_proc=16, dryrun=False):
+    """
+    Remove a list of file keys from S3. With dryrun=True, just report how
+    many keys (and delete requests) it would take.
+    """
 
+    file_list = list(file_list)
 
-def remove_files(file_list, *, b, really=False, n_proc=16):
-    """Remove a list of file keys from S3"""
+    if dryrun:
+        print("Would remove {} files in {} requests".format(
+                len(file_list), -(-len(file_list) // DELETE_BATCH_SIZE))
+        )
+        return len(file_list)
 
     assert really
 
     print("Removing {} files!".format(len(file_list)))
 
-    global s3c
-    s3c = boto3.client('s3')
-    global bucket
-    bucket = b
+    with TransferSession(n_threads=n_proc) as session:
+        return _report(session.remove(file_list, b), 'remove')
 
-    try:
-        p = multiprocessing.Pool(processes=n_proc)
-        p.map(remove_file, file_list, chunksize=100)
-    finally:
-        p.close()
-        p.join()
 
+def download_files(src_list, dest_list, *, b, n_proc=16):
+    """Download a list of file to local storage"""
 
-def download_file(k):
-    key, dest = k
-    s3c.download_file(Bucket=bucket, Key=key, Filename=dest)
+    with TransferSession(n_threads=n_proc) as session:
+        return _report(session.download(zip(src_list, dest_list), b),
+                       'download')
 
 
-def download_files(src_list, dest_list, *, b, n_proc=16):
-    """Download a list of file to local storage"""
+def upload_files(src_list, dest_list, *, b, n_proc=16):
+    """Upload a list of local files to bucket b"""
+
+    with TransferSession(n_threads=n_proc) as session:
+        return _report(session.upload(zip(src_list, dest_list), b),
+                       'upload')
+
+
+def read_archive_member(bucket, key, member, index=None, client=None):
+    """
+    Read one file from an indexed archive with a single ranged GET, instead
+    of downloading the whole archive. member is its name in the archive.
+    Pass the archive's index to save fetching it again.
+    """
+    if client is None:
+        client = boto3.client('s3')
+
+    if index is None:
+        response = client.get_object(Bucket=bucket,
+                                     Key=key + ARCHIVE_INDEX_SUFFIX)
+        index = json.loads(response['Body'].read().decode())
+
+    if member not in index['members']:
+        raise KeyError('{} is not in s3://{}/{}'.format(member, bucket, key))
+
+    entry = index['members'][member]
+    response = client.get_object(
+            Bucket=bucket, Key=key,
+            Range='bytes={}-{}'.format(entry['offset'],
+                                       entry['offset'] + entry['length'] - 1)
+    )
+    data = gzip.decompress(response['Body'].read())
 
-    global s3c
-    s3c = boto3.client('s3')
-    global bucket
-    bucket = b
-
-    try:
-        multiprocessing.Pool(processes=n_proc)
-        p.map(download_file, src_list, dest_list, chunksize=100)
-    finally:
-        p.close()
-        p.join()
+    return data[entry['data_offset']:entry['data_offset'] + entry['size']]
@@ -0,0 +1,137 @@
+import datetime
+import heapq
+import json
+import os
+import re
+
+import boto3
+
+from collections import defaultdict
+
+import utilities.s3_util as s3u
+
+
+# matches fastq names like SAMPLE_R1_001.fastq.gz and captures SAMPLE
+SAMPLE_RE = re.compile("([^/]+)_R\d_\d+.fastq.gz$")
+
+# results older than this are out of date and get re-run
+CURR_MIN_VER = datetime.datetime(2017, 3, 1, tzinfo=datetime.timezone.utc)
+
+
+def read_json(path):
+    """Load JSON from a local path or an s3:// URI"""
+    if path.startswith('s3://'):
+        bucket, key = s3u.s3_bucket_and_key(path)
+        response = boto3.client('s3').get_object(Bucket=bucket, Key=key)
+        return json.loads(response['Body'].read().decode())
+
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def write_json(path, obj):
+    """Write obj as JSON to a local path or an s3:// URI"""
+    if path.startswith('s3://'):
+        bucket, key = s3u.s3_bucket_and_key(path)
+        boto3.client('s3').put_object(Bucket=bucket, Key=key,
+                                      Body=json.dumps(obj).encode())
+    else:
+        with open(path, 'w') as fh:
+            json.dump(obj, fh)
+
+
+def get_samples(bucket, prefix, cache=None):
+    """
+    Group the fastq.gz files under a prefix by sample.
+    Returns {sample_name: [(key, size), ...]}
+    """
+    samples = defaultdict(list)
+
+    for key, size in s3u.get_size(bucket, prefix, cache=cache):
+        matched = SAMPLE_RE.search(os.path.basename(key))
+        if matched:
+            samples[matched.group(1)].append((key, size))
+
+    return samples
+
+
+def get_output_path(s3_input_path, input_dir, s3_output_path=None):
+    """Where results for input_dir go, by default [input_dir]/results"""
+    if s3_output_path is None:
+        return os.path.join(s3_input_path, input_dir, 'results')
+
+    return s3_output_path
+
+
+def get_finished(s3_output_path, cache=None):
+    """The (sample_name, taxon) pairs that have an up-to-date htseq-count.txt"""
+    bucket, prefix = s3u.s3_bucket_and_key(s3_output_path)
+
+    output = s3u.parallel_prefix_gen(bucket, prefix,
+                                     lambda r: (r['LastModified'], r['Key']),
+                                     cache=cache)
+
+    return {tuple(os.path.basename(fn).split('.')[:2]) for dt,fn in output
+            if fn.endswith('htseq-count.txt') and dt > CURR_MIN_VER}
+
+
+def make_manifest(s3_input_path, input_dirs, s3_output_path=None, cache=None):
+    """
+    List the fastqs and existing results for an alignment run once, so the
+    jobs don't have to. The manifest looks like
+
+    {'s3_input_path': ...,
+     'input_dirs': {input_dir: {'s3_output_path': ...,
+                                'samples': {sample_name: {
+                                    'fastqs': [[key, size], ...],
+                                    'finished': [taxon, ...]}}}}}
+    """
+    s3_input_bucket, s3_input_prefix = s3u.s3_bucket_and_key(s3_input_path)
+
+    manifest = {'s3_input_path': s3_input_path, 'input_dirs': dict()}
+
+    for input_dir in input_dirs:
+        output_path = get_output_path(s3_input_path, input_dir, s3_output_path)
+
+        finished = defaultdict(list)
+        for sample_name, taxon in get_finished(output_path, cache=cache):
+            finished[sample_name].append(taxon)
+
+        samples = get_samples(s3_input_bucket,
+                              os.path.join(s3_input_prefix, input_dir),
+                              cache=cache)
+
+        manifest['input_dirs'][input_dir] = {
+            's3_output_path': output_path,
+            'samples': {
+                sample_name: {'fastqs': sorted(fastqs),
+                              'finished': sorted(finished[sample_name])}
+                for sample_name, fastqs in samples.items()
+            }
+        }
+
+    return manifest
+
+
+def plan_partitions(sample_sizes, num_partitions):
+    """
+    Split samples into num_partitions with roughly equal total size, by
+    assigning the largest remaining sample to the lightest partition.
+
+    sample_sizes is {(input_dir, sample_name): bytes}. Returns a plan:
+    {'num_partitions': N, 'partitions': [{'samples': [...], 'bytes': n}]}
+    """
+    partitions = [{'samples': [], 'bytes': 0} for i in range(num_partitions)]
+    heap = [(0, i) for i in range(num_partitions)]
+
+    for sample, size in sorted(sample_sizes.items(),
+                               key=lambda s: (-s[1], s[0])):
+        load, i = heapq.heappop(heap)
+        partitions[i]['samples'].append(list(sample))
+        partitions[i]['bytes'] += size
+        heapq.heappush(heap, (load + size, i))
+
+    for partition in partitions:
+        partition['samples'].sort()
+
+    return {'num_partitions': num_partitions, 'partitions': partitions}